@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Analytics
+
+Read-only access to the events DB for analysis and reporting. Connections are
+opened with a read-only URI and memory-mapped I/O, so any number of processes
+(e.g. parallel report generation) can read the same file through the OS page
+cache without taking write locks or copying pages into per-connection caches.
+
+By default the DB is also opened with immutable=1, which tells SQLite that the
+file cannot change while it is open: no locking or change detection at all.
+Only use that when nothing is ingesting into the DB at the same time. Pass
+immutable=False to get plain read-only access to a DB that is being written.
+While an ingest connection has the DB open in WAL mode (see db), recent rows
+are only in the -wal file, which immutable readers would not see; immutable
+is dropped automatically whenever that file exists.
+
+Query results are returned as Arrow record batches. If the ADBC SQLite driver
+(adbc_driver_sqlite) is installed, batches are built natively by the driver
+and never pass through Python objects; otherwise rows are fetched with sqlite3
+and converted column by column. Either way the result converts to pandas
+(to_pandas), polars or Parquet without another copy through Python.
+
+Usage:
+    python analytics.py "SELECT * FROM Fleet_Summary" -o fleets.parquet
+
+@author: alexe
+"""
+import argparse
+import os
+import sqlite3
+from urllib.parse import quote
+import pyarrow as pa
+import db
+
+try:
+    import adbc_driver_sqlite.dbapi as adbc_sqlite
+except ImportError:
+    adbc_sqlite = None
+
+# Default memory map size. SQLite maps at most this much of the file, the
+# whole DB fits comfortably.
+MMAP_SIZE = 1024 * 1024 * 1024
+
+def readonly_uri(path, immutable=True):
+    if os.path.exists(path + '-wal'):
+        immutable = False
+    uri = f'file:{quote(os.path.abspath(path))}?mode=ro'
+    if immutable:
+        uri += '&immutable=1'
+    return uri
+
+# Open a read-only connection to the DB with sqlite3
+def connect_readonly(path=db.DEFAULT_PATH, immutable=True,
+                     mmap_size=MMAP_SIZE, **kwargs):
+    kwargs.setdefault('check_same_thread', False)
+    conn = sqlite3.connect(readonly_uri(path, immutable), uri=True, **kwargs)
+    conn.execute(f'PRAGMA mmap_size = {mmap_size}')
+    conn.execute('PRAGMA query_only = 1')
+    return conn
+
+# Build an Arrow array for one result column. SQLite columns can mix types
+# (dynamic typing), which Arrow cannot infer a single type for; those columns,
+# and ones with no values to infer from, fall back to strings.
+def column_array(values):
+    try:
+        arr = pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if v is None else str(v) for v in values],
+                        type=pa.string())
+    if pa.types.is_null(arr.type):
+        return pa.array(values, type=pa.string())
+    return arr
+
+# Convert a list of row tuples to a record batch, inferring column types
+def rows_to_batch(rows, names):
+    columns = list(zip(*rows)) if rows else [[] for _ in names]
+    return pa.RecordBatch.from_arrays(
+        [column_array(list(col)) for col in columns], names=names)
+
+# Run a query on an sqlite3 connection and return an Arrow table. SQLite
+# columns have no fixed type, so all rows are fetched before types are
+# inferred; the table is then split into batches without copying. Column
+# names come from the cursor, so empty results still have a schema.
+def sqlite3_table(conn, query, params=()):
+    cursor = conn.execute(query, params)
+    names = [d[0] for d in cursor.description]
+    return pa.Table.from_batches([rows_to_batch(cursor.fetchall(), names)])
+
+# Run a query with the ADBC driver and return an Arrow table
+def adbc_table(query, params=(), path=db.DEFAULT_PATH, immutable=True):
+    with adbc_sqlite.connect(readonly_uri(path, immutable)) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+        cursor.execute(query, params)
+        table = cursor.fetch_arrow_table()
+        cursor.close()
+    return table
+
+# Yield the results of a query as Arrow record batches of at most batch_size
+# rows each.
+def query_batches(query, params=(), path=db.DEFAULT_PATH, immutable=True,
+                  batch_size=64 * 1024):
+    if adbc_sqlite is not None:
+        uri = readonly_uri(path, immutable)
+        with adbc_sqlite.connect(uri) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+            cursor.execute(query, params)
+            reader = cursor.fetch_record_batch()
+            for batch in reader:
+                yield from pa.Table.from_batches([batch]).to_batches(
+                    max_chunksize=batch_size)
+            cursor.close()
+    else:
+        yield from query_table(query, params, path, immutable).to_batches(
+            max_chunksize=batch_size)
+
+# Run a query and return the result as an Arrow table. The table keeps the
+# query's columns even when there are no rows.
+def query_table(query, params=(), path=db.DEFAULT_PATH, immutable=True):
+    if adbc_sqlite is not None:
+        return adbc_table(query, params, path, immutable)
+    conn = connect_readonly(path, immutable)
+    try:
+        return sqlite3_table(conn, query, params)
+    finally:
+        conn.close()
+
+# Run a query and return the result as a pandas DataFrame
+def read_frame(query, params=(), path=db.DEFAULT_PATH, immutable=True):
+    return query_table(query, params, path, immutable).to_pandas()
+
+# Write a query result to a file, format chosen from the extension (.csv,
+# .parquet, or .arrow/.feather for Arrow IPC)
+def export(query, out_path, params=(), path=db.DEFAULT_PATH,
+           immutable=True):
+    table = query_table(query, params, path, immutable)
+    ext = os.path.splitext(out_path)[1].lower()
+    if ext == '.csv':
+        import pyarrow.csv as pa_csv
+        pa_csv.write_csv(table, out_path)
+    elif ext == '.parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, out_path)
+    elif ext in ('.arrow', '.feather'):
+        import pyarrow.feather as feather
+        feather.write_feather(table, out_path)
+    else:
+        raise ValueError(f'Unknown export format: {ext}')
+    return table.num_rows
+
+def add_arguments(parser):
+    parser.add_argument("query", type=str,
+                        help="SQL query, or the name of a table or view")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                        help="output file (.csv, .parquet, .arrow)")
+    parser.add_argument("--db", type=str, default=db.DEFAULT_PATH)
+    parser.add_argument("--live", action='store_true',
+                        help="DB may be written while reading (disables"
+                        + " immutable mode)")
+
+def main(args):
+    query = args.query
+    if len(query.split()) == 1:
+        query = f'SELECT * FROM {query}'
+    nrows = export(query, args.output, path=args.db,
+                   immutable=not args.live)
+    print(f'Wrote {nrows} rows to {args.output}')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="analytics",
+        description="export query results from the Armada SQL DB")
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Armada
+
+One command line for the tools:
+    scrape - fetch an event from T4.tools and add it to the DB (web_scraper)
+    ingest - add or update an event from a saved T4 page (event_sync)
+    views - build the summary views and export them to csv (make_views)
+    export - write a query, table or view to csv/parquet/arrow (analytics)
+    bench - run the timing benchmarks (benchmarks)
+
+Each tool is only imported once its subcommand has been picked, and the tools
+import their heavy dependencies (selenium, bs4, pandas, the LLM SDKs) only
+when they use them, so `armada.py views` or a scores-only scrape does not
+load the LLM backends or need API keys. Startup time of each subcommand is
+measured with -X importtime by benchmarks.importtime.
+
+Usage:
+    python armada.py scrape https://t4.tools/events/... --no-fleets
+    python armada.py views --force
+    python armada.py export Fleet_Summary -o fleets.parquet
+    python armada.py bench -k make_views
+
+@author: alexe
+"""
+import argparse
+import importlib
+import sys
+
+# Subcommand: (module, description)
+commands = {
+    'scrape': ('web_scraper',
+               'fetch an event from T4.tools and add it to the DB'),
+    'ingest': ('event_sync',
+               'add or update an event in the DB from a saved T4 page'),
+    'views': ('make_views',
+              'build the summary views and export them to csv'),
+    'export': ('analytics',
+               'write a query, table or view to csv, parquet or arrow'),
+    'bench': ('benchmarks.__main__',
+              'run timing benchmarks on synthetic events'),
+    }
+
+def command_parser():
+    parser = argparse.ArgumentParser(
+        prog="armada",
+        description="tools for the SW Armada events DB",
+        epilog="run 'armada.py <command> -h' for the options of a command")
+    subparsers = parser.add_subparsers(dest='command', metavar='command',
+                                       required=True)
+    for name, (_, description) in commands.items():
+        # Options are only added for the chosen command, see main
+        subparsers.add_parser(name, help=description, add_help=False)
+    return parser
+
+# Pick the subcommand from argv[0], then import its module and parse the
+# rest of argv with the module's own arguments
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in commands:
+        command_parser().parse_args(argv)
+        return
+    name = argv[0]
+    module_name, description = commands[name]
+    module = importlib.import_module(module_name)
+    parser = argparse.ArgumentParser(prog=f"armada {name}",
+                                     description=description)
+    module.add_arguments(parser)
+    return module.main(parser.parse_args(argv[1:]))
+
+if __name__ == '__main__':
+    main()
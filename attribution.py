@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Attribution
+
+Estimate how much each component (ship, upgrade, squadron or flagship, as in
+cooccurrence) changes the chance of winning a game, controlling for the rest
+of the list. Fleet_Summary averages (avg_tp, mov) mix up a component with the
+lists and players that happen to take it.
+
+Each game in Scores between two players with fleets in the DB is one
+observation. The model is a paired-comparison logistic regression:
+    P(A beats B) = 1 / (1 + exp(-w . (x_A - x_B)))
+where x is the fleet's 0/1 vector of components, so w_i is the change in the
+log-odds of winning from having component i, all else equal. Optionally a
+player strength covariate is added: the player's average tournament points
+in the other events of the window (shrunk towards the window average when
+they played few games), so that good players' favourite components are not
+credited with their wins. Games won on tournament points count as wins;
+draws and byes are left out. Components in fewer than min_fleets fleets are
+dropped.
+
+The design matrix is sparse (a fleet has ~25 of several hundred components)
+and is kept as coordinate arrays; products with it are numpy bincounts. The
+model is fitted with L2 regularization by Newton's method, solving each
+Newton step by conjugate gradients on Hessian-vector products, so the
+Hessian is never formed and memory grows with the number of games, not
+games x components.
+
+Confidence intervals come from a bootstrap over games: each replicate refits
+the model with games weighted by how many times they were drawn, starting
+from the full fit. Replicates run in parallel processes.
+
+Fitted models are cached by a digest of the data and the settings, in memory
+and optionally in a directory (--cache), so refitting a window whose games
+have not changed costs only the query. Within a process, the digest is also
+remembered by the revisions of the window's events (see event_sync), so
+while none of them changes the games are not queried again either.
+
+Usage:
+    python attribution.py --since 2025-01-01 --bootstrap 200
+    python attribution.py --event 3 4 5 --player-strength --top 20
+
+@author: alexe
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import compact_fleet
+import cooccurrence
+import sql_queries
+import db
+import fleet_lists
+
+# Games played by a player in other events, worth as much as the window
+# average when working out their strength
+STRENGTH_PRIOR_GAMES = 3
+
+# Event window: WHERE clause on Events (as e) and its parameters
+def event_filter(event_ids=None, since=None, until=None):
+    conditions = []
+    params = []
+    if event_ids is not None:
+        conditions.append('e.id IN (SELECT value FROM json_each(?))')
+        params.append(json.dumps([int(ii) for ii in event_ids]))
+    if since is not None:
+        conditions.append('e.date >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('e.date <= ?')
+        params.append(until)
+    return ' AND '.join(conditions) or '1', tuple(params)
+
+# Strength of each (player, event): average tournament points in the other
+# events of the window, shrunk towards the window average, minus that average
+def player_strength(conn, where, params):
+    totals = {}
+    events = {}
+    for player, event_id, tp in conn.execute(
+            sql_queries.get_player_games_where.format(where=where), params):
+        total = totals.setdefault(player, [0, 0])
+        total[0] += tp
+        total[1] += 1
+        event = events.setdefault((player, event_id), [0, 0])
+        event[0] += tp
+        event[1] += 1
+    num_games = sum(n for _, n in totals.values())
+    mean = sum(tp for tp, _ in totals.values()) / max(1, num_games)
+    res = {}
+    for (player, event_id), (event_tp, event_n) in events.items():
+        tp, n = totals[player]
+        tp -= event_tp
+        n -= event_n
+        res[(player, event_id)] = (tp + STRENGTH_PRIOR_GAMES * mean) \
+            / (n + STRENGTH_PRIOR_GAMES) - mean
+    return res
+
+# Games of the window as a sparse paired design matrix. Returns a dict with
+# the coordinate arrays (rows, cols, vals), outcomes y (1 if the first
+# player won), the component item of each column (see cooccurrence.encode;
+# the strength column, if any, is last) and the number of fleets with each
+# component.
+def build_dataset(conn, event_ids=None, since=None, until=None, min_fleets=5,
+                  strength=False):
+    where, params = event_filter(event_ids, since, until)
+    games = [(f1, f2, tp1 > tp2) for _, _, f1, f2, tp1, tp2 in conn.execute(
+        sql_queries.get_games_where.format(where=where), params)
+        if tp1 != tp2]
+    fleet_ids = sorted({f for f1, f2, _ in games for f in (f1, f2)})
+    archive = compact_fleet.FleetArchive.from_db(conn, fleet_ids)
+    commanders = fleet_lists.get_names(conn).commanders
+    items = {archive.ids[ii]: cooccurrence.fleet_items(archive, ii,
+                                                       commanders)
+             for ii in range(len(archive))}
+
+    num_fleets = {}
+    for fleet_items in items.values():
+        for item in fleet_items:
+            num_fleets[item] = num_fleets.get(item, 0) + 1
+    columns = sorted(item for item, n in num_fleets.items()
+                     if n >= min_fleets)
+    column_index = {item: col for col, item in enumerate(columns)}
+
+    rows = []
+    cols = []
+    vals = []
+    for row, (f1, f2, _) in enumerate(games):
+        for val, only in ((1., items[f1] - items[f2]),
+                          (-1., items[f2] - items[f1])):
+            for item in only:
+                if item in column_index:
+                    rows.append(row)
+                    cols.append(column_index[item])
+                    vals.append(val)
+    num_features = len(columns)
+    if strength:
+        strengths = player_strength(conn, where, params)
+        fleets = {fleet_id: (player, event_id) for fleet_id, event_id, player
+                  in conn.execute('SELECT id, event_id, player FROM Fleets'
+                                  + ' WHERE id IN (SELECT value'
+                                  + ' FROM json_each(?))',
+                                  (json.dumps(fleet_ids),))}
+        for row, (f1, f2, _) in enumerate(games):
+            diff = strengths.get(fleets[f1], 0.) \
+                - strengths.get(fleets[f2], 0.)
+            if diff:
+                rows.append(row)
+                cols.append(num_features)
+                vals.append(diff)
+        num_features += 1
+    return {'rows': np.array(rows, dtype=np.int64),
+            'cols': np.array(cols, dtype=np.int64),
+            'vals': np.array(vals, dtype=np.float64),
+            'y': np.array([won for _, _, won in games], dtype=np.float64),
+            'items': columns, 'strength': strength,
+            'num_features': num_features,
+            'num_fleets': [num_fleets[item] for item in columns]}
+
+# Logistic loss of weights w, with games weighted by weights
+def loss(w, data, l2, weights):
+    z = matvec(data, w)
+    return float(np.sum(weights * (np.logaddexp(0., z) - data['y'] * z))
+                 + 0.5 * l2 * w @ w)
+
+def matvec(data, w):
+    return np.bincount(data['rows'], weights=data['vals'] * w[data['cols']],
+                       minlength=len(data['y']))
+
+def rmatvec(data, r):
+    return np.bincount(data['cols'], weights=data['vals'] * r[data['rows']],
+                       minlength=data['num_features'])
+
+# L2-regularized logistic regression by Newton-CG. weights are per-game
+# weights (all 1 by default); w is the starting point.
+def fit(data, l2=1., weights=None, w=None, tol=1e-6, max_iter=50,
+        max_cg=100):
+    num_features = data['num_features']
+    weights = np.ones(len(data['y'])) if weights is None else weights
+    w = np.zeros(num_features) if w is None else np.array(w, dtype=float)
+    current = loss(w, data, l2, weights)
+    for _ in range(max_iter):
+        z = matvec(data, w)
+        p = np.exp(-np.logaddexp(0., -z))
+        grad = rmatvec(data, weights * (p - data['y'])) + l2 * w
+        if np.max(np.abs(grad), initial=0.) < tol * max(1., weights.sum()):
+            break
+        curvature = weights * p * (1. - p)
+
+        # Conjugate gradients for the Newton step H d = -grad, solved only
+        # roughly while far from the optimum (inexact Newton)
+        grad_sq = grad @ grad
+        forcing = min(0.5, (grad_sq ** 0.5 / max(1., weights.sum())) ** 0.5)
+        step = np.zeros(num_features)
+        resid = -grad
+        direction = resid.copy()
+        resid_sq = resid @ resid
+        for _ in range(max_cg):
+            h_dir = rmatvec(data, curvature * matvec(data, direction)) \
+                + l2 * direction
+            alpha = resid_sq / (direction @ h_dir)
+            step += alpha * direction
+            resid -= alpha * h_dir
+            new_sq = resid @ resid
+            if new_sq < forcing ** 2 * grad_sq:
+                break
+            direction = resid + new_sq / resid_sq * direction
+            resid_sq = new_sq
+
+        # Backtracking line search
+        rate = 1.
+        while rate > 1e-8:
+            new_w = w + rate * step
+            new_loss = loss(new_w, data, l2, weights)
+            if new_loss <= current + 1e-4 * rate * (grad @ step):
+                break
+            rate *= 0.5
+        if current - new_loss < tol * 1e-3 * max(1., abs(current)):
+            w, current = new_w, new_loss
+            break
+        w, current = new_w, new_loss
+    return w
+
+# Fit count bootstrap replicates. Runs in worker processes.
+def bootstrap_fits(data, l2, w0, seed, count):
+    rng = np.random.default_rng(seed)
+    num_games = len(data['y'])
+    res = []
+    for _ in range(count):
+        weights = np.bincount(rng.integers(0, num_games, num_games),
+                              minlength=num_games).astype(np.float64)
+        res.append(fit(data, l2, weights=weights, w=w0))
+    return res
+
+class Model:
+    def __init__(self, data, coef, l2, samples=None, level=0.9):
+        self.items = data['items']
+        self.strength = data['strength']
+        self.num_games = len(data['y'])
+        self.num_fleets = data['num_fleets']
+        self.l2 = l2
+        self.coef = coef
+        self.lower = self.upper = None
+        if samples is not None and len(samples):
+            tail = (1. - level) / 2. * 100.
+            self.lower, self.upper = np.percentile(
+                samples, [tail, 100. - tail], axis=0)
+
+    # Coefficient of the strength covariate (per tournament point)
+    @property
+    def strength_coef(self):
+        return float(self.coef[-1]) if self.strength else None
+
+    # (item, coefficient, lower, upper, fleets) per component, by coefficient
+    def table(self):
+        res = []
+        for col, item in enumerate(self.items):
+            res.append((item, float(self.coef[col]),
+                        None if self.lower is None else float(self.lower[col]),
+                        None if self.upper is None else float(self.upper[col]),
+                        self.num_fleets[col]))
+        res.sort(key=lambda row: -row[1])
+        return res
+
+# Fitted models by digest of data and settings
+_models = {}
+
+# Digest of the data of each window already fitted, by DB file, revisions of
+# the window's events (see event_sync) and settings, so a window whose events
+# have not changed is not queried again
+_windows = {}
+
+def window_key(conn, event_ids, since, until, min_fleets, strength):
+    where, params = event_filter(event_ids, since, until)
+    revisions = conn.execute(
+        sql_queries.get_event_revisions_where.format(where=where),
+        params).fetchall()
+    path = conn.execute('PRAGMA database_list').fetchone()[2]
+    return (os.path.abspath(path) if path else None, tuple(revisions),
+            min_fleets, strength)
+
+def digest(data, l2, bootstrap, seed):
+    sha = hashlib.sha1()
+    for key in ('rows', 'cols', 'vals', 'y'):
+        sha.update(data[key].tobytes())
+    sha.update(json.dumps([data['items'], data['strength'], l2, bootstrap,
+                           seed]).encode('utf-8'))
+    return sha.hexdigest()
+
+# Fit the model for an event window, with bootstrap intervals if bootstrap
+# is the number of replicates. Cached models are reused when the window's
+# games and the settings are unchanged; if none of the window's events has a
+# new revision, the games are not even read.
+def fit_window(conn, event_ids=None, since=None, until=None, min_fleets=5,
+               strength=False, l2=1., bootstrap=0, workers=None, seed=0,
+               cache_dir=None):
+    window = window_key(conn, event_ids, since, until, min_fleets, strength) \
+        + (l2, bootstrap, seed)
+    data = None
+    key = _windows.get(window)
+    if key is None:
+        data = build_dataset(conn, event_ids, since, until, min_fleets,
+                             strength)
+        key = _windows[window] = digest(data, l2, bootstrap, seed)
+    if key in _models:
+        return _models[key]
+    cache_path = os.path.join(cache_dir, f'{key}.pickle') if cache_dir \
+        else None
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            model = _models[key] = pickle.load(f)
+        return model
+
+    if data is None:
+        data = build_dataset(conn, event_ids, since, until, min_fleets,
+                             strength)
+    coef = fit(data, l2)
+    samples = None
+    if bootstrap:
+        workers = min(workers or os.cpu_count() or 1, bootstrap)
+        counts = [bootstrap // workers + (ii < bootstrap % workers)
+                  for ii in range(workers)]
+        seeds = np.random.SeedSequence(seed).spawn(workers)
+        if workers > 1:
+            with ProcessPoolExecutor(workers) as executor:
+                results = executor.map(bootstrap_fits, [data] * workers,
+                                       [l2] * workers, [coef] * workers,
+                                       seeds, counts)
+                samples = [w for res in results for w in res]
+        else:
+            samples = bootstrap_fits(data, l2, coef, seeds[0], counts[0])
+        samples = np.array(samples)
+    model = _models[key] = Model(data, coef, l2, samples)
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, 'wb') as f:
+            pickle.dump(model, f)
+    return model
+
+def row_text(row, names):
+    item, coef, lower, upper, num_fleets = row
+    text = f'{cooccurrence.item_name(item, names):60s} {coef:+.3f}'
+    if lower is not None:
+        text += f' [{lower:+.3f}, {upper:+.3f}]'
+    return text + f' ({num_fleets} fleets)'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="attribution",
+        description="estimate the effect of each component on winning games")
+    parser.add_argument("--db", type=str, default=db.DEFAULT_PATH)
+    parser.add_argument("--event", type=int, nargs='+', dest='event_ids',
+                        help="events in the window (default: all)")
+    parser.add_argument("--since", type=str, help="first event date")
+    parser.add_argument("--until", type=str, help="last event date")
+    parser.add_argument("--min-fleets", type=int, default=5,
+                        help="leave out components in fewer fleets")
+    parser.add_argument("--player-strength", action='store_true',
+                        help="control for player strength")
+    parser.add_argument("--l2", type=float, default=1.,
+                        help="regularization strength")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="bootstrap replicates for 90%% intervals")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cache", type=str,
+                        help="directory to keep fitted models in")
+    parser.add_argument("--top", type=int, default=15,
+                        help="components to print at each end")
+    args = parser.parse_args()
+
+    try:
+        conn = db.connect_readonly(args.db)
+    except ValueError as e:
+        parser.error(str(e))
+    model = fit_window(conn, args.event_ids, args.since, args.until,
+                       args.min_fleets, args.player_strength, args.l2,
+                       args.bootstrap, args.workers, args.seed, args.cache)
+    names = fleet_lists.get_names(conn)
+    conn.close()
+
+    table = model.table()
+    print(f'{model.num_games} games, {len(table)} components'
+          + (f', strength {model.strength_coef:+.3f} per TP'
+             if model.strength else ''))
+    print('Largest positive effects (log-odds of winning):')
+    for row in table[:args.top]:
+        print(row_text(row, names))
+    print('Largest negative effects:')
+    for row in table[-args.top:]:
+        print(row_text(row, names))
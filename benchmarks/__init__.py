@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks
+
+Reproducible timing scenarios for the scraper, fleet resolution, view building
+and csv export, run against synthetic events made by the generator module.
+Run with:
+    python -m benchmarks -o bench.json
+
+@author: alexe
+"""
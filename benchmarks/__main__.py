@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark runner
+
+Generate a synthetic workload, run the timed scenarios and write the results
+to a JSON file. Passing --compare with the results of an earlier run prints
+the change per scenario and exits with an error if any scenario got slower
+than the allowed threshold, so regressions show up between versions.
+
+@author: alexe
+"""
+import argparse
+import json
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from benchmarks.scenarios import scenarios, Workspace
+
+def git_revision():
+    try:
+        res = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             capture_output=True, text=True, check=True)
+        return res.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Time repeat runs of a scenario. Scenarios may return a dictionary of extra
+# metrics (request counts etc.), the ones from the last run are kept.
+def run_scenario(func, ws, repeat):
+    times = []
+    metrics = None
+    for _ in range(repeat):
+        run = func(ws)
+        t0 = time.perf_counter()
+        metrics = run()
+        times.append(time.perf_counter() - t0)
+    res = {'times_s': [round(t, 6) for t in times],
+           'min_s': round(min(times), 6),
+           'median_s': round(statistics.median(times), 6),
+           'mean_s': round(statistics.mean(times), 6)}
+    if metrics:
+        res['metrics'] = metrics
+    return res
+
+# Compare medians against an earlier results file. Returns the names of the
+# scenarios that regressed by more than threshold (as a fraction).
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, res in results['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(name)
+        if not old or 'median_s' not in old or 'median_s' not in res:
+            continue
+        ratio = res['median_s'] / old['median_s'] if old['median_s'] else 1.
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  <-- regression'
+        print(f'{name:20s} {old["median_s"]:10.4f}s -> '
+              f'{res["median_s"]:10.4f}s  ({ratio:5.2f}x){flag}')
+    return regressions
+
+def add_arguments(parser):
+    parser.add_argument("--db", type=str, default='data/armada_events.sql',
+                        help="DB to copy the fleet component catalog from")
+    parser.add_argument("-p", "--players", type=int, default=64)
+    parser.add_argument("-r", "--rounds", type=int, default=6)
+    parser.add_argument("-e", "--events", type=int, default=1)
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of timed runs per scenario")
+    parser.add_argument("-k", "--only", type=str, nargs='+',
+                        choices=sorted(scenarios),
+                        help="run only these scenarios")
+    parser.add_argument("-o", "--output", type=str,
+                        default='bench_output.json',
+                        help="file to write results to")
+    parser.add_argument("--compare", type=str, metavar="BASELINE",
+                        help="results file of an earlier run to compare to")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown (fraction of baseline median) that"
+                        + " counts as a regression")
+
+def main(args):
+    ws = Workspace(args.db, args.players, args.rounds, args.events,
+                   args.seed)
+    results = {
+        'meta': {'git_revision': git_revision(),
+                 'python': platform.python_version(),
+                 'sqlite': sqlite3.sqlite_version,
+                 'platform': platform.platform(),
+                 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'players': args.players, 'rounds': args.rounds,
+                 'events': args.events, 'seed': args.seed,
+                 'repeat': args.repeat},
+        'scenarios': {},
+        }
+    try:
+        for name, func in scenarios.items():
+            if args.only and name not in args.only:
+                continue
+            try:
+                res = run_scenario(func, ws, args.repeat)
+            except ImportError as e:
+                print(f'{name:20s} skipped ({e})')
+                results['scenarios'][name] = {'skipped': str(e)}
+                continue
+            print(f'{name:20s} median {res["median_s"]:.4f}s')
+            results['scenarios'][name] = res
+    finally:
+        ws.cleanup()
+
+    with open(args.output, 'w') as f:
+        f.write(json.dumps(results, indent=2))
+    print(f'Results written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="benchmarks",
+        description="run timing benchmarks on synthetic Armada events")
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Generator
+
+Make synthetic, but schema-valid, tournament data for benchmarking. The fleet
+component tables (ships, upgrades, squadrons, names, slots and factions) are
+copied from the real database so that generated fleets resolve against the
+same catalog as real ones. Players, fleets and results are random, seeded so
+that the same parameters always give the same data.
+
+Two outputs are available for each generated event:
+    - rows inserted directly into a copy of the DB (Events, Fleets, Fleets_*
+      and Scores), for benchmarking the views and exports
+    - an HTML page laid out like a T4.tools event page, with a rounds tab and
+      a lists tab, for benchmarking scraping and ingest. The raw text of each
+      fleet list is also returned so a stub LLM can answer with the expected
+      fleet dictionary.
+
+@author: alexe
+"""
+import html
+import random
+import sqlite3
+import migrations
+
+# Fleet building limits used when generating lists
+MAX_POINTS = 400
+MAX_SQUADRON_POINTS = 134
+
+# Tables that hold fleet components. Everything else is event data and is
+# emptied when copying the catalog.
+catalog_tables = ['Factions', 'Ships', 'Squadrons', 'UpgradeSlots',
+                  'Upgrades', 'Upgrades_Factions', 'Ships_UpgradeSlots',
+                  'ShipNames', 'UpgradeNames', 'SquadronNames']
+event_tables = ['Fleets_Upgrades', 'Fleets_Squadrons', 'Fleets_Ships',
+                'Fleets', 'Scores', 'Events']
+
+first_names = ['Alex', 'Ben', 'Chris', 'Dana', 'Eli', 'Fran', 'Gabe',
+               'Hana', 'Ivan', 'Jo', 'Kai', 'Lee', 'Mara', 'Nico', 'Owen',
+               'Pia', 'Quinn', 'Ray', 'Sam', 'Tess', 'Uma', 'Vic', 'Wes',
+               'Xia', 'Yuri', 'Zoe']
+last_names = ['Antilles', 'Bel Iblis', 'Calrissian', 'Dodonna', 'Erso',
+              'Fel', 'Grint', 'Holdo', 'Iblis', 'Jerjerrod', 'Kenobi',
+              'Lothal', 'Madine', 'Needa', 'Ozzel', 'Piett', 'Raddus',
+              'Sloane', 'Tarkin', 'Ugnaught', 'Veers', 'Wedge', 'Yularen',
+              'Zeb']
+
+# Fleet components for fast random selection, read once from the catalog
+class Catalog:
+    def __init__(self, conn):
+        cursor = conn.cursor()
+        self.factions = {fid: name for fid, name in cursor.execute(
+            'SELECT id, name FROM Factions')}
+
+        # One display name per component. Lists exported from fleet builders
+        # use a consistent name, so pick the same alias every time.
+        def names(query):
+            res = {}
+            for obj_id, name in cursor.execute(query):
+                res.setdefault(obj_id, name)
+            return res
+        ship_names = names('SELECT ship_id, name FROM ShipNames '
+                           'ORDER BY ship_id, name DESC')
+        upgrade_names = names('SELECT upgrade_id, name FROM UpgradeNames '
+                              'ORDER BY upgrade_id, name')
+        squad_names = names('SELECT squadron_id, name FROM SquadronNames '
+                            'ORDER BY squadron_id, name DESC')
+
+        slots = {}
+        for ship_id, slot_id in cursor.execute(
+                'SELECT ship_id, slot_id FROM Ships_UpgradeSlots'):
+            slots.setdefault(ship_id, []).append(slot_id)
+
+        self.ships = {fid: [] for fid in self.factions}
+        for ship_id, faction_id, cost in cursor.execute(
+                'SELECT id, faction_id, cost FROM Ships'):
+            if ship_id in ship_names:
+                self.ships[faction_id].append(
+                    {'id': ship_id, 'name': ship_names[ship_id],
+                     'cost': cost, 'slots': slots.get(ship_id, [])})
+
+        # upgrades[faction_id][slot_id] = list of upgrades
+        self.upgrades = {fid: {} for fid in self.factions}
+        for upgrade_id, faction_id, cost, slot_id, uniq in cursor.execute(
+                '''SELECT u.id, f.faction_id, u.cost, u.slot_id, u.uniq
+                FROM Upgrades AS u
+                INNER JOIN Upgrades_Factions AS f ON f.upgrade_id = u.id'''):
+            if upgrade_id in upgrade_names:
+                self.upgrades[faction_id].setdefault(slot_id, []).append(
+                    {'id': upgrade_id, 'name': upgrade_names[upgrade_id],
+                     'cost': cost, 'uniq': uniq})
+
+        self.squadrons = {fid: [] for fid in self.factions}
+        for squad_id, faction_id, cost, uniq in cursor.execute(
+                'SELECT id, faction_id, cost, uniq FROM Squadrons'):
+            if squad_id in squad_names:
+                self.squadrons[faction_id].append(
+                    {'id': squad_id, 'name': squad_names[squad_id],
+                     'cost': cost, 'uniq': uniq})
+
+# Make a random but legal-looking fleet for the given faction. The result is
+# in the same format as fleet_parser output, with the expected component IDs
+# already filled in.
+def generate_fleet(rng, catalog, faction_id):
+    upgrades = catalog.upgrades[faction_id]
+    ships = catalog.ships[faction_id]
+    squadrons = catalog.squadrons[faction_id]
+    used_uniques = set()
+    points = 0
+
+    fleet = {'faction': catalog.factions[faction_id],
+             'faction_id': faction_id,
+             'ships': [], 'squadrons': []}
+
+    num_ships = rng.randint(2, 5)
+    for iis in range(num_ships):
+        candidates = [s for s in ships
+                      if points + s['cost'] <= MAX_POINTS - 30]
+        if not candidates:
+            break
+        ship = rng.choice(candidates)
+        points += ship['cost']
+        entry = {'name': ship['name'], 'id': ship['id'],
+                 'base_cost': ship['cost'], 'upgrades': []}
+        for slot_id in ship['slots']:
+            # The first ship is the flagship and always gets a commander,
+            # other slots are filled about half the time.
+            is_commander = slot_id == 1
+            if is_commander and iis > 0:
+                continue
+            if not is_commander and rng.random() < 0.5:
+                continue
+            options = [u for u in upgrades.get(slot_id, [])
+                       if ('upgrade', u['id']) not in used_uniques
+                       and points + u['cost'] <= MAX_POINTS]
+            if not options:
+                continue
+            upgrade = rng.choice(options)
+            if upgrade['uniq']:
+                used_uniques.add(('upgrade', upgrade['id']))
+            points += upgrade['cost']
+            entry['upgrades'].append({'name': upgrade['name'],
+                                      'id': upgrade['id'],
+                                      'cost': upgrade['cost']})
+            if is_commander:
+                fleet['commander'] = upgrade['name']
+        entry['total_cost'] = entry['base_cost'] \
+            + sum(u['cost'] for u in entry['upgrades'])
+        fleet['ships'].append(entry)
+
+    squad_points = 0
+    budget = min(MAX_SQUADRON_POINTS, MAX_POINTS - points)
+    for _ in range(rng.randint(0, 8)):
+        options = [q for q in squadrons
+                   if squad_points + q['cost'] <= budget
+                   and ('squadron', q['id']) not in used_uniques]
+        if not options:
+            break
+        squad = rng.choice(options)
+        squad_points += squad['cost']
+        if squad['uniq']:
+            used_uniques.add(('squadron', squad['id']))
+            count = 1
+        else:
+            count = 1
+            while rng.random() < 0.4 and \
+                    squad_points + squad['cost'] <= budget:
+                count += 1
+                squad_points += squad['cost']
+        fleet['squadrons'].append({'name': squad['name'], 'id': squad['id'],
+                                   'cost': squad['cost'], 'count': count})
+    return fleet
+
+# Write a fleet as free text, in the style of a fleet builder export. This is
+# what players paste into T4 and what the LLM is asked to parse.
+def fleet_text(fleet, player):
+    lines = [f'Name: {player}',
+             f'Faction: {fleet["faction"]}']
+    if fleet.get('commander'):
+        lines.append(f'Commander: {fleet["commander"]}')
+    lines.append('')
+    for ship in fleet['ships']:
+        lines.append(f'{ship["name"]} ({ship["base_cost"]})')
+        for upgrade in ship['upgrades']:
+            lines.append(f'• {upgrade["name"]} ({upgrade["cost"]})')
+        lines.append(f'= {ship["total_cost"]} Points')
+        lines.append('')
+    if fleet['squadrons']:
+        lines.append('Squadrons:')
+        for squad in fleet['squadrons']:
+            lines.append(f'• {squad["count"]} x {squad["name"]} '
+                         f'({squad["count"] * squad["cost"]})')
+    return '\n'.join(lines)
+
+def player_names(rng, num_players):
+    names = set()
+    while len(names) < num_players:
+        names.add(f'{rng.choice(first_names)} {rng.choice(last_names)}'
+                  + ('' if rng.random() < 0.7 else f' {rng.randint(1, 99)}'))
+    return sorted(names)
+
+# Tournament points on the 1-10 scale from margin of victory. Winner and loser
+# TP always add up to 11.
+def tournament_points(mov):
+    brackets = [(60, 6), (140, 7), (220, 8), (300, 9)]
+    for limit, tp in brackets:
+        if mov < limit:
+            return tp
+    return 10
+
+# Swiss-ish pairings: sort by TP so far, pair neighbours, give a bye to the
+# last player if numbers are odd. Returns rows in the Scores table layout,
+# without event_id: (round, player, points, tp, opponent).
+def generate_rounds(rng, players, num_rounds):
+    totals = {p: 0 for p in players}
+    rounds = []
+    for rnd in range(1, num_rounds+1):
+        order = sorted(players, key=lambda p: (-totals[p], rng.random()))
+        games = []
+        if len(order) % 2:
+            bye = order.pop()
+            games.append((bye, None, 140, 0))
+        for ii in range(0, len(order), 2):
+            playerA, playerB = order[ii], order[ii+1]
+            ptsA = rng.randint(0, 400)
+            ptsB = rng.randint(0, 400)
+            games.append((playerA, playerB, ptsA, ptsB))
+
+        rows = []
+        for playerA, playerB, ptsA, ptsB in games:
+            if playerB is None:
+                rows.append((rnd, playerA, 140, 8, None))
+                totals[playerA] += 8
+                continue
+            # Second player wins ties
+            tp_win = tournament_points(abs(ptsA - ptsB))
+            tpA = tp_win if ptsA > ptsB else 11 - tp_win
+            rows.append((rnd, playerA, ptsA, tpA, playerB))
+            rows.append((rnd, playerB, ptsB, 11 - tpA, playerA))
+            totals[playerA] += tpA
+            totals[playerB] += 11 - tpA
+        rounds.append(rows)
+    return rounds
+
+# Generate one event: player names, one fleet per player and round results.
+def generate_event(rng, catalog, num_players, num_rounds, name):
+    players = player_names(rng, num_players)
+    faction_ids = sorted(catalog.factions)
+    fleets = {}
+    for player in players:
+        fleet = generate_fleet(rng, catalog, rng.choice(faction_ids))
+        fleets[player] = {'fleet': fleet, 'text': fleet_text(fleet, player)}
+    return {'name': name,
+            'url': f'https://t4.tools/e/{name}',
+            'date': f'2025-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}',
+            'region': 'Synthetic',
+            'players': players,
+            'fleets': fleets,
+            'rounds': generate_rounds(rng, players, num_rounds)}
+
+# Copy the catalog from the real DB into a new DB at dst_path, with empty
+# event tables and no views.
+def copy_catalog(src_path, dst_path):
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(dst_path)
+    src.backup(dst)
+    src.close()
+    cursor = dst.cursor()
+    views = cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'view'").fetchall()
+    for (view,) in views:
+        cursor.execute(f'DROP VIEW {view}')
+    for table in event_tables:
+        cursor.execute(f'DELETE FROM {table}')
+    dst.commit()
+    migrations.migrate(dst)
+    cursor.execute('VACUUM')
+    return dst
+
+# Insert a generated event directly into the DB, bypassing the scraper
+def insert_event(conn, event):
+    cursor = conn.cursor()
+    cursor.execute('INSERT INTO Events (name, url, date, region) '
+                   'VALUES (?, ?, ?, ?)',
+                   (event['name'], event['url'], event['date'],
+                    event['region']))
+    ev_id = cursor.lastrowid
+    for player in event['players']:
+        fleet = event['fleets'][player]['fleet']
+        cursor.execute('INSERT INTO Fleets (player, event_id, faction_id) '
+                       'VALUES (?, ?, ?)', (player, ev_id, fleet['faction_id']))
+        fleet_id = cursor.lastrowid
+        for ship in fleet['ships']:
+            cursor.execute('INSERT INTO Fleets_Ships (fleet_id, ship_id) '
+                           'VALUES (?, ?)', (fleet_id, ship['id']))
+            fleet_ship_id = cursor.lastrowid
+            cursor.executemany('INSERT INTO Fleets_Upgrades '
+                               '(upgrade_id, fleet_ship_id) VALUES (?, ?)',
+                               [(u['id'], fleet_ship_id)
+                                for u in ship['upgrades']])
+        cursor.executemany('INSERT INTO Fleets_Squadrons '
+                           '(fleet_id, squadron_id, count) VALUES (?, ?, ?)',
+                           [(fleet_id, q['id'], q['count'])
+                            for q in fleet['squadrons']])
+    cursor.executemany('INSERT INTO Scores VALUES (?, ?, ?, ?, ?, ?)',
+                       [(ev_id,) + row
+                        for rows in event['rounds'] for row in rows])
+    conn.commit()
+    return ev_id
+
+# Make a copy of the real DB at dst_path holding num_events synthetic events
+def generate_database(src_path, dst_path, num_players=64, num_rounds=6,
+                      num_events=1, seed=0):
+    rng = random.Random(seed)
+    conn = copy_catalog(src_path, dst_path)
+    catalog = Catalog(conn)
+    events = []
+    for ii in range(num_events):
+        event = generate_event(rng, catalog, num_players, num_rounds,
+                               f'SYNTHETIC_{seed}_{ii+1}')
+        insert_event(conn, event)
+        events.append(event)
+    conn.close()
+    return events
+
+# Lay the event out like a T4.tools event page, using the same element ids
+# and classes that event_to_file looks for.
+def event_html(event):
+    esc = html.escape
+    out = ['<html><head><title>', esc(event['name']), '</title></head><body>']
+    year, mon, day = event['date'].split('-')
+    month = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+             'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'][int(mon)-1]
+    out.append('<div class="pt-3 small row">'
+               f'<div class="col"><i class="bi bi-calendar3"></i> '
+               f'Sat {day} {month}, {year}</div>'
+               f'<div class="col"><i class="bi bi-globe"></i> '
+               f'{esc(event["region"])}</div></div>')
+
+    out.append('<div id="uncontrolled-tab-example-tabpane-rounds">')
+    for rows in event['rounds']:
+        out.append('<div role="tabpanel">')
+        seen = set()
+        for rnd, player, points, tp, opponent in rows:
+            if player in seen:
+                continue
+            seen.update([player, opponent])
+            if opponent is None:
+                spans = [player, '', '', 'Bye']
+            else:
+                opp = next(r for r in rows if r[1] == opponent)
+                spans = [player, points, tp, opponent, opp[2], opp[3]]
+            out.append('<div class="col-11">'
+                       + ''.join(f'<span>{esc(str(s))}</span>'
+                                 for s in spans)
+                       + '</div>')
+        out.append('</div>')
+    out.append('</div>')
+
+    # No whitespace between list entries, event_to_file walks the children
+    # of the lists tab directly.
+    out.append('<div id="uncontrolled-tab-example-tabpane-lists">')
+    for player in event['players']:
+        text = event['fleets'][player]['text']
+        out.append('<div class="card">'
+                   f'<div><span><span>{esc(player)}</span></span></div>'
+                   f'<div><pre>{esc(text)}</pre></div>'
+                   '</div>')
+    out.append('</div></body></html>')
+    return ''.join(out)
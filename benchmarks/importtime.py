@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Import time
+
+Startup cost of the command line tools, measured with python -X importtime.
+Each armada.py subcommand is run with --help in a fresh interpreter, so only
+the imports needed to build its parser are made, and the import times
+reported by the interpreter are added up. Modules that a subcommand should
+not load at startup (the LLM parser and SDKs, browser automation, pandas)
+are listed if they show up.
+
+    python -m benchmarks.importtime
+    python -m benchmarks.importtime views scrape --top 10
+
+The import_time benchmark scenario records the same figures.
+
+@author: alexe
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules no subcommand should need just to start
+heavy_modules = ['fleet_parser', 'google.genai', 'huggingface_hub',
+                 'llama_cpp', 'selenium', 'bs4', 'pandas']
+
+# Imports made by running command (a list of arguments to armada.py) with
+# -X importtime: {module: (self us, cumulative us)}
+def import_times(command):
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime',
+         os.path.join(ROOT, 'armada.py')] + command,
+        cwd=ROOT, capture_output=True, text=True)
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            # Header line
+            continue
+        times[fields[2].strip()] = (self_us, cumulative_us)
+    return times
+
+# Total import time (ms), number of modules and heavy modules loaded by a
+# subcommand
+def command_startup(name):
+    times = import_times([name, '--help'])
+    return {'import_ms': round(sum(t[0] for t in times.values()) / 1000, 2),
+            'modules': len(times),
+            'heavy': [m for m in heavy_modules if m in times]}
+
+if __name__ == '__main__':
+    import armada
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.importtime",
+        description="measure the import time of armada.py subcommands")
+    parser.add_argument("commands", type=str, nargs='*',
+                        help="subcommands to measure (default: all of "
+                        + ", ".join(armada.commands) + ")")
+    parser.add_argument("--top", type=int, default=0,
+                        help="also list the slowest imports of each")
+    args = parser.parse_args()
+    unknown = [name for name in args.commands if name not in armada.commands]
+    if unknown:
+        parser.error(f'unknown subcommands: {", ".join(unknown)}')
+
+    for name in args.commands or armada.commands:
+        res = command_startup(name)
+        print(f'{name:8s} {res["import_ms"]:8.1f} ms, {res["modules"]}'
+              + ' modules' + (f', loads {", ".join(res["heavy"])}'
+                              if res['heavy'] else ''))
+        if args.top:
+            times = import_times([name, '--help'])
+            for module, (_, cumulative) in sorted(
+                    times.items(), key=lambda t: -t[1][1])[:args.top]:
+                print(f'    {cumulative / 1000:8.1f} ms  {module}')
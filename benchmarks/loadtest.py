@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Load test
+
+HTTP load generator for query_service. A number of concurrent clients, each
+on its own keep-alive connection, send GET requests for a list of paths in
+turn until the total number of requests has been made, and the throughput
+and latency percentiles are reported. With --conditional, clients send back
+the ETag they got for a path, like a polling dashboard, so unchanged results
+come back as 304.
+
+Against a running service:
+    python -m benchmarks.loadtest http://127.0.0.1:8080 -n 20000 -c 32
+
+Without a URL a service is started in-process on --db.
+
+@author: alexe
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+# Mix of requests a dashboard makes: summary tables, filtered lists, single
+# fleets and matchups
+default_paths = [
+    '/events',
+    '/fleets?limit=100',
+    '/fleets?event_id=1',
+    '/popularity/ships',
+    '/popularity/squadrons',
+    '/popularity/upgrades?slot=Commander',
+    '/matchups',
+    '/matchups?by=commander',
+    '/fleets/1',
+    '/fleets/2',
+    '/lists?event_id=1',
+    ]
+
+async def read_response(reader):
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length:
+        await reader.readexactly(length)
+    return status, headers
+
+async def client(host, port, paths, count, offset, conditional, latencies,
+                 statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+    etags = {}
+    try:
+        for ii in range(count):
+            path = paths[(offset + ii) % len(paths)]
+            request = f'GET {path} HTTP/1.1\r\nHost: {host}\r\n'
+            if conditional and path in etags:
+                request += f'If-None-Match: {etags[path]}\r\n'
+            t0 = time.perf_counter()
+            writer.write((request + '\r\n').encode('latin-1'))
+            status, headers = await read_response(reader)
+            latencies.append(time.perf_counter() - t0)
+            statuses[status] = statuses.get(status, 0) + 1
+            if 'etag' in headers:
+                etags[path] = headers['etag']
+    finally:
+        writer.close()
+
+# Send requests total requests from concurrency clients. Returns the
+# throughput, latency percentiles (ms) and count of each response status.
+async def run_load(url, requests=10000, concurrency=16, paths=None,
+                   conditional=False):
+    parts = urlsplit(url)
+    paths = paths or default_paths
+    latencies = []
+    statuses = {}
+    counts = [requests // concurrency + (ii < requests % concurrency)
+              for ii in range(concurrency)]
+    t0 = time.perf_counter()
+    await asyncio.gather(*[
+        client(parts.hostname, parts.port, paths, count, ii, conditional,
+               latencies, statuses)
+        for ii, count in enumerate(counts) if count])
+    elapsed = time.perf_counter() - t0
+    latencies.sort()
+    def percentile(p):
+        return round(1000 * latencies[min(len(latencies) - 1,
+                                          int(p * len(latencies)))], 3)
+    return {'requests': len(latencies),
+            'concurrency': concurrency,
+            'elapsed_s': round(elapsed, 4),
+            'requests_per_s': round(len(latencies) / elapsed, 1),
+            'latency_ms_p50': percentile(0.5),
+            'latency_ms_p99': percentile(0.99),
+            'latency_ms_mean': round(1000 * statistics.mean(latencies), 3),
+            'statuses': {str(k): v for k, v in sorted(statuses.items())}}
+
+def load_test(url, **kwargs):
+    return asyncio.run(run_load(url, **kwargs))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.loadtest",
+        description="measure requests per second of query_service")
+    parser.add_argument("url", type=str, nargs='?',
+                        help="service to test (default: start one on --db)")
+    parser.add_argument("--db", type=str, default='data/armada_events.sql')
+    parser.add_argument("-n", "--requests", type=int, default=10000)
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("--conditional", action='store_true',
+                        help="send If-None-Match with the last ETag")
+    parser.add_argument("--path", type=str, nargs='+', dest='paths',
+                        help="paths to request (default: a dashboard mix)")
+    args = parser.parse_args()
+
+    kwargs = {'requests': args.requests, 'concurrency': args.concurrency,
+              'paths': args.paths, 'conditional': args.conditional}
+    if args.url:
+        res = load_test(args.url, **kwargs)
+    else:
+        import query_service
+        with query_service.ServiceThread(args.db) as service:
+            res = load_test(service.url, **kwargs)
+    for key, value in res.items():
+        print(f'{key:20s} {value}')
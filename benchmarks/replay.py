@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Replay server
+
+Local HTTP server that plays back a sequence of event page snapshots, for
+testing and timing event_watch offline. Every request gets the current
+snapshot with an ETag and Last-Modified header, and conditional requests for
+an unchanged snapshot get 304 Not Modified, like a well behaved web server.
+The next snapshot is served after advance() is called, or automatically
+every requests_per_snapshot requests.
+
+snapshots() turns a generated event into the pages seen while it is played:
+the fleet lists and no results, then one more round of results per page.
+
+Usage:
+    python -m benchmarks.replay -p 32 -r 4 --port 8765
+
+@author: alexe
+"""
+import argparse
+import copy
+import hashlib
+import random
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from benchmarks import generator
+
+# Pages for an event as it is played, one more round of results each
+def snapshots(event):
+    res = []
+    for num_rounds in range(len(event['rounds']) + 1):
+        ev = copy.deepcopy(event)
+        ev['rounds'] = ev['rounds'][:num_rounds]
+        res.append(generator.event_html(ev))
+    return res
+
+class ReplayServer:
+    def __init__(self, pages, port=0, requests_per_snapshot=None):
+        self.pages = [page.encode('utf-8') for page in pages]
+        self.requests_per_snapshot = requests_per_snapshot
+        self.index = 0
+        self.requests = 0
+        self.not_modified = 0
+        self._lock = threading.Lock()
+        self._stamp()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port),
+                                         self._handler())
+        self.port = self.httpd.server_address[1]
+        self.url = f'http://127.0.0.1:{self.port}/event'
+        self._thread = None
+
+    def _stamp(self):
+        page = self.pages[self.index]
+        self.etag = '"' + hashlib.sha1(page).hexdigest() + '"'
+        self.last_modified = formatdate(time.time(), usegmt=True)
+
+    def advance(self):
+        with self._lock:
+            if self.index + 1 < len(self.pages):
+                self.index += 1
+                self._stamp()
+            return self.index
+
+    @property
+    def finished(self):
+        return self.index == len(self.pages) - 1
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                    page, etag = server.pages[server.index], server.etag
+                    last_modified = server.last_modified
+                    auto = server.requests_per_snapshot
+                    if auto and server.requests % auto == 0 \
+                            and server.index + 1 < len(server.pages):
+                        server.index += 1
+                        server._stamp()
+                if self.headers.get('If-None-Match') == etag:
+                    with server._lock:
+                        server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(page)))
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                self.wfile.write(page)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.replay",
+        description="serve a generated event round by round")
+    parser.add_argument("--db", type=str, default='data/armada_events.sql',
+                        help="DB to copy the fleet component catalog from")
+    parser.add_argument("-p", "--players", type=int, default=32)
+    parser.add_argument("-r", "--rounds", type=int, default=4)
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--every", type=int, default=3,
+                        help="requests per snapshot before moving to the"
+                        + " next round")
+    args = parser.parse_args()
+
+    import sqlite3
+    conn = sqlite3.connect(args.db)
+    event = generator.generate_event(random.Random(args.seed),
+                                     generator.Catalog(conn), args.players,
+                                     args.rounds, f'REPLAY_{args.seed}')
+    conn.close()
+    server = ReplayServer(snapshots(event), port=args.port,
+                          requests_per_snapshot=args.every)
+    print(f'Serving {len(server.pages)} snapshots at {server.url}')
+    server.httpd.serve_forever()
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+Scenarios
+
+Timed benchmark scenarios. Each scenario is a function that takes the shared
+Workspace, does any setup that should not be timed (fresh DB copies, parsing
+input, etc.) and returns a callable that runs the timed part. Scenarios are
+registered with the scenario decorator and run in registration order.
+
+Scenarios that need an optional package (bs4, pandas, LLM SDKs pulled in by
+fleet_parser) import it inside setup; the runner reports them as skipped if
+the import fails.
+
+@author: alexe
+"""
+import builtins
+import copy
+import os
+import shutil
+import tempfile
+import db
+from benchmarks import generator
+from benchmarks.stubs import StubParser, StubGeminiClient, as_llm_output
+
+scenarios = {}
+
+def scenario(name):
+    def register(func):
+        scenarios[name] = func
+        return func
+    return register
+
+# Generated inputs shared by all scenarios: a catalog-only DB, a DB with all
+# generated events inserted, and the T4-style page for each event.
+class Workspace:
+    def __init__(self, src_path, num_players, num_rounds, num_events, seed,
+                 root=None):
+        self.root = root or tempfile.mkdtemp(prefix='armada_bench_')
+        self.catalog_path = os.path.join(self.root, 'catalog.sql')
+        self.events_path = os.path.join(self.root, 'events.sql')
+
+        conn = generator.copy_catalog(src_path, self.catalog_path)
+        conn.close()
+        self.events = generator.generate_database(
+            src_path, self.events_path, num_players=num_players,
+            num_rounds=num_rounds, num_events=num_events, seed=seed)
+        self.pages = [generator.event_html(ev) for ev in self.events]
+        self._copies = 0
+
+    # Fresh copy of one of the template DBs, so that write scenarios always
+    # start from the same state.
+    def copy_db(self, template):
+        self._copies += 1
+        path = os.path.join(self.root, f'run_{self._copies}.sql')
+        shutil.copyfile(template, path)
+        return path
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+# Fail loudly if name resolution falls back to prompting the user, rather
+# than hanging the benchmark.
+def no_input(prompt=''):
+    raise RuntimeError(f'benchmark asked for user input: {prompt}')
+
+def add_event(conn, event):
+    cursor = conn.cursor()
+    cursor.execute('INSERT INTO Events (name, url, date, region) '
+                   'VALUES (?, ?, ?, ?)',
+                   (event['name'], event['url'], event['date'],
+                    event['region']))
+    conn.commit()
+    return cursor.lastrowid
+
+def parse_pages(pages):
+    from bs4 import BeautifulSoup
+    return [BeautifulSoup(page, 'html5lib') for page in pages]
+
+@scenario('html_parse')
+def html_parse(ws):
+    from bs4 import BeautifulSoup
+    def run():
+        parse_pages(ws.pages)
+    return run
+
+@scenario('scores')
+def scores(ws):
+    import event_to_file
+    soups = parse_pages(ws.pages)
+    conn = db.connect(ws.copy_db(ws.catalog_path))
+    ev_ids = [add_event(conn, ev) for ev in ws.events]
+    rounds = [soup.find(id='uncontrolled-tab-example-tabpane-rounds')
+              for soup in soups]
+    def run():
+        for rnd, ev_id in zip(rounds, ev_ids):
+            event_to_file.get_scores(rnd, conn, ev_id)
+        conn.close()
+    return run
+
+# Full fleet ingest from the lists tab: stub LLM, name resolution, insertion
+@scenario('fleet_ingest')
+def fleet_ingest(ws):
+    import event_to_file
+    import fleet_parser
+    soups = parse_pages(ws.pages)
+    conn = db.connect(ws.copy_db(ws.catalog_path))
+    ev_ids = [add_event(conn, ev) for ev in ws.events]
+    lists = [soup.find(id='uncontrolled-tab-example-tabpane-lists')
+             for soup in soups]
+    stub = StubParser(ws.events)
+    def parse_fleets(fleets, **kwargs):
+        return [stub(fleet) for fleet in fleets]
+    def run():
+        orig = (fleet_parser.parse_fleet, fleet_parser.parse_fleets,
+                builtins.input)
+        fleet_parser.parse_fleet = stub
+        fleet_parser.parse_fleets = parse_fleets
+        builtins.input = no_input
+        try:
+            for fleets, ev_id in zip(lists, ev_ids):
+                event_to_file.get_fleet_lists(fleets, conn, ev_id)
+        finally:
+            (fleet_parser.parse_fleet, fleet_parser.parse_fleets,
+             builtins.input) = orig
+            conn.close()
+    return run
+
+# Re-sync events that are already in the DB after one fleet list and one
+# result changed on each page. Only the changed rows should be re-parsed.
+@scenario('event_resync')
+def event_resync(ws):
+    import event_sync
+    import fleet_parser
+    from bs4 import BeautifulSoup
+    path = ws.copy_db(ws.catalog_path)
+    stub = StubParser(ws.events)
+    def parse_fleets(fleets, **kwargs):
+        return [stub(fleet) for fleet in fleets]
+    def sync_all(pages):
+        orig = (fleet_parser.parse_fleet, fleet_parser.parse_fleets,
+                builtins.input)
+        fleet_parser.parse_fleet = stub
+        fleet_parser.parse_fleets = parse_fleets
+        builtins.input = no_input
+        try:
+            for soup, ev in zip(pages, ws.events):
+                event_sync.sync_site(soup, ev['url'], ev['name'],
+                                     sql_path=path)
+        finally:
+            (fleet_parser.parse_fleet, fleet_parser.parse_fleets,
+             builtins.input) = orig
+    sync_all(parse_pages(ws.pages))
+
+    changed = []
+    for ev in ws.events:
+        ev = copy.deepcopy(ev)
+        players = ev['players']
+        ev['fleets'][players[0]] = ev['fleets'][players[1]]
+        rows = ev['rounds'][-1]
+        rows[0] = rows[0][:2] + (rows[0][2] + 1,) + rows[0][3:]
+        changed.append(generator.event_html(ev))
+    pages = parse_pages(changed)
+    def run():
+        calls = stub.calls
+        sync_all(pages)
+        db.close_connection(path)
+        return {'fleets_parsed': stub.calls - calls}
+    return run
+
+# Resolve component names to IDs for every generated fleet
+@scenario('name_resolution')
+def name_resolution(ws):
+    import event_to_file
+    conn = db.connect(ws.copy_db(ws.catalog_path))
+    fleets = [as_llm_output(entry['fleet'])
+              for ev in ws.events for entry in ev['fleets'].values()]
+    def run():
+        orig_input = builtins.input
+        builtins.input = no_input
+        cursor = conn.cursor()
+        try:
+            for fleet in fleets:
+                event_to_file.apply_fleet_cleaning(cursor, copy.deepcopy(fleet))
+        finally:
+            builtins.input = orig_input
+            conn.close()
+    return run
+
+# Insert already resolved fleets
+@scenario('fleet_insertion')
+def fleet_insertion(ws):
+    import event_to_file
+    conn = db.connect(ws.copy_db(ws.catalog_path))
+    work = []
+    for ev in ws.events:
+        ev_id = add_event(conn, ev)
+        work += [(ev_id, player, entry['fleet'])
+                 for player, entry in ev['fleets'].items()]
+    def run():
+        for ev_id, player, fleet in work:
+            event_to_file.insert_fleet(conn, fleet, player, ev_id)
+        conn.close()
+    return run
+
+# Create the summary views and pull every row out of them
+@scenario('make_views')
+def make_views(ws):
+    import make_views as mv
+    conn = db.connect(ws.copy_db(ws.events_path))
+    def run():
+        mv.build_views(conn, force=True)
+        for name, _, _ in mv.views:
+            conn.execute(f'SELECT * FROM {name}').fetchall()
+        conn.close()
+    return run
+
+# Rebuild every fleet list in the DB, all at once with fleet_lists and then
+# one fleet at a time with sql_queries.get_fleet_list
+@scenario('fleet_lists')
+def fleet_lists(ws):
+    import fleet_lists as fl
+    conn = db.connect(ws.events_path)
+    def run():
+        fleets = fl.get_fleets(conn)
+        conn.close()
+        return {'fleets': len(fleets)}
+    return run
+
+@scenario('fleet_lists_single')
+def fleet_lists_single(ws):
+    import sql_queries
+    conn = db.connect(ws.events_path)
+    ids = [row[0] for row in conn.execute('SELECT id FROM Fleets')]
+    def run():
+        for fleet_id in ids:
+            conn.execute(sql_queries.get_fleet_list,
+                         (fleet_id,) * 3).fetchall()
+        conn.close()
+        return {'fleets': len(ids)}
+    return run
+
+# Pack every fleet into a compact archive, write it to bytes and read it
+# back, then count the fleets using each upgrade and group identical lists
+@scenario('compact_fleet')
+def compact_fleet(ws):
+    import compact_fleet as cf
+    conn = db.connect(ws.events_path)
+    def run():
+        archive = cf.FleetArchive.from_db(conn)
+        conn.close()
+        data = archive.to_bytes()
+        archive = cf.FleetArchive.from_bytes(data)
+        archive.popularity('upgrade')
+        return {'fleets': len(archive), 'bytes': len(data),
+                'lists': len(archive.dedupe())}
+    return run
+
+# Mine frequent component combinations and rules over every fleet (one
+# worker, so the figure does not depend on the number of CPUs)
+@scenario('cooccurrence')
+def cooccurrence(ws):
+    import cooccurrence as co
+    conn = db.connect(ws.events_path)
+    def run():
+        miner = co.Miner(min_support=0.02, max_size=3, workers=1)
+        miner.update(conn)
+        conn.close()
+        return {'fleets': miner.num_fleets,
+                'itemsets': len(miner.itemsets()),
+                'rules': len(miner.rules(0.3, 1.))}
+    return run
+
+# Fit the win attribution model on every game, with a few bootstrap
+# replicates in one process (needs numpy)
+@scenario('attribution')
+def attribution(ws):
+    import attribution as at
+    conn = db.connect(ws.events_path)
+    def run():
+        data = at.build_dataset(conn)
+        conn.close()
+        coef = at.fit(data)
+        samples = at.bootstrap_fits(data, 1., coef, 0, 5)
+        return {'games': len(data['y']), 'components': len(data['items']),
+                'replicates': len(samples)}
+    return run
+
+@scenario('csv_export')
+def csv_export(ws):
+    import make_views as mv
+    conn = db.connect(ws.copy_db(ws.events_path))
+    mv.build_views(conn, force=True)
+    out_dir = tempfile.mkdtemp(dir=ws.root)
+    def run():
+        mv.export_views(conn, out_dir=out_dir)
+        conn.close()
+    return run
+
+# Import a release of the whole catalog with every cost changed, into a DB
+# with events (baseline snapshot, new version and catalog table updates)
+@scenario('catalog_import')
+def catalog_import(ws):
+    import json
+    import catalog_import as ci
+    conn = db.connect(ws.copy_db(ws.events_path))
+    release = ci.export_catalog(conn)
+    for kind in ('ships', 'upgrades', 'squadrons'):
+        for entry in release[kind]:
+            entry['cost'] += 1
+    release.update(version='bench', effective_date='2100-01-01')
+    path = os.path.join(ws.root, 'release.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(release, f)
+    def run():
+        res = ci.import_release(conn, path)
+        conn.close()
+        return {'changed': sum(len(kind['changed'])
+                               for kind in res['diff'].values())}
+    return run
+
+# Parse every generated list through fleet_parser with a stub Gemini client,
+# one request per list, then batched. Timings include the stub's simulated
+# network and generation latency.
+def llm_parse(ws, batch_size):
+    import fleet_parser
+    import llm_backends
+    texts = [entry['text'] for ev in ws.events
+             for entry in ev['fleets'].values()]
+    client = StubGeminiClient(ws.events)
+    pool = llm_backends.BackendPool(
+        [llm_backends.GeminiBackend(client=client)])
+    def run():
+        if batch_size > 1:
+            parsed = fleet_parser.parse_fleets(texts, batch_size=batch_size,
+                                               backend=pool)
+        else:
+            parsed = [fleet_parser.parse_fleet(text, backend=pool)
+                      for text in texts]
+        return {'fleets': len(texts),
+                'failed': sum(1 for res in parsed if not res),
+                'requests': client.requests,
+                'prompt_chars': client.prompt_chars}
+    return run
+
+@scenario('llm_parse_single')
+def llm_parse_single(ws):
+    return llm_parse(ws, 1)
+
+@scenario('llm_parse_batched')
+def llm_parse_batched(ws):
+    import fleet_parser
+    return llm_parse(ws, fleet_parser.BATCH_SIZE)
+
+# Requests per second of the query service on the events DB, with a mix of
+# dashboard requests from concurrent keep-alive clients. The client runs in
+# the same process, so the figure is a lower bound for the service.
+@scenario('query_service')
+def query_service(ws):
+    import make_views as mv
+    import query_service as qs
+    from benchmarks import loadtest
+    path = ws.copy_db(ws.events_path)
+    conn = db.connect(path)
+    mv.build_views(conn, force=True)
+    conn.close()
+    def run():
+        with qs.ServiceThread(path) as service:
+            return loadtest.load_test(service.url, requests=5000,
+                                      concurrency=16)
+    return run
+
+# Startup of every armada.py subcommand (--help in a fresh interpreter). The
+# timing includes interpreter startup; the import time of each subcommand and
+# any heavy modules it loads are reported.
+@scenario('import_time')
+def import_time(ws):
+    import armada
+    from benchmarks import importtime
+    def run():
+        res = {}
+        for name in armada.commands:
+            startup = importtime.command_startup(name)
+            res[f'{name}_import_ms'] = startup['import_ms']
+            if startup['heavy']:
+                res[f'{name}_heavy'] = ','.join(startup['heavy'])
+        return res
+    return run
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Stubs
+
+Stand-ins for the LLM used in fleet parsing, so that ingest can be benchmarked
+offline and deterministically. The stubs know the fleet behind every generated
+list text and answer with it, minus the component IDs that the pipeline is
+supposed to resolve itself. StubParser replaces fleet_parser.parse_fleet
+entirely; StubGeminiClient replaces only the remote client, so the prompt
+building and response validation in fleet_parser are exercised too.
+
+@author: alexe
+"""
+import copy
+import json
+import time
+
+# Strip the answers (IDs) from a generated fleet so it looks like LLM output
+def as_llm_output(fleet):
+    res = copy.deepcopy(fleet)
+    res.pop('faction_id', None)
+    for ship in res['ships']:
+        ship.pop('id', None)
+        for upgrade in ship['upgrades']:
+            upgrade.pop('id', None)
+    for squad in res['squadrons']:
+        squad.pop('id', None)
+    return res
+
+# Drop-in replacement for fleet_parser.parse_fleet. An optional latency (in
+# seconds) can be added to each call to mimic a remote model.
+class StubParser:
+    def __init__(self, events, latency=0.):
+        self.latency = latency
+        self.calls = 0
+        self.answers = {}
+        for event in events:
+            for entry in event['fleets'].values():
+                self.answers[entry['text'].strip()] = \
+                    as_llm_output(entry['fleet'])
+
+    def __call__(self, fleet, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        res = self.answers.get(fleet.strip())
+        return copy.deepcopy(res) if res else None
+
+# Response object with the one attribute fleet_parser reads
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+# Local stand-in for the Gemini client (client.models.generate_content and
+# generate_content_stream), used to measure request batching offline. It finds
+# the fleet lists in the prompt, answers with the matching generated fleets,
+# and sleeps to mimic a remote model: a fixed latency per request plus a cost
+# per prompt and response character. Streamed responses come in chunks, with
+# the response latency spread over them, so a caller that stops reading early
+# saves time as it would with a real model. Requests and characters sent are
+# counted for reporting.
+class StubGeminiClient:
+    def __init__(self, events, request_latency=0.05, char_latency=2e-6,
+                 chunk_size=256):
+        self.parser = StubParser(events)
+        self.request_latency = request_latency
+        self.char_latency = char_latency
+        self.chunk_size = chunk_size
+        self.requests = 0
+        self.prompt_chars = 0
+        self.models = self
+
+    def _answer(self, contents, config):
+        import fleet_parser
+        self.requests += 1
+        self.prompt_chars += len(contents)
+        if config and config.get('response_schema'):
+            fleets = fleet_parser.split_batch_prompt(contents)
+            return json.dumps([{'index': index, 'fleet': self.parser(fleet)}
+                               for index, fleet in sorted(fleets.items())])
+        fleet = fleet_parser.split_prompt(contents)
+        return '```json\n' + json.dumps(self.parser(fleet)) + '\n```'
+
+    def generate_content(self, model, contents, config=None):
+        text = self._answer(contents, config)
+        time.sleep(self.request_latency
+                   + self.char_latency * (len(contents) + len(text)))
+        return StubResponse(text)
+
+    def generate_content_stream(self, model, contents, config=None):
+        text = self._answer(contents, config)
+        time.sleep(self.request_latency + self.char_latency * len(contents))
+        for ii in range(0, len(text), self.chunk_size):
+            chunk = text[ii:ii+self.chunk_size]
+            time.sleep(self.char_latency * len(chunk))
+            yield StubResponse(chunk)
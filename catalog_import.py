@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog Import
+
+Load a points/errata release of the fleet component catalog (ships, upgrades,
+squadrons, their names, slots and factions) from a JSON file in a single
+transaction. A release looks like the output of --export:
+    {
+    "version": "RRG 5.6",
+    "effective_date": "2025-06-01",
+    "ships": [{"id": 1, "name": "...", "aliases": ["..."],
+               "faction": "rebel", "cost": 77, "size": "Medium",
+               "slots": ["Commander", "Officer", ...]}],
+    "upgrades": [{"id": 1, "name": "...", "aliases": [], "cost": 23,
+                  "slot": "Commander", "uniq": 1, "mod": 0,
+                  "factions": ["rebel"]}],
+    "squadrons": [{"id": 1, "name": "...", "aliases": [],
+                   "faction": "rebel", "cost": 19, "uniq": 1}]
+    }
+Components are matched to the catalog by id if one is given, otherwise by
+name (or alias) and faction (ships and squadrons) or slot (upgrades).
+Unmatched components are added. Components missing from the release are kept,
+since old fleets still use them, and are listed in the diff.
+
+Before anything is written, the release is diffed against the catalog and the
+changes are printed: components added, fields changed (with old and new
+values), new aliases and components missing from the release.
+
+Every import is kept as a version in CatalogVersions, with a snapshot of the
+cost of every component in CatalogCosts. The first import also records the
+catalog as it was before as a baseline version. The views cost each fleet
+with the version in effect on the date of its event, so a points change does
+not rewrite the results of past events. The Ships, Upgrades and Squadrons
+tables hold the latest version; a release with an earlier effective date than
+the latest only adds its snapshot.
+
+The whole catalog is read and written with a handful of set-based
+statements, so a full reload takes a few tens of milliseconds. Importing the
+same file again does nothing.
+
+Usage:
+    python catalog_import.py release.json --dry-run
+    python catalog_import.py release.json
+    python catalog_import.py --export catalog.json
+
+@author: alexe
+"""
+import argparse
+import hashlib
+import json
+import os
+import db
+
+# Effective date of the baseline version made from the catalog as it was
+# before the first import
+BASELINE_DATE = '0000-01-01'
+
+# Per component kind: table, names table and its id column, fields stored as
+# columns, and the field (besides the name) that tells same-named components
+# apart
+kinds = {
+    'ship': {'key': 'ships', 'table': 'Ships', 'names': 'ShipNames',
+             'id_col': 'ship_id', 'columns': ['faction', 'cost', 'size'],
+             'match': 'faction'},
+    'upgrade': {'key': 'upgrades', 'table': 'Upgrades',
+                'names': 'UpgradeNames', 'id_col': 'upgrade_id',
+                'columns': ['cost', 'slot', 'uniq', 'mod'],
+                'match': 'slot'},
+    'squadron': {'key': 'squadrons', 'table': 'Squadrons',
+                 'names': 'SquadronNames', 'id_col': 'squadron_id',
+                 'columns': ['faction', 'cost', 'uniq'], 'match': 'faction'},
+    }
+
+# Fields that reference another table: field -> (column, lookup)
+references = {'faction': 'faction_id', 'slot': 'slot_id'}
+
+def load_lookups(conn):
+    factions = dict(conn.execute('SELECT id, name FROM Factions'))
+    slots = dict(conn.execute('SELECT id, name FROM UpgradeSlots'))
+    return {'faction': factions, 'slot': slots}
+
+# Current catalog, in release format
+def export_catalog(conn):
+    lookups = load_lookups(conn)
+    res = {}
+    for kind, spec in kinds.items():
+        names = {}
+        aliases = {}
+        for obj_id, name, canonical in conn.execute(
+                f'SELECT {spec["id_col"]}, name, canonical'
+                + f' FROM {spec["names"]} ORDER BY rowid'):
+            if canonical:
+                names[obj_id] = name
+            else:
+                aliases.setdefault(obj_id, []).append(name)
+        columns = [references.get(c, c) for c in spec['columns']]
+        entries = []
+        for row in conn.execute(f'SELECT id, {", ".join(columns)}'
+                                + f' FROM {spec["table"]} ORDER BY id'):
+            entry = {'id': row[0], 'name': names.get(row[0]),
+                     'aliases': aliases.get(row[0], [])}
+            for field, value in zip(spec['columns'], row[1:]):
+                entry[field] = lookups[field][value] \
+                    if field in references else value
+            entries.append(entry)
+        res[spec['key']] = entries
+
+    by_id = {e['id']: e for e in res['ships']}
+    for e in by_id.values():
+        e['slots'] = []
+    for ship_id, slot_id in conn.execute(
+            'SELECT ship_id, slot_id FROM Ships_UpgradeSlots'
+            + ' ORDER BY ship_id, slot_id'):
+        if ship_id in by_id:
+            by_id[ship_id]['slots'].append(lookups['slot'][slot_id])
+    by_id = {e['id']: e for e in res['upgrades']}
+    for e in by_id.values():
+        e['factions'] = []
+    for upgrade_id, faction_id in conn.execute(
+            'SELECT upgrade_id, faction_id FROM Upgrades_Factions'
+            + ' ORDER BY upgrade_id, faction_id'):
+        if upgrade_id in by_id:
+            by_id[upgrade_id]['factions'].append(
+                lookups['faction'][faction_id])
+    return res
+
+# Check the fields of a release entry and fill in optional ones
+def normalize(kind, entry, lookups):
+    spec = kinds[kind]
+    missing = [f for f in ['name'] + spec['columns']
+               if entry.get(f) is None and f not in ('uniq', 'mod')]
+    if missing:
+        raise ValueError(f'{kind} {entry.get("name")!r} is missing'
+                         + f' {", ".join(missing)}')
+    res = dict(entry)
+    res.setdefault('aliases', [])
+    res.setdefault('uniq', 0)
+    res.setdefault('mod', 0)
+    for field in references:
+        if field in res and res[field] not in lookups[field].values():
+            raise ValueError(f'{kind} {res["name"]!r} has unknown {field}'
+                             + f' {res[field]!r}')
+    # Slots of a ship and factions of an upgrade, in id order like --export
+    for list_kind, field, lookup in (('ship', 'slots', 'slot'),
+                                     ('upgrade', 'factions', 'faction')):
+        if kind != list_kind:
+            res.pop(field, None)
+            continue
+        ids = reverse(lookups[lookup])
+        unknown = [v for v in res.get(field, []) if v not in ids]
+        if unknown:
+            raise ValueError(f'{kind} {res["name"]!r} has unknown {field}'
+                             + f' {", ".join(map(str, unknown))}')
+        res[field] = sorted(res.get(field, []), key=ids.get)
+    return res
+
+def reverse(lookup):
+    return {v: k for k, v in lookup.items()}
+
+# Match release entries to catalog components. Returns [(id or None,
+# entry)] in release order. Components without a canonical name (name None)
+# can only be matched by id or alias.
+def match(kind, entries, current):
+    spec = kinds[kind]
+    ids = {e['id'] for e in current}
+    canonical = {}
+    alias = {}
+    for e in current:
+        if e['name'] is not None:
+            canonical[(e['name'].lower(), e[spec['match']])] = e['id']
+        for name in e['aliases']:
+            alias.setdefault((name.lower(), e[spec['match']]), set()).add(
+                e['id'])
+    res = []
+    for entry in entries:
+        if entry.get('id') is not None:
+            res.append((entry['id'] if entry['id'] in ids else None, entry))
+            continue
+        key = (entry['name'].lower(), entry[spec['match']])
+        obj_id = canonical.get(key)
+        if obj_id is None and len(alias.get(key, ())) == 1:
+            obj_id = next(iter(alias[key]))
+        res.append((obj_id, entry))
+    return res
+
+# Fields compared between a release entry and the catalog
+def compared_fields(kind):
+    fields = ['name'] + kinds[kind]['columns']
+    if kind == 'ship':
+        fields.append('slots')
+    if kind == 'upgrade':
+        fields.append('factions')
+    return fields
+
+# Differences between a release and the current catalog, per kind:
+# added names, changed {name: {field: [old, new]}}, new aliases
+# {name: [aliases]}, missing names and the number unchanged
+def diff(release, current):
+    res = {}
+    for kind, spec in kinds.items():
+        cur = {e['id']: e for e in current[spec['key']]}
+        kind_res = {'added': [], 'changed': {}, 'aliases': {},
+                    'missing': [], 'unchanged': 0}
+        seen = set()
+        for obj_id, entry in release[kind]:
+            if obj_id is None:
+                kind_res['added'].append(entry['name'])
+                continue
+            seen.add(obj_id)
+            old = cur[obj_id]
+            changes = {f: [old[f], entry[f]] for f in compared_fields(kind)
+                       if f in entry and old[f] != entry[f]}
+            known = {a.lower() for a in [old['name']] + old['aliases']
+                     if a is not None}
+            new_aliases = [a for a in [entry['name']] + entry['aliases']
+                           if a.lower() not in known]
+            if changes:
+                kind_res['changed'][entry['name']] = changes
+            if new_aliases:
+                kind_res['aliases'][entry['name']] = new_aliases
+            if not changes and not new_aliases:
+                kind_res['unchanged'] += 1
+        kind_res['missing'] = [e['name'] for obj_id, e in cur.items()
+                               if obj_id not in seen]
+        res[kind] = kind_res
+    return res
+
+def read_release(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    release = json.loads(data)
+    for field in ('version', 'effective_date'):
+        if not release.get(field):
+            raise ValueError(f'release has no {field}')
+    return release, hashlib.sha1(data).hexdigest()
+
+# Write the components of a release to the catalog tables
+def apply_release(cursor, release, lookups):
+    ids = {field: reverse(lookup) for field, lookup in lookups.items()}
+    for kind, spec in kinds.items():
+        columns = [references.get(c, c) for c in spec['columns']]
+        def values(entry):
+            return [ids[f][entry[f]] if f in references else entry[f]
+                    for f in spec['columns']]
+
+        matched = release[kind]
+        for ii, (obj_id, entry) in enumerate(matched):
+            if obj_id is None:
+                cols = (['id'] if entry.get('id') is not None else []) \
+                    + columns
+                args = ([entry['id']] if entry.get('id') is not None
+                        else []) + values(entry)
+                cursor.execute(f'INSERT INTO {spec["table"]}'
+                               + f' ({", ".join(cols)}) VALUES'
+                               + f' ({", ".join("?" * len(cols))})', args)
+                matched[ii] = (cursor.lastrowid, entry)
+        cursor.executemany(
+            f'UPDATE {spec["table"]} SET '
+            + ', '.join(f'{c} = ?' for c in columns) + ' WHERE id = ?',
+            [values(entry) + [obj_id] for obj_id, entry in matched])
+
+        # Names: the release name becomes canonical, other names are kept
+        names = spec['names']
+        id_col = spec['id_col']
+        existing = {}
+        for obj_id, name in cursor.execute(
+                f'SELECT {id_col}, name FROM {names}'):
+            existing.setdefault(obj_id, set()).add(name)
+        new_names = [(obj_id, name) for obj_id, entry in matched
+                     for name in [entry['name']] + entry['aliases']
+                     if name not in existing.get(obj_id, ())]
+        cursor.executemany(f'INSERT INTO {names} ({id_col}, name)'
+                           + ' VALUES (?, ?)', new_names)
+        cursor.executemany(
+            f'UPDATE {names} SET canonical = 0'
+            + f' WHERE {id_col} = ? AND canonical = 1 AND name <> ?',
+            [(obj_id, entry['name']) for obj_id, entry in matched])
+        cursor.executemany(
+            f'UPDATE {names} SET canonical = 1 WHERE rowid = ('
+            + f'SELECT rowid FROM {names} WHERE {id_col} = ? AND name = ?'
+            + ' ORDER BY rowid LIMIT 1) AND canonical = 0',
+            [(obj_id, entry['name']) for obj_id, entry in matched])
+
+    ships = release['ship']
+    cursor.executemany('DELETE FROM Ships_UpgradeSlots WHERE ship_id = ?',
+                       [(obj_id,) for obj_id, _ in ships])
+    cursor.executemany('INSERT INTO Ships_UpgradeSlots (ship_id, slot_id)'
+                       + ' VALUES (?, ?)',
+                       [(obj_id, ids['slot'][slot]) for obj_id, e in ships
+                        for slot in e['slots']])
+    upgrades = release['upgrade']
+    cursor.executemany('DELETE FROM Upgrades_Factions WHERE upgrade_id = ?',
+                       [(obj_id,) for obj_id, _ in upgrades])
+    cursor.executemany('INSERT INTO Upgrades_Factions (upgrade_id, faction_id)'
+                       + ' VALUES (?, ?)',
+                       [(obj_id, ids['faction'][faction])
+                        for obj_id, e in upgrades
+                        for faction in e['factions']])
+
+def current_costs(cursor):
+    return {(kind, obj_id): cost for kind, spec in kinds.items()
+            for obj_id, cost in cursor.execute(
+                f'SELECT id, cost FROM {spec["table"]}')}
+
+def add_version(cursor, version, effective_date, source, digest, costs):
+    cursor.execute('INSERT INTO CatalogVersions (version, effective_date,'
+                   + ' imported, source, digest)'
+                   + " VALUES (?, ?, datetime('now'), ?, ?)",
+                   (version, effective_date, source, digest))
+    version_id = cursor.lastrowid
+    cursor.executemany('INSERT INTO CatalogCosts VALUES (?, ?, ?, ?)',
+                       [(version_id, kind, obj_id, cost)
+                        for (kind, obj_id), cost in costs.items()])
+    return version_id
+
+# Import a release file into the DB. Returns the diff, with the id of the new
+# version (None for a dry run or a file that was already imported).
+def import_release(conn, path, dry_run=False):
+    release, digest = read_release(path)
+    lookups = load_lookups(conn)
+    current = export_catalog(conn)
+    matched = {}
+    for kind, spec in kinds.items():
+        entries = [normalize(kind, e, lookups)
+                   for e in release.get(spec['key'], [])]
+        matched[kind] = match(kind, entries, current[spec['key']])
+    res = {'diff': diff(matched, current), 'version_id': None}
+    if dry_run:
+        return res
+    if conn.execute('SELECT 1 FROM CatalogVersions WHERE digest = ?',
+                    (digest,)).fetchone():
+        res['skipped'] = 'already imported'
+        return res
+
+    date = release['effective_date']
+    cursor = conn.cursor()
+    conn.commit()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        if not cursor.execute('SELECT 1 FROM CatalogVersions').fetchone():
+            add_version(cursor, 'baseline', BASELINE_DATE, None, None,
+                        current_costs(cursor))
+        latest = cursor.execute('SELECT MAX(effective_date)'
+                                + ' FROM CatalogVersions').fetchone()[0]
+        # Costs carried over for components not in the release: those of the
+        # version this one follows
+        prev = cursor.execute(
+            'SELECT id FROM CatalogVersions WHERE effective_date <= ?'
+            + ' ORDER BY effective_date DESC, id DESC LIMIT 1',
+            (date,)).fetchone()
+        costs = current_costs(cursor)
+        if prev is not None:
+            costs.update({(kind, obj_id): cost
+                          for kind, obj_id, cost in cursor.execute(
+                              'SELECT kind, component_id, cost'
+                              + ' FROM CatalogCosts WHERE version_id = ?',
+                              prev)})
+        if date >= latest:
+            apply_release(cursor, matched, lookups)
+        else:
+            # Only the snapshot; new components still need catalog rows
+            for kind, entries in matched.items():
+                matched[kind] = [m for m in entries if m[0] is not None]
+        costs.update({(kind, obj_id): entry['cost']
+                      for kind, entries in matched.items()
+                      for obj_id, entry in entries})
+        res['version_id'] = add_version(cursor, release['version'], date,
+                                        os.path.basename(path), digest,
+                                        costs)
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return res
+
+def print_diff(res):
+    for kind, kind_res in res['diff'].items():
+        print(f'{kinds[kind]["key"]}: {len(kind_res["added"])} added,'
+              + f' {len(kind_res["changed"])} changed,'
+              + f' {len(kind_res["aliases"])} with new names,'
+              + f' {len(kind_res["missing"])} missing,'
+              + f' {kind_res["unchanged"]} unchanged')
+        for name in kind_res['added']:
+            print(f'  + {name}')
+        for name, changes in kind_res['changed'].items():
+            fields = ', '.join(f'{f} {old} -> {new}'
+                               for f, (old, new) in changes.items())
+            print(f'  ~ {name}: {fields}')
+        for name, aliases in kind_res['aliases'].items():
+            print(f'  ~ {name}: new names {", ".join(aliases)}')
+        for name in kind_res['missing']:
+            print(f'  ? {name} (not in release, kept)')
+
+def print_versions(conn):
+    for row in conn.execute('SELECT v.id, v.version, v.effective_date,'
+                            + ' v.imported, v.source, COUNT(c.cost)'
+                            + ' FROM CatalogVersions AS v'
+                            + ' LEFT JOIN CatalogCosts AS c'
+                            + ' ON c.version_id = v.id'
+                            + ' GROUP BY v.id ORDER BY v.effective_date'):
+        print('{}: {} effective {} (imported {} from {}, {} costs)'
+              .format(*row))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="catalog_import",
+        description="load a points/errata release into the Armada SQL DB")
+    parser.add_argument("release", type=str, nargs='?',
+                        help="JSON release file")
+    parser.add_argument("--db", type=str, default=db.DEFAULT_PATH)
+    parser.add_argument("-n", "--dry-run", action='store_true',
+                        help="only print the differences with the catalog")
+    parser.add_argument("--export", type=str, metavar="PATH",
+                        help="write the current catalog as a release file")
+    parser.add_argument("--versions", action='store_true',
+                        help="list the imported catalog versions")
+    args = parser.parse_args()
+
+    conn = db.connect(args.db)
+    if args.export:
+        catalog = export_catalog(conn)
+        catalog = {'version': 'export', 'effective_date': None, **catalog}
+        with open(args.export, 'w', encoding='utf-8') as f:
+            json.dump(catalog, f, indent=1, ensure_ascii=False)
+        print(f'Catalog written to {args.export}')
+    elif args.release:
+        try:
+            res = import_release(conn, args.release, dry_run=args.dry_run)
+        except (ValueError, KeyError) as e:
+            print(f'Could not import {args.release}: {e}')
+            conn.close()
+            exit(1)
+        print_diff(res)
+        if res.get('skipped'):
+            print(f'{args.release} was {res["skipped"]}')
+        elif res['version_id'] is not None:
+            print(f'Imported as catalog version {res["version_id"]}')
+    if args.versions:
+        print_versions(conn)
+    conn.close()
@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+"""
+Compact Fleet
+
+Compact in-memory fleets for analytics over many events. The parser and
+fleet_lists work with fleets as nested dicts (fleet['ships'][i]['upgrades']
+[j]['id']), which take about 5 kB each and have to be walked key by key.
+Here a fleet only keeps component IDs, in fixed-width integer arrays:
+    CompactFleet - one fleet, a __slots__ object with arrays of ship IDs,
+        upgrade IDs (with the offset of each ship's upgrades), squadron IDs
+        and squadron counts
+    FleetArchive - many fleets stored column-wise: every fleet's ship IDs
+        in one array, every upgrade ID in another and so on, plus offset
+        arrays marking where each fleet (and each ship) starts
+An archive of 100k fleets takes about 15 MB, loads from the DB in one pass
+over each fleet table, and saves to and loads from a file as a few raw array
+copies. The components of a fleet are contiguous in each array, so scans
+(which fleets have a component, how many fleets use each one) walk flat
+arrays without building any dicts.
+
+Component IDs are stored as unsigned 16-bit integers and squadron counts as
+unsigned bytes; both are far above what the catalog and the game use.
+Faction IDs are unsigned bytes too, with 0 for a fleet without a (known)
+faction.
+
+A fleet's canonical form ignores the player, the event and the order of its
+ships, upgrades and squadrons, so fleets with the same list have the same
+canonical bytes and hash (CompactFleet.key) and can be deduplicated.
+
+Usage:
+    python compact_fleet.py -o fleets.bin
+    python compact_fleet.py --load fleets.bin --dedupe
+
+@author: alexe
+"""
+import argparse
+import bisect
+import collections
+import hashlib
+import struct
+import sys
+from array import array
+import sql_queries
+import db
+import fleet_lists
+
+ID_TYPE = 'H'
+COUNT_TYPE = 'B'
+OFFSET_TYPE = 'I'
+
+kinds = ('ship', 'upgrade', 'squadron')
+
+# Bytes of an array in little-endian order, whatever the machine
+def to_le(arr):
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+def from_le(typecode, data):
+    arr = array(typecode)
+    arr.frombytes(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+# One fleet. upgrade_offsets has one entry per ship plus one: the upgrades of
+# ship i are upgrades[upgrade_offsets[i]:upgrade_offsets[i + 1]].
+class CompactFleet:
+    __slots__ = ('id', 'event_id', 'player', 'faction_id', 'ships',
+                 'upgrade_offsets', 'upgrades', 'squadrons', 'counts')
+
+    # id, event_id, faction_id, length of the player name, ships, upgrades,
+    # squadrons
+    header = struct.Struct('<qiBHHHH')
+
+    def __init__(self, id=None, event_id=None, player=None, faction_id=0,
+                 ships=(), upgrade_offsets=(0,), upgrades=(), squadrons=(),
+                 counts=()):
+        self.id = id
+        self.event_id = event_id
+        self.player = player
+        self.faction_id = faction_id
+        self.ships = array(ID_TYPE, ships)
+        self.upgrade_offsets = array(ID_TYPE, upgrade_offsets)
+        self.upgrades = array(ID_TYPE, upgrades)
+        self.squadrons = array(ID_TYPE, squadrons)
+        self.counts = array(COUNT_TYPE, counts)
+
+    # From a fleet in fleet_lists format. factions maps faction names to IDs;
+    # fleets with no faction or one not in factions get faction 0 (unknown).
+    @classmethod
+    def from_dict(cls, fleet, factions):
+        offsets = [0]
+        upgrades = []
+        for ship in fleet['ships']:
+            upgrades.extend(u['id'] for u in ship['upgrades'])
+            offsets.append(len(upgrades))
+        return cls(fleet.get('id'), fleet.get('event_id'),
+                   fleet.get('player'),
+                   factions.get(fleet.get('faction'), 0),
+                   [s['id'] for s in fleet['ships']], offsets, upgrades,
+                   [q['id'] for q in fleet['squadrons']],
+                   [q['count'] for q in fleet['squadrons']])
+
+    # Back to fleet_lists format, with names and costs from a
+    # fleet_lists.Names lookup if one is given
+    def to_dict(self, names=None, factions=None):
+        def lookup(table, obj_id):
+            if names is None:
+                return None, None
+            return getattr(names, table).get(obj_id, (None, None))
+
+        res = {'id': self.id, 'event_id': self.event_id,
+               'player': self.player,
+               'faction': (factions or {}).get(self.faction_id,
+                                               self.faction_id),
+               'commander': None, 'ships': [], 'squadrons': []}
+        for ii, ship_id in enumerate(self.ships):
+            name, cost = lookup('ships', ship_id)
+            ship = {'id': ship_id, 'name': name, 'base_cost': cost,
+                    'upgrades': []}
+            for upgrade_id in self.ship_upgrades(ii):
+                name, cost = lookup('upgrades', upgrade_id)
+                ship['upgrades'].append({'id': upgrade_id, 'name': name,
+                                         'cost': cost})
+                if names is not None and upgrade_id in names.commanders:
+                    res['commander'] = name
+            res['ships'].append(ship)
+        for squad_id, count in zip(self.squadrons, self.counts):
+            name, cost = lookup('squadrons', squad_id)
+            res['squadrons'].append({'id': squad_id, 'name': name,
+                                     'cost': cost, 'count': count})
+        return res
+
+    def ship_upgrades(self, ii):
+        return self.upgrades[self.upgrade_offsets[ii]:
+                             self.upgrade_offsets[ii + 1]]
+
+    def to_bytes(self):
+        player = (self.player or '').encode('utf-8')
+        return b''.join([
+            self.header.pack(self.id or 0, self.event_id or 0,
+                             self.faction_id, len(player), len(self.ships),
+                             len(self.upgrades), len(self.squadrons)),
+            player, to_le(self.ships), to_le(self.upgrade_offsets),
+            to_le(self.upgrades), to_le(self.squadrons), to_le(self.counts)])
+
+    @classmethod
+    def from_bytes(cls, data):
+        (fleet_id, event_id, faction_id, len_player, num_ships, num_upgrades,
+         num_squadrons) = cls.header.unpack_from(data)
+        pos = cls.header.size
+        player = bytes(data[pos:pos + len_player]).decode('utf-8')
+        pos += len_player
+        fields = []
+        size = array(ID_TYPE).itemsize
+        for typecode, num in ((ID_TYPE, num_ships),
+                              (ID_TYPE, num_ships + 1),
+                              (ID_TYPE, num_upgrades),
+                              (ID_TYPE, num_squadrons),
+                              (COUNT_TYPE, num_squadrons)):
+            end = pos + num * (size if typecode == ID_TYPE else 1)
+            fields.append(from_le(typecode, data[pos:end]))
+            pos = end
+        res = cls(fleet_id, event_id, player, faction_id)
+        (res.ships, res.upgrade_offsets, res.upgrades, res.squadrons,
+         res.counts) = fields
+        return res
+
+    # The list without player, event or ordering: faction, ships sorted by
+    # ID and upgrades (each ship's upgrades sorted), then squadrons sorted
+    # by ID with their total counts
+    def canonical(self):
+        ships = sorted((ship_id, sorted(self.ship_upgrades(ii)))
+                       for ii, ship_id in enumerate(self.ships))
+        squadrons = collections.Counter()
+        for squad_id, count in zip(self.squadrons, self.counts):
+            squadrons[squad_id] += count
+        values = [self.faction_id, len(ships)]
+        for ship_id, upgrades in ships:
+            values += [ship_id, len(upgrades)] + upgrades
+        values.append(len(squadrons))
+        for squad_id in sorted(squadrons):
+            values += [squad_id, squadrons[squad_id]]
+        return to_le(array(ID_TYPE, values))
+
+    # 64-bit hash of the canonical form
+    def key(self):
+        return int.from_bytes(
+            hashlib.blake2b(self.canonical(), digest_size=8).digest(),
+            'little')
+
+    def __eq__(self, other):
+        if not isinstance(other, CompactFleet):
+            return NotImplemented
+        return self.canonical() == other.canonical()
+
+    def __hash__(self):
+        return self.key()
+
+    def __repr__(self):
+        return (f'CompactFleet(id={self.id}, player={self.player!r},'
+                + f' ships={list(self.ships)},'
+                + f' squadrons={list(self.squadrons)})')
+
+# Many fleets, column-wise. Fleet i has ships ships[ship_offsets[i]:
+# ship_offsets[i + 1]], ship j has upgrades upgrades[upgrade_offsets[j]:
+# upgrade_offsets[j + 1]], and so on. Player names are stored once each.
+class FleetArchive:
+    magic = b'ARMF'
+    format_version = 1
+
+    # Arrays written to file, in order
+    columns = [('ids', 'q'), ('event_ids', 'i'), ('faction_ids', 'B'),
+               ('player_ids', OFFSET_TYPE), ('ship_offsets', OFFSET_TYPE),
+               ('ships', ID_TYPE), ('upgrade_offsets', OFFSET_TYPE),
+               ('upgrades', ID_TYPE), ('squadron_offsets', OFFSET_TYPE),
+               ('squadrons', ID_TYPE), ('counts', COUNT_TYPE)]
+
+    def __init__(self):
+        for name, typecode in self.columns:
+            setattr(self, name, array(typecode))
+        for name in ('ship_offsets', 'upgrade_offsets', 'squadron_offsets'):
+            getattr(self, name).append(0)
+        self.players = []
+        self._player_index = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, ii):
+        if ii < 0:
+            ii += len(self)
+        if not 0 <= ii < len(self):
+            raise IndexError('fleet index out of range')
+        s0, s1 = self.ship_offsets[ii], self.ship_offsets[ii + 1]
+        q0, q1 = self.squadron_offsets[ii], self.squadron_offsets[ii + 1]
+        u0 = self.upgrade_offsets[s0]
+        res = CompactFleet(self.ids[ii], self.event_ids[ii],
+                           self.players[self.player_ids[ii]],
+                           self.faction_ids[ii])
+        res.ships = self.ships[s0:s1]
+        res.upgrade_offsets = array(
+            ID_TYPE, (off - u0 for off in self.upgrade_offsets[s0:s1 + 1]))
+        res.upgrades = self.upgrades[u0:self.upgrade_offsets[s1]]
+        res.squadrons = self.squadrons[q0:q1]
+        res.counts = self.counts[q0:q1]
+        return res
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self[ii]
+
+    def player_id(self, player):
+        player_id = self._player_index.get(player)
+        if player_id is None:
+            player_id = self._player_index[player] = len(self.players)
+            self.players.append(player)
+        return player_id
+
+    def append(self, fleet):
+        self.ids.append(fleet.id or 0)
+        self.event_ids.append(fleet.event_id or 0)
+        self.faction_ids.append(fleet.faction_id)
+        self.player_ids.append(self.player_id(fleet.player or ''))
+        u0 = len(self.upgrades)
+        self.ships.extend(fleet.ships)
+        self.ship_offsets.append(len(self.ships))
+        self.upgrade_offsets.extend(u0 + off
+                                    for off in fleet.upgrade_offsets[1:])
+        self.upgrades.extend(fleet.upgrades)
+        self.squadrons.extend(fleet.squadrons)
+        self.counts.extend(fleet.counts)
+        self.squadron_offsets.append(len(self.squadrons))
+
+    # Read the selected fleets (see fleet_lists.fleet_filter) from the DB,
+    # one ordered pass over each fleet table
+    @classmethod
+    def from_db(cls, conn, fleet_ids=None, event_id=None):
+        res = cls()
+        where, params = fleet_lists.fleet_filter(fleet_ids, event_id)
+        index = {}
+        for fleet_id, ev_id, player, faction_id in conn.execute(
+                sql_queries.get_fleet_ids_where.format(where=where), params):
+            index[fleet_id] = len(res.ids)
+            res.ids.append(fleet_id)
+            res.event_ids.append(ev_id)
+            res.faction_ids.append(faction_id)
+            res.player_ids.append(res.player_id(player))
+
+        # Ships come in fleet order, so each fleet's ships are contiguous
+        num_ships = [0] * len(index)
+        ship_index = {}
+        for fleet_id, fleet_ship_id, ship_id in conn.execute(
+                sql_queries.get_fleets_ships_where.format(where=where),
+                params):
+            ship_index[fleet_ship_id] = len(res.ships)
+            res.ships.append(ship_id)
+            num_ships[index[fleet_id]] += 1
+        for num in num_ships:
+            res.ship_offsets.append(res.ship_offsets[-1] + num)
+
+        upgrades = [[] for _ in res.ships]
+        for fleet_ship_id, upgrade_id in conn.execute(
+                sql_queries.get_fleets_upgrades_where.format(where=where),
+                params):
+            upgrades[ship_index[fleet_ship_id]].append(upgrade_id)
+        for ship_upgrades in upgrades:
+            res.upgrades.extend(ship_upgrades)
+            res.upgrade_offsets.append(len(res.upgrades))
+
+        squadrons = [[] for _ in index]
+        for fleet_id, squad_id, count in conn.execute(
+                sql_queries.get_fleets_squadrons_where.format(where=where),
+                params):
+            squadrons[index[fleet_id]].append((squad_id, count))
+        for fleet_squadrons in squadrons:
+            for squad_id, count in fleet_squadrons:
+                res.squadrons.append(squad_id)
+                res.counts.append(count)
+            res.squadron_offsets.append(len(res.squadrons))
+        return res
+
+    # Offsets of each fleet's components in the flat array of a kind
+    def fleet_offsets(self, kind):
+        if kind == 'ship':
+            return self.ship_offsets
+        if kind == 'squadron':
+            return self.squadron_offsets
+        if kind == 'upgrade':
+            return array(OFFSET_TYPE, (self.upgrade_offsets[off]
+                                       for off in self.ship_offsets))
+        raise ValueError(f'unknown component kind {kind!r}')
+
+    def values(self, kind):
+        return {'ship': self.ships, 'upgrade': self.upgrades,
+                'squadron': self.squadrons}[kind]
+
+    # Components of a kind in fleet ii
+    def components(self, ii, kind, offsets=None):
+        offsets = offsets or self.fleet_offsets(kind)
+        return self.values(kind)[offsets[ii]:offsets[ii + 1]]
+
+    # Indices of the fleets with a component
+    def find(self, kind, component_id):
+        offsets = self.fleet_offsets(kind)
+        res = array(OFFSET_TYPE)
+        values = self.values(kind)
+        pos = -1
+        while True:
+            try:
+                pos = values.index(component_id, pos + 1)
+            except ValueError:
+                return res
+            ii = bisect.bisect_right(offsets, pos) - 1
+            res.append(ii)
+            # Skip the rest of this fleet
+            pos = offsets[ii + 1] - 1
+
+    # Number of fleets using each component of a kind
+    def popularity(self, kind):
+        offsets = self.fleet_offsets(kind)
+        values = self.values(kind)
+        res = collections.Counter()
+        for ii in range(len(self)):
+            res.update(set(values[offsets[ii]:offsets[ii + 1]]))
+        return res
+
+    # Groups of fleets with the same list: {key: [fleet indices]}
+    def dedupe(self):
+        res = {}
+        for ii, fleet in enumerate(self):
+            res.setdefault(fleet.key(), []).append(ii)
+        return res
+
+    # Bytes held by the arrays and player names
+    def nbytes(self):
+        return sum(len(arr) * arr.itemsize for arr in
+                   (getattr(self, name) for name, _ in self.columns)) \
+            + sum(len(player.encode('utf-8')) + 1 for player in self.players)
+
+    def to_bytes(self):
+        players = '\0'.join(self.players).encode('utf-8')
+        parts = [self.magic, struct.pack('<HQ', self.format_version,
+                                         len(players)), players]
+        for name, _ in self.columns:
+            arr = getattr(self, name)
+            parts.append(struct.pack('<Q', len(arr)))
+            parts.append(to_le(arr))
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = memoryview(data)
+        if bytes(data[:4]) != cls.magic:
+            raise ValueError('not a fleet archive')
+        version, len_players = struct.unpack_from('<HQ', data, 4)
+        if version != cls.format_version:
+            raise ValueError(f'unsupported fleet archive version {version}')
+        pos = 4 + struct.calcsize('<HQ')
+        res = cls()
+        players = bytes(data[pos:pos + len_players]).decode('utf-8')
+        res.players = players.split('\0') if players else []
+        res._player_index = {p: ii for ii, p in enumerate(res.players)}
+        pos += len_players
+        for name, typecode in cls.columns:
+            num, = struct.unpack_from('<Q', data, pos)
+            pos += 8
+            end = pos + num * array(typecode).itemsize
+            setattr(res, name, from_le(typecode, data[pos:end]))
+            pos = end
+        return res
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="compact_fleet",
+        description="pack the fleets of the Armada SQL DB into a compact"
+        + " archive file")
+    parser.add_argument("--db", type=str, default=db.DEFAULT_PATH)
+    parser.add_argument("--event", type=int, help="only fleets of an event")
+    parser.add_argument("-o", "--output", type=str,
+                        help="write the archive to a file")
+    parser.add_argument("--load", type=str, metavar="PATH",
+                        help="read an archive file instead of the DB")
+    parser.add_argument("--dedupe", action='store_true',
+                        help="list fleets with the same list")
+    args = parser.parse_args()
+
+    if args.load:
+        archive = FleetArchive.load(args.load)
+    else:
+        try:
+            conn = db.connect_readonly(args.db)
+        except ValueError as e:
+            parser.error(str(e))
+        archive = FleetArchive.from_db(conn, event_id=args.event)
+        conn.close()
+    print(f'{len(archive)} fleets, {len(archive.ships)} ships,'
+          + f' {len(archive.upgrades)} upgrades,'
+          + f' {len(archive.squadrons)} squadron entries,'
+          + f' {archive.nbytes() / 1e6:.2f} MB')
+    if args.output:
+        archive.save(args.output)
+        print(f'Archive written to {args.output}')
+    if args.dedupe:
+        groups = [ii for ii in archive.dedupe().values() if len(ii) > 1]
+        for group in groups:
+            print('Same list: ' + ', '.join(
+                f'{archive.players[archive.player_ids[ii]]}'
+                + f' (fleet {archive.ids[ii]})' for ii in group))
+        print(f'{len(groups)} lists used by more than one fleet')
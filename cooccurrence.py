@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Co-occurrence
+
+Find the components that are taken together: frequent combinations of ships,
+upgrades, squadrons and flagships (the ship carrying the commander) across
+fleets, and association rules between them with their support, confidence
+and lift, e.g.
+    upgrade: Darth Vader, flagship: Imperial II-class Star Destroyer
+        -> upgrade: Avenger (support 6%, confidence 81%, lift 5.2)
+The dashboard views only count components one at a time.
+
+Each fleet is a set of integer items (component kind and ID, see encode),
+read from a compact_fleet.FleetArchive. For a group of fleets, every item
+gets a bitset (a Python int with bit i set if fleet i has the item), and the
+frequent itemsets are found depth-first by intersecting bitsets (Eclat): the
+support of an itemset is the popcount of the AND of its items' bitsets.
+
+Fleets are split into partitions of whole events (at least partition_size
+fleets each), and each partition is mined on its own, in parallel processes.
+Any itemset that is frequent over all fleets is frequent in at least one
+partition at the same relative support, so the union of the partitions'
+itemsets holds every globally frequent one; these candidates are then
+counted in every partition from its bitsets and the totals are kept if
+frequent. Results are exact.
+
+New events are added incrementally: only their partition is mined, and
+counts already made for a partition are kept. The miner keeps the revision
+of every event it has mined (see event_sync); when an event is synced again,
+its fleets are taken out of their partition (shifting the bits of the
+fleets after them) and added again, and both partitions are mined again.
+The miner state can be saved between runs with --state, so re-mining after
+an event only reads and mines the new or changed fleets.
+
+Usage:
+    python cooccurrence.py --min-support 0.05 --min-lift 2
+    python cooccurrence.py --state mining.pickle --top 50
+
+@author: alexe
+"""
+import argparse
+import math
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+import compact_fleet
+import sql_queries
+import db
+import fleet_lists
+
+kinds = ('ship', 'upgrade', 'squadron', 'flagship')
+
+# Items are ints: kind index * ITEM_BASE + component ID
+ITEM_BASE = 1 << 16
+
+def encode(kind, component_id):
+    return kinds.index(kind) * ITEM_BASE + component_id
+
+def decode(item):
+    return kinds[item // ITEM_BASE], item % ITEM_BASE
+
+# Item set of fleet ii of an archive. commanders is the set of commander
+# upgrade IDs.
+def fleet_items(archive, ii, commanders):
+    ship_offsets = archive.ship_offsets
+    upgrade_offsets = archive.upgrade_offsets
+    upgrade_base = encode('upgrade', 0)
+    flagship_base = encode('flagship', 0)
+    items = set()
+    for jj in range(ship_offsets[ii], ship_offsets[ii + 1]):
+        ship_upgrades = archive.upgrades[upgrade_offsets[jj]:
+                                         upgrade_offsets[jj + 1]]
+        items.add(archive.ships[jj])
+        items.update(upgrade_base + u for u in ship_upgrades)
+        if not commanders.isdisjoint(ship_upgrades):
+            items.add(flagship_base + archive.ships[jj])
+    squadron_base = encode('squadron', 0)
+    items.update(squadron_base + q for q in archive.squadrons[
+        archive.squadron_offsets[ii]:archive.squadron_offsets[ii + 1]])
+    return items
+
+# Item sets of the fleets of an archive, by event, in event order
+def archive_items(archive, commanders):
+    res = {}
+    for ii in range(len(archive)):
+        res.setdefault(archive.event_ids[ii], []).append(
+            fleet_items(archive, ii, commanders))
+    return dict(sorted(res.items()))
+
+# Bitset of every item: bit i is set if fleet i has the item
+def bitsets(fleets):
+    res = {}
+    for ii, items in enumerate(fleets):
+        bit = 1 << ii
+        for item in items:
+            res[item] = res.get(item, 0) | bit
+    return res
+
+# Itemsets (sorted tuples) of up to max_size items found in at least
+# min_count fleets, with their counts
+def eclat(bits, min_count, max_size):
+    res = {}
+
+    # candidates: (item, bitset of prefix + item, count), each frequent
+    def extend(prefix, candidates):
+        for kk, (item, item_bits, count) in enumerate(candidates):
+            itemset = prefix + (item,)
+            res[itemset] = count
+            if len(itemset) == max_size:
+                continue
+            children = []
+            for other, other_bits, _ in candidates[kk + 1:]:
+                bits = item_bits & other_bits
+                other_count = bits.bit_count()
+                if other_count >= min_count:
+                    children.append((other, bits, other_count))
+            if children:
+                extend(itemset, children)
+
+    extend((), [(item, b, b.bit_count()) for item, b in sorted(bits.items())
+                if b.bit_count() >= min_count])
+    return res
+
+def min_count(min_support, num_fleets):
+    return max(1, math.ceil(min_support * num_fleets - 1e-9))
+
+# Locally frequent itemsets of a partition. Runs in worker processes.
+def mine_partition(bits, num_fleets, min_support, max_size):
+    return eclat(bits, min_count(min_support, num_fleets), max_size)
+
+# Fleets of whole events, mined together
+class Partition:
+    def __init__(self):
+        self.event_ids = []
+        self.event_sizes = []
+        self.num_fleets = 0
+        self.bits = {}
+        # Locally frequent itemsets, and the count of every itemset counted
+        # so far (including these)
+        self.local = None
+        self.counts = {}
+
+    def add(self, event_id, fleets):
+        for item, item_bits in bitsets(fleets).items():
+            self.bits[item] = self.bits.get(item, 0) \
+                | (item_bits << self.num_fleets)
+        self.event_ids.append(event_id)
+        self.event_sizes.append(len(fleets))
+        self.num_fleets += len(fleets)
+        self.local = None
+        self.counts = {}
+
+    # Take the fleets of an event out, shifting the bits of the fleets after
+    # them down
+    def remove(self, event_id):
+        ii = self.event_ids.index(event_id)
+        start = sum(self.event_sizes[:ii])
+        size = self.event_sizes[ii]
+        low = (1 << start) - 1
+        for item, item_bits in list(self.bits.items()):
+            item_bits = (item_bits & low) | (item_bits >> (start + size)
+                                             << start)
+            if item_bits:
+                self.bits[item] = item_bits
+            else:
+                del self.bits[item]
+        del self.event_ids[ii]
+        del self.event_sizes[ii]
+        self.num_fleets -= size
+        self.local = None
+        self.counts = {}
+
+    def count(self, itemset):
+        res = self.counts.get(itemset)
+        if res is None:
+            bits = self.bits.get(itemset[0], 0)
+            for item in itemset[1:]:
+                bits &= self.bits.get(item, 0)
+            res = self.counts[itemset] = bits.bit_count()
+        return res
+
+class Rule(NamedTuple):
+    antecedent: tuple
+    consequent: int
+    count: int
+    support: float
+    confidence: float
+    lift: float
+
+class Miner:
+    def __init__(self, min_support=0.05, max_size=3, partition_size=200,
+                 workers=None):
+        self.min_support = min_support
+        self.max_size = max_size
+        self.partition_size = partition_size
+        self.workers = workers or os.cpu_count() or 1
+        self.partitions = []
+        # Revision of every event added (see event_sync)
+        self.events = {}
+        self._itemsets = None
+
+    @property
+    def num_fleets(self):
+        return sum(p.num_fleets for p in self.partitions)
+
+    # Add the fleets of events: {event_id: [item sets]}, at the revisions in
+    # revisions ({event_id: revision}, 0 if missing). Events already added at
+    # the same revision are skipped; events at a new revision replace their
+    # old fleets, and events in removed are taken out. New fleets go into
+    # the last partition until it has partition_size fleets, then into new
+    # ones. Only partitions that changed are mined again.
+    def add_events(self, events, revisions=None, removed=()):
+        revisions = revisions or {}
+        changed = []
+        for event_id in removed:
+            if event_id in self.events:
+                del self.events[event_id]
+                changed.append(self.remove_event(event_id))
+        for event_id, fleets in events.items():
+            revision = revisions.get(event_id, 0)
+            if event_id in self.events:
+                if self.events[event_id] == revision:
+                    continue
+                changed.append(self.remove_event(event_id))
+            self.events[event_id] = revision
+            if not fleets:
+                continue
+            if not self.partitions or \
+                    self.partitions[-1].num_fleets >= self.partition_size:
+                self.partitions.append(Partition())
+            part = self.partitions[-1]
+            part.add(event_id, fleets)
+            changed.append(part)
+        if not changed:
+            return 0
+        self._itemsets = None
+        self.partitions = [p for p in self.partitions if p.num_fleets]
+        changed = [p for p in dict.fromkeys(changed)
+                   if p is not None and p.num_fleets]
+        args = [(p.bits, p.num_fleets, self.min_support, self.max_size)
+                for p in changed]
+        if self.workers > 1 and len(changed) > 1:
+            with ProcessPoolExecutor(min(self.workers, len(changed))) as ex:
+                results = list(ex.map(mine_partition, *zip(*args)))
+        else:
+            results = [mine_partition(*a) for a in args]
+        for part, local in zip(changed, results):
+            part.local = local
+            part.counts = dict(local)
+        return len(changed)
+
+    # Take an event's fleets out of its partition. Returns the partition.
+    def remove_event(self, event_id):
+        for part in self.partitions:
+            if event_id in part.event_ids:
+                part.remove(event_id)
+                return part
+        return None
+
+    # Bring the miner up to date with the DB: add new events, replace the
+    # fleets of events whose revision changed and drop events that are gone
+    def update(self, conn):
+        revisions = dict(conn.execute(
+            sql_queries.get_event_revisions_where.format(where='1')))
+        removed = [ev_id for ev_id in self.events if ev_id not in revisions]
+        stale = {ev_id for ev_id, revision in revisions.items()
+                 if self.events.get(ev_id) != revision}
+        fleet_ids = [fleet_id for fleet_id, event_id in conn.execute(
+            'SELECT id, event_id FROM Fleets') if event_id in stale]
+        events = {}
+        if fleet_ids:
+            archive = compact_fleet.FleetArchive.from_db(conn, fleet_ids)
+            commanders = fleet_lists.get_names(conn).commanders
+            events = archive_items(archive, commanders)
+        # Events that changed and now have no fleets
+        for ev_id in stale & set(self.events):
+            events.setdefault(ev_id, [])
+        if not events and not removed:
+            return 0
+        return self.add_events(events, revisions, removed)
+
+    # Itemsets frequent over all fleets: {itemset: count}
+    def itemsets(self):
+        if self._itemsets is None:
+            candidates = set()
+            for part in self.partitions:
+                candidates.update(part.local)
+            needed = min_count(self.min_support, self.num_fleets)
+            res = {}
+            for itemset in candidates:
+                count = sum(p.count(itemset) for p in self.partitions)
+                if count >= needed:
+                    res[itemset] = count
+            self._itemsets = res
+        return self._itemsets
+
+    # Rules X -> y with a single item y, for every frequent itemset X + y
+    # of two or more items. Sorted by lift, then confidence.
+    def rules(self, min_confidence=0.5, min_lift=1.):
+        itemsets = self.itemsets()
+        total = self.num_fleets
+        res = []
+        for itemset, count in itemsets.items():
+            if len(itemset) < 2:
+                continue
+            for item in itemset:
+                antecedent = tuple(i for i in itemset if i != item)
+                confidence = count / itemsets[antecedent]
+                lift = confidence * total / itemsets[(item,)]
+                if confidence >= min_confidence and lift >= min_lift:
+                    res.append(Rule(antecedent, item, count, count / total,
+                                    confidence, lift))
+        res.sort(key=lambda r: (-r.lift, -r.confidence, r.antecedent,
+                                r.consequent))
+        return res
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            miner = pickle.load(f)
+        if not isinstance(miner.events, dict):
+            raise ValueError(f'{path} was saved by an older version')
+        return miner
+
+# Display name of an item, e.g. 'flagship: Victory II-class Star Destroyer'
+def item_name(item, names):
+    kind, component_id = decode(item)
+    table = {'ship': names.ships, 'flagship': names.ships,
+             'upgrade': names.upgrades, 'squadron': names.squadrons}[kind]
+    return f'{kind}: {table.get(component_id, (component_id,))[0]}'
+
+def rule_text(rule, names):
+    return (', '.join(item_name(i, names) for i in rule.antecedent)
+            + f' -> {item_name(rule.consequent, names)}'
+            + f' (support {rule.support:.1%},'
+            + f' confidence {rule.confidence:.0%}, lift {rule.lift:.2f})')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="cooccurrence",
+        description="find components taken together in the fleets of the"
+        + " Armada SQL DB")
+    parser.add_argument("--db", type=str, default=db.DEFAULT_PATH)
+    parser.add_argument("--min-support", type=float, default=0.05,
+                        help="fraction of fleets an itemset must be in")
+    parser.add_argument("--max-size", type=int, default=3,
+                        help="largest itemset size")
+    parser.add_argument("--min-confidence", type=float, default=0.5)
+    parser.add_argument("--min-lift", type=float, default=1.5)
+    parser.add_argument("--top", type=int, default=30,
+                        help="number of rules to print")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes mining partitions (default: CPUs)")
+    parser.add_argument("--state", type=str,
+                        help="keep the miner state in this file and only"
+                        + " mine new events")
+    args = parser.parse_args()
+
+    miner = None
+    if args.state and os.path.exists(args.state):
+        try:
+            miner = Miner.load(args.state)
+        except ValueError as e:
+            print(f'{e}, starting over')
+    if miner is not None and (miner.min_support, miner.max_size) \
+            != (args.min_support, args.max_size):
+        print('Mining settings changed, starting over')
+        miner = None
+    if miner is None:
+        miner = Miner(args.min_support, args.max_size)
+    miner.workers = args.workers or os.cpu_count() or 1
+
+    try:
+        conn = db.connect_readonly(args.db)
+    except ValueError as e:
+        parser.error(str(e))
+    mined = miner.update(conn)
+    names = fleet_lists.get_names(conn)
+    conn.close()
+    if args.state:
+        miner.save(args.state)
+
+    rules = miner.rules(args.min_confidence, args.min_lift)
+    print(f'{miner.num_fleets} fleets in {len(miner.events)} events'
+          + f' ({mined} partitions mined), {len(miner.itemsets())} frequent'
+          + f' itemsets, {len(rules)} rules')
+    for rule in rules[:args.top]:
+        print(rule_text(rule, names))
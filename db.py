@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+DB
+
+Connection management and prepared lookup statements for the events DB.
+
+Each process keeps one configured connection per DB file (see
+get_connection), rather than every caller opening its own with default
+settings. Connections use synchronous=NORMAL, which avoids an fsync per
+commit, and get a larger page cache and memory-mapped I/O for the reads done
+during fleet resolution and view building.
+
+The shared ingest connection also switches the DB to WAL journaling while it
+is open. WAL mode is stored in the DB file itself, so when the connection is
+closed (close_connection/close_all, or at exit) the log is checkpointed into
+the DB and the file is switched back to a rollback journal. The tracked DB in
+data/ then stays a single self-contained file, which read-only analytics
+connections opened with immutable=1 can rely on.
+
+Opening a DB for writing also applies any schema migrations it is missing
+(see migrations), so older copies of the DB are brought up to date the first
+time a tool writes to them. Tools that only read open the DB read-only
+(connect_readonly), which fails with a clear error on an older schema instead
+of writing to the file.
+
+The component lookup queries in sql_queries are resolved once, at import, into
+a statement table keyed by object type, so name resolution does not have to
+build attribute names and look them up on every call. SQLite's own statement
+cache then reuses the compiled statement, since the same string object is
+passed each time.
+
+@author: alexe
+"""
+import atexit
+import os
+import sqlite3
+from urllib.parse import quote
+import migrations
+import profiling
+import sql_queries
+
+DEFAULT_PATH = 'data/armada_events.sql'
+
+# Pragmas applied to every connection. Negative cache_size is in KiB.
+pragmas = {
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'temp_store': 'MEMORY',
+    }
+
+# Size of the per-connection compiled statement cache
+CACHED_STATEMENTS = 256
+
+# Lookups used to resolve a fleet component to its primary key, from most to
+# least precise, with the fields each one needs (in parameter order). A lookup
+# is skipped if any of its fields are missing.
+lookup_fields = [
+    ('name_faction_cost', ('name', 'faction_id', 'cost')),
+    ('name_faction', ('name', 'faction_id')),
+    ('name_cost', ('name', 'cost')),
+    ('name', ('name',)),
+    ('faction_cost', ('faction_id', 'cost')),
+    ]
+
+# statements[obj] = [(fields, query), ...] in lookup order, for each object
+# type that sql_queries has lookups for.
+def build_statements(objects=('ship', 'upgrade', 'squadron')):
+    res = {}
+    for obj in objects:
+        res[obj] = []
+        for key, fields in lookup_fields:
+            query = getattr(sql_queries, f'get_{obj}_from_{key}', None)
+            if query:
+                res[obj].append((fields, query))
+    return res
+
+statements = build_statements()
+
+def configure(conn, wal=False):
+    for key, value in pragmas.items():
+        conn.execute(f'PRAGMA {key} = {value}')
+    if wal:
+        conn.execute('PRAGMA journal_mode = WAL')
+    return conn
+
+# Open a new configured connection, with the schema migrated to the current
+# version. With wal=True the DB is switched to WAL journaling; use close()
+# below rather than conn.close() to switch it back.
+def connect(path=DEFAULT_PATH, wal=False, **kwargs):
+    kwargs.setdefault('cached_statements', CACHED_STATEMENTS)
+    conn = configure(profiling.connect(path, **kwargs), wal)
+    migrations.migrate(conn)
+    return conn
+
+# Open a new configured read-only connection. The schema must already be at
+# the current version, since a read-only connection cannot migrate it.
+def connect_readonly(path=DEFAULT_PATH, **kwargs):
+    if not os.path.isfile(path):
+        raise FileNotFoundError(path)
+    kwargs.setdefault('cached_statements', CACHED_STATEMENTS)
+    conn = configure(profiling.connect(
+        f'file:{quote(os.path.abspath(path))}?mode=ro', uri=True, **kwargs))
+    conn.execute('PRAGMA query_only = 1')
+    try:
+        migrations.check_version(conn, path)
+    except ValueError:
+        conn.close()
+        raise
+    return conn
+
+# Commit, checkpoint any WAL into the DB file and return it to rollback
+# journaling, then close. Switching back fails harmlessly if another
+# connection still has the DB open; the last one to close does it.
+def close(conn):
+    conn.commit()
+    mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+    if mode.lower() == 'wal':
+        try:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            conn.execute('PRAGMA journal_mode = DELETE')
+        except sqlite3.OperationalError:
+            pass
+    conn.close()
+
+# Signature of a DB file (and its WAL), which changes with every commit. Used
+# to tell whether anything read from the DB earlier may be stale.
+def generation(path=DEFAULT_PATH):
+    res = []
+    for name in (path, path + '-wal'):
+        try:
+            st = os.stat(name)
+        except FileNotFoundError:
+            res.append(None)
+            continue
+        res.append((st.st_mtime_ns, st.st_size))
+    return tuple(res)
+
+# Connections owned by this process, keyed by absolute DB path. The pid is
+# stored too so that a forked child does not reuse its parent's connection.
+_connections = {}
+
+# Get the shared (ingest) connection for a DB, opening it on first use
+def get_connection(path=DEFAULT_PATH):
+    key = os.path.abspath(path)
+    pid, conn = _connections.get(key, (None, None))
+    if conn is None or pid != os.getpid():
+        conn = connect(path, wal=True)
+        _connections[key] = (os.getpid(), conn)
+    return conn
+
+def close_connection(path=DEFAULT_PATH):
+    pid, conn = _connections.pop(os.path.abspath(path), (None, None))
+    if conn is not None and pid == os.getpid():
+        close(conn)
+
+def close_all():
+    for path in list(_connections):
+        close_connection(path)
+
+# Shared connections are closed (and their WAL checkpointed) at exit even if
+# the caller did not do it
+atexit.register(close_all)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Event Sync
+
+Keep an event in the DB in step with its T4.tools page when the page changes
+after the first scrape (late fleet lists, corrected scores), without redoing
+the whole event.
+
+Each round's results and each player's raw fleet list text are fingerprinted
+(SHA-1) and the fingerprints are stored in the RoundFingerprints and
+FleetFingerprints tables. On a re-scrape the fingerprints from the page are
+compared with the stored ones:
+    - rounds that are new or changed are rewritten in Scores, rounds that are
+      no longer on the page are removed
+    - fleet lists that are new or whose text changed are sent to the LLM and
+      (re)inserted, lists that are no longer on the page are removed
+    - everything else is left alone, so an unchanged event costs one page
+      load and no LLM requests
+
+Fleet list text is compared with whitespace normalized, so cosmetic changes do
+not trigger a new LLM request. Events scraped before syncing was used have
+data but no fingerprints; the first sync adopts rounds whose Scores rows
+match the page and fleets that are already in the DB, instead of redoing
+them.
+
+Every sync that changes anything bumps the event's revision in
+EventRevisions (see migrations), as does a plain scrape. The event's rows in
+the exported csv files are rewritten straight away; the query service cache,
+cooccurrence.Miner and attribution keep the revisions their results were
+made from and redo the events whose revision has changed.
+
+@author: alexe
+"""
+import argparse
+import hashlib
+import json
+from collections import Counter
+import event_to_file
+import make_views
+import profiling
+import db
+
+get_round_fingerprints = """
+SELECT round, digest FROM RoundFingerprints WHERE event_id = ?
+"""
+
+get_fleet_fingerprints = """
+SELECT player, digest FROM FleetFingerprints WHERE event_id = ?
+"""
+
+set_round_fingerprint = """
+INSERT OR REPLACE INTO RoundFingerprints (event_id, round, digest)
+VALUES (?, ?, ?)
+"""
+
+set_fleet_fingerprint = """
+INSERT OR REPLACE INTO FleetFingerprints (event_id, player, digest)
+VALUES (?, ?, ?)
+"""
+
+get_round_scores = """
+SELECT round, player, points, tournament_points, opponent FROM Scores
+WHERE event_id = ? AND round = ?
+"""
+
+get_event_players = "SELECT DISTINCT player FROM Fleets WHERE event_id = ?"
+
+# Removing a fleet means removing its rows from every Fleets table, children
+# first
+delete_fleet_str = [
+    """
+    DELETE FROM Fleets_Upgrades WHERE fleet_ship_id IN (
+        SELECT fs.id FROM Fleets_Ships AS fs
+        INNER JOIN Fleets AS f ON f.id = fs.fleet_id
+        WHERE f.event_id = ? AND f.player = ?)
+    """,
+    """
+    DELETE FROM Fleets_Ships WHERE fleet_id IN (
+        SELECT id FROM Fleets WHERE event_id = ? AND player = ?)
+    """,
+    """
+    DELETE FROM Fleets_Squadrons WHERE fleet_id IN (
+        SELECT id FROM Fleets WHERE event_id = ? AND player = ?)
+    """,
+    "DELETE FROM Fleets WHERE event_id = ? AND player = ?",
+    "DELETE FROM FleetFingerprints WHERE event_id = ? AND player = ?",
+    ]
+
+delete_round_str = [
+    "DELETE FROM Scores WHERE event_id = ? AND round = ?",
+    "DELETE FROM RoundFingerprints WHERE event_id = ? AND round = ?",
+    ]
+
+def fingerprint(value):
+    return hashlib.sha1(json.dumps(value).encode('utf-8')).hexdigest()
+
+# Round rows in a fixed order, so that rows listed in a different order on
+# the page do not count as a change
+def round_fingerprint(rows):
+    return fingerprint(sorted(json.dumps(row) for row in rows))
+
+def fleet_fingerprint(raw_fleet):
+    return fingerprint([' '.join(line.split())
+                        for line in raw_fleet.strip().splitlines()])
+
+# Keys that were added, changed and removed going from old to new
+def diff(old, new):
+    added = [key for key in new if key not in old]
+    changed = [key for key in new if key in old and old[key] != new[key]]
+    removed = [key for key in old if key not in new]
+    return added, changed, removed
+
+# Bring the Scores of an event in line with the rounds tab of its page.
+# Returns the round numbers that were added, changed, removed and adopted.
+def sync_scores(rounds, conn, ev_id):
+    cursor = conn.cursor()
+    page = {ii+1: rows
+            for ii, rows in enumerate(event_to_file.read_rounds(rounds))}
+    digests = {rnd: round_fingerprint(rows) for rnd, rows in page.items()}
+    stored = dict(cursor.execute(get_round_fingerprints, (ev_id,)))
+
+    # Rounds ingested before syncing was used. Keep them if they match.
+    adopted = []
+    for rnd, rows in page.items():
+        if rnd in stored:
+            continue
+        existing = cursor.execute(get_round_scores, (ev_id, rnd)).fetchall()
+        if existing and Counter(existing) == Counter(rows):
+            stored[rnd] = digests[rnd]
+            cursor.execute(set_round_fingerprint, (ev_id, rnd, digests[rnd]))
+            adopted.append(rnd)
+
+    added, changed, removed = diff(stored, digests)
+    for rnd in changed + removed:
+        for delete_str in delete_round_str:
+            cursor.execute(delete_str, (ev_id, rnd))
+    for rnd in added + changed:
+        if rnd in added:
+            # Leftover rows from a plain (unsynced) scrape
+            cursor.execute(delete_round_str[0], (ev_id, rnd))
+        cursor.executemany(event_to_file.insert_scores_str,
+                           [(ev_id,) + row for row in page[rnd]])
+        cursor.execute(set_round_fingerprint, (ev_id, rnd, digests[rnd]))
+    conn.commit()
+    return {'added': added, 'changed': changed, 'removed': removed,
+            'adopted': adopted}
+
+# Bring the fleets of an event in line with the lists tab of its page. Only
+# new and changed lists are parsed. Returns the players whose fleets were
+# added, changed, removed and adopted, and the ones that failed to parse.
+def sync_fleets(fleets, conn, ev_id, batch_size=1, backend=None):
+    cursor = conn.cursor()
+    page = {}
+    for name, raw_fleet in event_to_file.read_fleet_lists(fleets):
+        if not name:
+            print('WARNING: skipping fleet list with no player name')
+            continue
+        page[name] = raw_fleet
+    digests = {name: fleet_fingerprint(raw) for name, raw in page.items()}
+    stored = dict(cursor.execute(get_fleet_fingerprints, (ev_id,)))
+
+    # Fleets ingested before syncing was used. There is no list text to
+    # compare against, so take them as they are.
+    adopted = []
+    for (name,) in cursor.execute(get_event_players, (ev_id,)).fetchall():
+        if name in page and name not in stored:
+            stored[name] = digests[name]
+            cursor.execute(set_fleet_fingerprint, (ev_id, name,
+                                                   digests[name]))
+            adopted.append(name)
+
+    added, changed, removed = diff(stored, digests)
+    for name in changed + removed:
+        for delete_str in delete_fleet_str:
+            cursor.execute(delete_str, (ev_id, name))
+    conn.commit()
+
+    pending = [(name, page[name]) for name in added + changed]
+    inserted = event_to_file.add_fleet_lists(pending, conn, ev_id,
+                                             batch_size, backend)
+    for name in inserted:
+        cursor.execute(set_fleet_fingerprint, (ev_id, name, digests[name]))
+    conn.commit()
+    # Lists that failed have no fingerprint, so the next sync tries again
+    failed = [name for name, _ in pending if name not in inserted]
+    return {'added': [n for n in added if n in inserted],
+            'changed': [n for n in changed if n in inserted],
+            'removed': removed, 'adopted': adopted, 'failed': failed}
+
+# Sync an event page with the DB. An empty tab is taken to mean the page did
+# not load properly rather than that everything was deleted, and is skipped.
+# If the event changed, its rows in the csv files exported to out_dir are
+# rewritten.
+def sync_site(soup, url, name, do_scores=True, do_fleets=True,
+              sql_path=db.DEFAULT_PATH, batch_size=1, backend=None,
+              out_dir=None):
+    conn = db.get_connection(sql_path)
+    ev_id = event_to_file.get_event(soup, conn, url, name)
+    res = {'event_id': ev_id}
+
+    rounds = soup.find(id='uncontrolled-tab-example-tabpane-rounds')
+    if do_scores and rounds and rounds.find('div', {'role': 'tabpanel'}):
+        with profiling.span('sync_scores'):
+            res['rounds'] = sync_scores(rounds, conn, ev_id)
+
+    fleets = soup.find(id='uncontrolled-tab-example-tabpane-lists')
+    if do_fleets and fleets and fleets.find('div'):
+        with profiling.span('sync_fleets'):
+            res['fleets'] = sync_fleets(fleets, conn, ev_id, batch_size,
+                                        backend)
+
+    changes = sum(len(res[key][kind]) for key in ('rounds', 'fleets')
+                  if key in res for kind in ('added', 'changed', 'removed'))
+    if changes:
+        res['revision'] = event_to_file.invalidate(conn, ev_id)
+        if out_dir is not None:
+            with profiling.span('refresh_exports'):
+                res['refreshed'] = make_views.refresh_event(
+                    conn, ev_id, out_dir=out_dir)
+    else:
+        res['revision'] = event_to_file.get_revision(conn, ev_id)
+    return res
+
+def print_report(res):
+    for key in ('rounds', 'fleets'):
+        if key not in res:
+            continue
+        counts = ', '.join(f'{len(v)} {kind}' for kind, v in res[key].items())
+        print(f'{key}: {counts}')
+    print(f'event {res["event_id"]} at revision {res["revision"]}')
+    if res.get('refreshed'):
+        print(f'refreshed exports: {", ".join(res["refreshed"])}')
+
+def add_arguments(parser):
+    parser.add_argument("page", type=str, help="saved HTML of the event page")
+    parser.add_argument("url", type=str, help="URL of the event on T4")
+    parser.add_argument("-n", "--name", type=str)
+    parser.add_argument("--db", type=str, default=db.DEFAULT_PATH)
+    parser.add_argument("--no-scores", action='store_true')
+    parser.add_argument("--no-fleets", action='store_true')
+    parser.add_argument("-b", "--batch-size", type=int, default=1)
+    parser.add_argument("--out-dir", type=str, default='data',
+                        help="directory of the exported csv files to update"
+                        + " (default: data)")
+
+def main(args):
+    from bs4 import BeautifulSoup
+    event_to_file.configure_logging()
+    with open(args.page, encoding='utf-8') as f:
+        soup = BeautifulSoup(f.read(), 'html5lib')
+    res = sync_site(soup, args.url, args.name or args.url.split('/')[-1],
+                    do_scores=not args.no_scores,
+                    do_fleets=not args.no_fleets, sql_path=args.db,
+                    batch_size=max(1, args.batch_size),
+                    out_dir=args.out_dir)
+    db.close_all()
+    print_report(res)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="event_sync",
+        description="sync an event in the Armada SQL DB with a saved T4"
+        + " page (use web_scraper.py --sync for live pages)")
+    add_arguments(parser)
+    main(parser.parse_args())
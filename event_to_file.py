@@ -11,8 +11,9 @@ done automatically, but in rare cases of ambiguity or typos the user will be
 asked to provide the correct, unambiguous name. Finally, once all primary keys
 have been found, the fleet can be inserted into the DB.
 
-Six tables are affected by this file:
+Seven tables are affected by this file:
     Events - add event info if the url is not yet in the DB
+    EventRevisions - bump the revision of the event (see event_sync)
     Scores - add results info if do_scores flag is True
     Fleets, Fleets_Ships, Fleets_Squadrons, Fleets_Upgrades - add fleet
         information if do_fleets flag is True.
@@ -20,10 +21,27 @@ Six tables are affected by this file:
 @author: alexe
 """
 import json
+import logging
 import os
-import fleet_parser
 import sqlite3
 import sql_queries
+import profiling
+import db
+
+# Parser warnings (LLM failures, lists that could not be read) go here
+LOG_PATH = 'logs/parser.log'
+
+# Send warnings to the parser log. Called by the command line tools rather
+# than at import, so importing this module has no side effects.
+def configure_logging(path=LOG_PATH):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    logging.basicConfig(
+        format = "{levelname}:{message}",
+        style = "{",
+        filename = path,
+        filemode = "a",
+        level = logging.WARNING)
 
 # Replace tabs, commas etc in player names with spaces
 def clean_name(name):
@@ -81,64 +99,17 @@ def get_obj_id(cursor, obj, name, faction_id=None, cost=None):
     # name must be lower case
     name = name.lower()
 
-    def get_id_from_name_faction_cost(name, faction_id, cost):
-        if not faction_id or not cost:
-            return None
-        try:
-            query_str = getattr(sql_queries,
-                                f'get_{obj}_from_name_faction_cost')
-        except AttributeError:
-            return None
-        return get_from_sql(cursor, query_str, (name, faction_id, cost))
-
-    def get_id_from_name_faction(name, faction_id):
-        if not faction_id:
-            return None
-        try:
-            query_str = getattr(sql_queries,
-                                f'get_{obj}_from_name_faction')
-        except AttributeError:
-            return None
-        return get_from_sql(cursor, query_str, (name, faction_id))
-
-    def get_id_from_name_cost(name, cost):
-        if not cost:
-            return None
-        try:
-            query_str = getattr(sql_queries,
-                                f'get_{obj}_from_name_cost')
-        except AttributeError:
-            return None
-        return get_from_sql(cursor, query_str, (name, cost))
-
-    def get_id_from_name(name):
-        try:
-            query_str = getattr(sql_queries,
-                                f'get_{obj}_from_name')
-        except AttributeError:
-            return None
-        return get_from_sql(cursor, query_str, (name,))
-
-    def get_id_from_faction_cost(faction_id, cost):
-        if not faction_id or not cost:
-            return None
-        try:
-            query_str = getattr(sql_queries,
-                                f'get_{obj}_from_faction_cost')
-        except AttributeError:
-            return None
-        return get_from_sql(cursor, query_str, (faction_id, cost))
-
-    # Start from most precise and work down
-    obj_id = get_id_from_name_faction_cost(name, faction_id, cost)
-    if not obj_id:
-        obj_id = get_id_from_name_faction(name, faction_id)
-    if not obj_id:
-        obj_id = get_id_from_name_cost(name, cost)
-    if not obj_id:
-        obj_id = get_id_from_name(name)
-    if not obj_id: # In case of misspelled name
-        obj_id = get_id_from_faction_cost(faction_id, cost)
+    # Start from most precise and work down. Lookup statements are resolved
+    # from sql_queries once, in db.statements.
+    values = {'name': name, 'faction_id': faction_id, 'cost': cost}
+    obj_id = None
+    for fields, query_str in db.statements.get(obj, []):
+        params = tuple(values[field] for field in fields)
+        if not all(params):
+            continue
+        obj_id = get_from_sql(cursor, query_str, params)
+        if obj_id:
+            break
 
     if not obj_id or len(obj_id) == 0: # No matches found, check with user
         print(f'''Failed to find ID for {obj} with name: "{name}",
@@ -221,6 +192,64 @@ def apply_fleet_cleaning(cursor, fleet):
         fleet['commander'] = commander
     return fleet
 
+# Add a cleaned fleet (all ships, upgrades and squadrons have IDs) to the
+# Fleets, Fleets_Ships, Fleets_Upgrades and Fleets_Squadrons tables.
+# Returns the new fleet ID, or None if the insert failed.
+def insert_fleet(conn, fleet, player, ev_id):
+    cursor = conn.cursor()
+
+    insert_fleet_str = """
+    INSERT INTO Fleets (player, event_id, faction_id) VALUES (?, ?, ?)
+    """
+    insert_ship_str = """
+    INSERT INTO Fleets_Ships (fleet_id, ship_id) VALUES (?, ?)
+    """
+    insert_upgrades_str = """
+    INSERT INTO Fleets_Upgrades (upgrade_id, fleet_ship_id) VALUES (?, ?)
+    """
+    insert_squadrons_str = """
+    INSERT INTO Fleets_Squadrons (fleet_id, squadron_id, count)
+    VALUES (?, ?, ?)
+    """
+
+    # The commander is not stored in Fleets, it is recovered from the
+    # upgrades on the flagship when building the summary views.
+    faction_id = fleet.get('faction_id', None)
+    fleet_values = (player, ev_id, faction_id,)
+    cursor.execute(insert_fleet_str, fleet_values)
+
+    #Get the newly generated id from Fleets
+    fleet_id = get_last_primary_key(cursor)
+    if not fleet_id:
+        conn.rollback()
+        return None
+
+    for ship in fleet['ships']:
+        ship_values = (fleet_id, ship['id'],)
+        cursor.execute(insert_ship_str, ship_values)
+
+        fleet_ship_id = get_last_primary_key(cursor)
+        if not fleet_ship_id:
+            continue
+
+        upgrade_values = [(upgrade['id'], fleet_ship_id)
+                          for upgrade in ship['upgrades']]
+        cursor.executemany(insert_upgrades_str, upgrade_values)
+
+    squad_values = [(fleet_id, squad['id'], squad.get('count', 1))
+                    for squad in fleet['squadrons']]
+    cursor.executemany(insert_squadrons_str, squad_values)
+    conn.commit()
+    return fleet_id
+
+# Read the fleet lists tab into (player name, raw list text) pairs
+def read_fleet_lists(fleets):
+    res = []
+    for child in fleets.children:
+        divs = child.find_all('div')
+        res.append((clean_name(divs[0].span.span.text), divs[1].pre.text))
+    return res
+
 # Parse fleet lists
 # - Fleet lists are read as text strings with no standard format
 # - Many, but not all, players use an online fleet builder with an export
@@ -234,110 +263,108 @@ def apply_fleet_cleaning(cursor, fleet):
 # include it.
 # - Lists may contain a header with a fleet name, faction, commander,
 # total points cost, objectives, etc.
-def get_fleet_lists(fleets, conn, ev_id):
+def get_fleet_lists(fleets, conn, ev_id, batch_size=1, backend=None):
 
     cursor = conn.cursor()
 
-    for child in fleets.children:
-        divs = child.find_all('div')
-        name = clean_name(divs[0].span.span.text)
+    # Collect the lists that are not yet in the database, so they can be sent
+    # to the LLM batch_size lists at a time.
+    pending = []
+    for name, raw_fleet in read_fleet_lists(fleets):
         # Check if this fleet is already in the database. Don't duplicate
         if len(name) > 0 and get_from_sql(cursor,
                                 sql_queries.get_fleet_from_event_player,
                                 (ev_id, name)):
             continue
-        print(f"parsing fleet list of {name}")
-        raw_fleet = divs[1].pre.text
-        # Fleet list naturally represented in dictionary format. Start here
-        # and then split into csv files
-        fleet = fleet_parser.parse_fleet(raw_fleet)
-        if not fleet:
-            # store info for debugging
-            filename = f'logs/{ev_id}_{"_".join(name.split())}.json'
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
-            with open(filename, 'w') as f:
-                f.write(json.dumps(fleet, indent=2))
-
-            continue
+        pending.append((name, raw_fleet))
 
-        # Fleet list has been converted into a dictionary, but values may
-        # not be suitable for adding to database. Some data cleaning needs
-        # to be done first.
-        # Do not add fleet to database until cleaning steps are done.
-        fleet = apply_fleet_cleaning(cursor, fleet)
-
-        # Now check that all values have been properly validated and, if so,
-        # add the fleet list to the database
-        insert_fleet_str = """
-        INSERT INTO Fleets (player, event_id, faction_id, commander)
-        VALUES (?, ?, ?, ?)
-        """
-        insert_ship_str = """
-        INSERT INTO Fleets_Ships (fleet_id, ship_id) VALUES (?, ?)
-        """
-        insert_upgrades_str = """
-        INSERT INTO Fleets_Upgrades (upgrade_id, fleet_ship_id)
-        VALUES (?, ?, ?)
-        """
-        insert_squadrons_str = """
-        INSERT INTO Fleets_Squadrons (fleet_id, squadron_id, count)
-        VALUES (?, ?, ?)
-        """
-
-        faction_id = fleet.get('faction_id', None)
-        commander = fleet.get('commander', None)
-        fleet_values = (name, ev_id, faction_id, commander,)
-        cursor.execute(insert_fleet_str, fleet_values)
-        conn.commit()
+    return add_fleet_lists(pending, conn, ev_id, batch_size, backend)
 
-        #Get the newly generated id from Fleets
-        fleet_id = get_last_primary_key(cursor)
-        if not fleet_id:
-            break
+# Parse (player name, raw list text) pairs and add them to the DB. Returns a
+# dictionary of player name to new fleet ID for the lists that were added.
+def add_fleet_lists(pending, conn, ev_id, batch_size=1, backend=None):
+    # Imported here so that scores-only runs and DB tools that use this
+    # module do not load the parser and its LLM backends
+    import fleet_parser
 
-        for ship in fleet['ships']:
-            ship_values = (fleet_id, ship['id'],)
-            cursor.execute(insert_ship_str, ship_values)
-            conn.commit()
+    cursor = conn.cursor()
+    added = {}
+
+    # Hand the parser enough lists to keep every backend request slot busy
+    # (batch_size lists per request), and insert each group as it comes back.
+    pool = fleet_parser.get_pool(backend)
+    group_size = batch_size * max(1, pool.max_concurrency)
+    for ii in range(0, len(pending), group_size):
+        batch = pending[ii:ii+group_size]
+        print(f"parsing fleet lists of {', '.join(n for n, _ in batch)}")
+        # Fleet list naturally represented in dictionary format. Start here
+        # and then split into csv files
+        with profiling.span('parse_fleet'):
+            if len(batch) > 1:
+                parsed = fleet_parser.parse_fleets(
+                    [raw_fleet for _, raw_fleet in batch],
+                    batch_size=batch_size, backend=pool)
+            else:
+                parsed = [fleet_parser.parse_fleet(batch[0][1],
+                                                   backend=pool)]
+
+        for (name, raw_fleet), fleet in zip(batch, parsed):
+            if not fleet:
+                # store info for debugging
+                filename = f'logs/{ev_id}_{"_".join(name.split())}.json'
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                with open(filename, 'w') as f:
+                    f.write(json.dumps({'player': name,
+                                        'raw_fleet': raw_fleet}, indent=2))
 
-            fleet_ship_id = get_last_primary_key(cursor)
-            if not fleet_ship_id:
                 continue
 
-            for upgrade in ship['upgrades']:
-                upgrade_values = (upgrade['id'], fleet_ship_id)
-                cursor.execute(insert_upgrades_str, upgrade_values)
-
-        for squad in fleet['squadrons']:
-            count = squad.get('count', 1)
-            squad_values = (fleet_id, squad['id'], count)
-            cursor.execute(insert_squadrons_str, squad_values)
-        conn.commit()
+            # Fleet list has been converted into a dictionary, but values may
+            # not be suitable for adding to database. Some data cleaning needs
+            # to be done first.
+            # Do not add fleet to database until cleaning steps are done.
+            with profiling.span('apply_fleet_cleaning'):
+                fleet = apply_fleet_cleaning(cursor, fleet)
+
+            # Now check that all values have been properly validated and, if
+            # so, add the fleet list to the database
+            with profiling.span('insert_fleet'):
+                fleet_id = insert_fleet(conn, fleet, name, ev_id)
+            if not fleet_id:
+                return added
+            added[name] = fleet_id
+    return added
 
 # Parse results information
 # Results rows will either contain six pieces of information, or four in case
 # of a bye. TP information is mostly redundant with points but needs to be
 # saved because the second player wins ties, and second player info is not
 # stored on T4.
-def get_scores(rounds, conn, ev_id):
+# Returns one list per round of Scores rows without the event ID:
+# (round, player, points, tournament_points, opponent)
+def read_rounds(rounds):
 
-    cursor = conn.cursor()
-    insert_str = 'INSERT INTO Scores VALUES (?, ?, ?, ?, ?, ?)'
-    insert_values = []
+    res = []
     rounds = rounds.find_all('div', {'role': 'tabpanel'})
     print(f'found {len(rounds)} rounds')
     for ii, rnd in enumerate(rounds):
         rows = rnd.find_all('div', {'class': 'col-11'})
         print(f'round {ii+1}: found {len(rows)} rows')
+        values = []
         for row in rows:
             info = row.find_all('span')
             if len(info) == 6:
+                # While a round is being played the pairings are shown
+                # without scores. Skip those games until results are in.
+                try:
+                    ptsA = int(info[1].text)
+                    tpA = int(info[2].text)
+                    ptsB = int(info[4].text)
+                    tpB = int(info[5].text)
+                except ValueError:
+                    continue
                 playerA = clean_name(info[0].text)
-                ptsA = int(info[1].text)
-                tpA = int(info[2].text)
                 playerB = clean_name(info[3].text)
-                ptsB = int(info[4].text)
-                tpB = int(info[5].text)
             elif len(info) == 4:
                 if info[0].text == 'Bye':
                     playerA = None
@@ -359,54 +386,88 @@ def get_scores(rounds, conn, ev_id):
                 continue
 
             if playerA:
-                insert_values += [(ev_id, ii+1, playerA, ptsA, tpA, playerB)]
+                values += [(ii+1, playerA, ptsA, tpA, playerB)]
             if playerB:
-                insert_values += [(ev_id, ii+1, playerB, ptsB, tpB, playerA)]
+                values += [(ii+1, playerB, ptsB, tpB, playerA)]
+        res.append(values)
+    return res
 
-    cursor.executemany(insert_str, insert_values)
+insert_scores_str = 'INSERT INTO Scores VALUES (?, ?, ?, ?, ?, ?)'
+
+def get_scores(rounds, conn, ev_id):
+
+    cursor = conn.cursor()
+    insert_values = [(ev_id,) + row for rows in read_rounds(rounds)
+                     for row in rows]
+    cursor.executemany(insert_scores_str, insert_values)
     conn.commit()
 
-# Main function to get (or create) event_id and then call results and fleets
-# parsers.
-def parse_site(soup, url, name, do_scores=True, do_fleets=True):
-    sql_path = 'data/armada_events.sql' #TODO: make input param?
-    conn = sqlite3.connect(sql_path)
+# Get the ID of the event at url, adding it to the Events table (with date and
+# region from the page) if it is not in the DB yet.
+def get_event(soup, conn, url, name):
     cursor = conn.cursor()
 
     # Check if event already in DB. If not, add to Events table
     ev_id = get_one_from_sql(cursor, sql_queries.get_event_from_url, (url,))
     if ev_id:
         print(f'Found matching event with ID: {ev_id}')
-    else:
-        select_str = 'div.pt-3.small.row div.col:has(> i.bi.bi-calendar3)'
-        ev_date = soup.select_one(select_str).text
-        ev_date = ev_date.replace(',','').split()[1:]
-        month = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
-                 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-        ev_mon = month.index(ev_date[1])
-        ev_date = f'{ev_date[2]}-{ev_mon:02}-{ev_date[0]:02}'
-
-        select_str = 'div.pt-3.small.row div.col:has(> i.bi.bi-globe)'
-        ev_region = soup.select_one(select_str).text
-        print(f'date: {ev_date}, region: {ev_region}')
-
-        insert_str = 'INSERT INTO Events (name, url, date, region) ' \
-            + 'VALUES (?, ?, ?, ?)'
-        insert_values = (name, url, ev_date, ev_region,)
-
-        cursor.execute(insert_str, insert_values)
-        conn.commit()
+        return ev_id
+
+    select_str = 'div.pt-3.small.row div.col:has(> i.bi.bi-calendar3)'
+    ev_date = soup.select_one(select_str).text
+    ev_date = ev_date.replace(',','').split()[1:]
+    month = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+             'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+    ev_mon = month.index(ev_date[1]) + 1
+    ev_date = f'{ev_date[2]}-{ev_mon:02}-{int(ev_date[0]):02}'
+
+    select_str = 'div.pt-3.small.row div.col:has(> i.bi.bi-globe)'
+    ev_region = soup.select_one(select_str).text
+    print(f'date: {ev_date}, region: {ev_region}')
+
+    insert_str = 'INSERT INTO Events (name, url, date, region) ' \
+        + 'VALUES (?, ?, ?, ?)'
+    insert_values = (name, url, ev_date, ev_region,)
+
+    cursor.execute(insert_str, insert_values)
+    conn.commit()
+
+    ev_id = get_last_primary_key(cursor)
+    print(f'Added new event with ID: {ev_id}')
+    return ev_id
 
-        ev_id = get_last_primary_key(cursor)
-        print(f'Added new event with ID: {ev_id}')
+def get_revision(conn, ev_id):
+    res = conn.execute(sql_queries.get_event_revision, (ev_id,)).fetchone()
+    return res[0] if res else 0
+
+# Mark everything derived from an event (csv exports, cached query results,
+# mined itemsets, fitted models) as stale by bumping its revision. Returns the
+# new revision.
+def invalidate(conn, ev_id):
+    conn.execute(sql_queries.bump_event_revision, (ev_id,))
+    conn.commit()
+    return get_revision(conn, ev_id)
+
+# Main function to get (or create) event_id and then call results and fleets
+# parsers.
+def parse_site(soup, url, name, do_scores=True, do_fleets=True,
+               sql_path=db.DEFAULT_PATH, batch_size=1, backend=None):
+    conn = db.get_connection(sql_path)
+    ev_id = get_event(soup, conn, url, name)
 
     # add results
     if do_scores:
         rounds = soup.find(id='uncontrolled-tab-example-tabpane-rounds')
-        get_scores(rounds, conn, ev_id)
+        with profiling.span('get_scores'):
+            get_scores(rounds, conn, ev_id)
         conn.commit()
 
     # add fleets
     if do_fleets:
         fleets = soup.find(id='uncontrolled-tab-example-tabpane-lists')
-        get_fleet_lists(fleets, conn, ev_id)
\ No newline at end of file
+        with profiling.span('get_fleet_lists'):
+            get_fleet_lists(fleets, conn, ev_id, batch_size=batch_size,
+                            backend=backend)
+
+    if do_scores or do_fleets:
+        invalidate(conn, ev_id)
\ No newline at end of file
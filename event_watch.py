@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Event Watch
+
+Follow an event while it is being played. The event page is polled on a
+schedule and whenever it changes, newly posted (or corrected) rounds are added
+to Scores through event_sync, so only the rounds that changed are written.
+Late fleet lists are picked up the same way.
+
+Polling is cheap when nothing has changed: pages fetched over HTTP are
+requested with If-None-Match / If-Modified-Since, so an unchanged page costs a
+304 response, and any page whose content hash matches the last one is not
+parsed again. Each unchanged poll doubles the wait before the next one (up to
+max_interval), and the wait drops back to interval as soon as something
+changes. Failed fetches back off the same way.
+
+Standings are kept up to date incrementally. Standings holds running totals
+per player (MoV, TP, TP variance terms and opponents), so a new round only
+touches the rows of that round. Strength of schedule is worked out from the
+totals when asked for. The values follow the definitions in the Fleet_Summary
+view (see make_views), and the event's rows in an exported fleet_summary.csv
+are updated in place, so the dashboard data stays current without
+re-exporting everything. When the event's fleets change, all of its rows in
+the exported csv files are rewritten (make_views.refresh_event).
+
+The time taken by every step of each refresh (fetch, parse, ingest, summary
+update) is reported per cycle.
+
+For live T4 pages the page has to be rendered by a browser first; see
+web_scraper --watch. The HTTPFetcher here works with any server that returns
+the rendered page, such as benchmarks.replay for offline testing.
+
+@author: alexe
+"""
+import csv
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+import event_to_file
+import event_sync
+import make_views
+import db
+
+# Fleet_Summary columns that depend on results
+standings_columns = ['mov', 'tp', 'sos', 'avg_tp', 'var_tp']
+
+# Conditional HTTP GET of a page. Returns the page text, or None if the
+# server says it has not changed since the last fetch.
+class HTTPFetcher:
+    def __init__(self, url, timeout=30.):
+        self.url = url
+        self.timeout = timeout
+        self.etag = None
+        self.last_modified = None
+
+    def fetch(self):
+        request = urllib.request.Request(self.url)
+        if self.etag:
+            request.add_header('If-None-Match', self.etag)
+        if self.last_modified:
+            request.add_header('If-Modified-Since', self.last_modified)
+        try:
+            with urllib.request.urlopen(request,
+                                        timeout=self.timeout) as response:
+                self.etag = response.headers.get('ETag')
+                self.last_modified = response.headers.get('Last-Modified')
+                charset = response.headers.get_content_charset() or 'utf-8'
+                return response.read().decode(charset)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+
+    def close(self):
+        pass
+
+# Running per-player results for one event
+class PlayerTotals:
+    __slots__ = ('games', 'tp', 'mov', 'played', 'played_tp',
+                 'played_tp_sq', 'opponents')
+
+    def __init__(self):
+        self.games = 0
+        self.tp = 0
+        self.mov = 0
+        # Games against an opponent (not byes), which variance and SoS use
+        self.played = 0
+        self.played_tp = 0
+        self.played_tp_sq = 0
+        self.opponents = Counter()
+
+# Standings of one event, updated a round at a time. Rounds are given as
+# Scores rows without the event ID, as from event_to_file.read_rounds.
+class Standings:
+    def __init__(self):
+        self.rounds = {}
+        self.players = {}
+
+    # Add or subtract (sign=-1) the games of one round
+    def _apply(self, rows, sign):
+        points = {row[1]: row[2] for row in rows}
+        for _, player, pts, tp, opponent in rows:
+            totals = self.players.setdefault(player, PlayerTotals())
+            if opponent is None or opponent not in points:
+                mov = 140
+            else:
+                mov = max(pts - points[opponent], 0)
+            totals.games += sign
+            totals.tp += sign * tp
+            totals.mov += sign * mov
+            if opponent is not None:
+                totals.played += sign
+                totals.played_tp += sign * tp
+                totals.played_tp_sq += sign * tp * tp
+                totals.opponents[opponent] += sign
+            if totals.games == 0:
+                del self.players[player]
+
+    def set_round(self, rnd, rows):
+        self.remove_round(rnd)
+        self.rounds[rnd] = rows
+        self._apply(rows, 1)
+
+    def remove_round(self, rnd):
+        if rnd in self.rounds:
+            self._apply(self.rounds.pop(rnd), -1)
+
+    # Standings of every player with at least one game against an opponent,
+    # as {player: {'mov', 'tp', 'sos', 'avg_tp', 'var_tp'}}
+    def table(self):
+        avg_tp = {player: totals.tp / totals.games
+                  for player, totals in self.players.items()}
+        res = {}
+        for player, totals in self.players.items():
+            opponents = {opp: n for opp, n in totals.opponents.items()
+                         if n > 0 and opp in avg_tp}
+            played = sum(opponents.values())
+            if not played:
+                continue
+            mean = avg_tp[player]
+            # Squared deviations of the played games from the mean over all
+            # games, from the running sums
+            sq_dev = (totals.played_tp_sq - 2 * mean * totals.played_tp
+                      + totals.played * mean * mean)
+            res[player] = {
+                'mov': totals.mov,
+                'tp': totals.tp,
+                'sos': round(sum(avg_tp[opp] * n
+                                 for opp, n in opponents.items()) / played, 2),
+                'avg_tp': round(mean, 2),
+                'var_tp': round(sq_dev / (played - 1), 3)
+                          if played > 1 else None,
+                }
+        return res
+
+    # Players in ranking order: tournament points, then MoV, then SoS
+    def ranking(self):
+        table = self.table()
+        return sorted(table.items(), key=lambda kv: (-kv[1]['tp'],
+                                                     -kv[1]['mov'],
+                                                     -kv[1]['sos']))
+
+def load_standings(conn, ev_id):
+    standings = Standings()
+    rows = conn.execute('SELECT round, player, points, tournament_points,'
+                        + ' opponent FROM Scores WHERE event_id = ?',
+                        (ev_id,)).fetchall()
+    rounds = {}
+    for row in rows:
+        rounds.setdefault(row[0], []).append(tuple(row))
+    for rnd, rnd_rows in rounds.items():
+        standings.set_round(rnd, rnd_rows)
+    return standings
+
+def csv_value(value):
+    return '' if value is None else str(value)
+
+# Update the rows of one event in an exported fleet_summary.csv with the
+# current standings. The other columns do not depend on results, so they are
+# only re-read from the Fleet_Summary view if the event has fleets that are
+# not in the file yet. Returns False if there is no file to update.
+def update_fleet_summary(conn, ev_id, standings, out_dir='data'):
+    path = os.path.join(out_dir, 'fleet_summary.csv')
+    if not os.path.isfile(path):
+        return False
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        fields = reader.fieldnames
+        rows = list(reader)
+
+    key = str(ev_id)
+    event_rows = [row for row in rows if row['event_id'] == key]
+    num_fleets = conn.execute('SELECT COUNT(*) FROM Fleets WHERE event_id = ?',
+                              (ev_id,)).fetchone()[0]
+    if len(event_rows) != num_fleets:
+        cursor = conn.execute('SELECT * FROM Fleet_Summary WHERE event_id = ?',
+                              (ev_id,))
+        names = [d[0] for d in cursor.description]
+        event_rows = [{name: csv_value(value)
+                       for name, value in zip(names, row)}
+                      for row in cursor.fetchall()]
+        rows = [row for row in rows if row['event_id'] != key] + event_rows
+
+    table = standings.table()
+    for row in event_rows:
+        values = table.get(row['player'], {})
+        for column in standings_columns:
+            row[column] = csv_value(values.get(column))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, path)
+    return True
+
+# Poll an event page and keep the DB (and summary csv in out_dir) up to date.
+# fetcher has a fetch() method returning the page HTML, or None if unchanged.
+# Runs until max_cycles polls have been made (forever if None). on_cycle is
+# called with the report of every cycle; returning False stops watching.
+def watch(fetcher, url, name, sql_path=db.DEFAULT_PATH, interval=60.,
+          max_interval=600., backoff=2., max_cycles=None, do_fleets=True,
+          out_dir='data', batch_size=1, backend=None, on_cycle=None,
+          sleep=time.sleep):
+    from bs4 import BeautifulSoup
+    conn = db.get_connection(sql_path)
+    ev_id = None
+    standings = None
+    last_digest = None
+    delay = interval
+    cycle = 0
+    while max_cycles is None or cycle < max_cycles:
+        cycle += 1
+        report = {'cycle': cycle, 'status': 'unchanged'}
+        t0 = time.perf_counter()
+        try:
+            page = fetcher.fetch()
+        except OSError as e:
+            logging.warning(f'Fetching {url} failed: {e}')
+            report['status'] = 'error'
+            report['error'] = str(e)
+            page = None
+        t_fetch = time.perf_counter()
+        report['fetch_s'] = round(t_fetch - t0, 4)
+
+        digest = hashlib.sha1(page.encode('utf-8')).hexdigest() \
+            if page is not None else None
+        if page is not None and digest != last_digest:
+            last_digest = digest
+            soup = BeautifulSoup(page, 'html5lib')
+            t_parse = time.perf_counter()
+            report['parse_s'] = round(t_parse - t_fetch, 4)
+
+            if ev_id is None:
+                ev_id = event_to_file.get_event(soup, conn, url, name)
+                standings = load_standings(conn, ev_id)
+            report['event_id'] = ev_id
+            rounds = soup.find(id='uncontrolled-tab-example-tabpane-rounds')
+            changed = []
+            if rounds and rounds.find('div', {'role': 'tabpanel'}):
+                res = event_sync.sync_scores(rounds, conn, ev_id)
+                report['rounds'] = res
+                changed = res['added'] + res['changed'] + res['removed']
+            fleets = soup.find(id='uncontrolled-tab-example-tabpane-lists')
+            fleet_changes = 0
+            if do_fleets and fleets and fleets.find('div'):
+                res = event_sync.sync_fleets(fleets, conn, ev_id, batch_size,
+                                             backend)
+                report['fleets'] = res
+                fleet_changes = len(res['added'] + res['changed']
+                                    + res['removed'])
+            t_ingest = time.perf_counter()
+            report['ingest_s'] = round(t_ingest - t_parse, 4)
+
+            if changed or fleet_changes:
+                report['status'] = 'updated'
+                report['revision'] = event_to_file.invalidate(conn, ev_id)
+                for rnd in changed:
+                    rows = conn.execute(event_sync.get_round_scores,
+                                        (ev_id, rnd)).fetchall()
+                    if rows:
+                        standings.set_round(rnd, [tuple(r) for r in rows])
+                    else:
+                        standings.remove_round(rnd)
+                try:
+                    # Fleets changed: the event's rows in every export are
+                    # out of date, not only the standings
+                    if fleet_changes:
+                        make_views.refresh_event(conn, ev_id,
+                                                 out_dir=out_dir)
+                    update_fleet_summary(conn, ev_id, standings, out_dir)
+                except sqlite3.OperationalError as e:
+                    logging.warning(f'Could not update fleet summary: {e}')
+                report['summary_s'] = round(time.perf_counter() - t_ingest,
+                                            4)
+
+        report['total_s'] = round(time.perf_counter() - t0, 4)
+        if report['status'] == 'updated':
+            delay = interval
+        else:
+            delay = min(delay * backoff, max_interval)
+        report['next_poll_s'] = delay
+        print_cycle(report)
+        if on_cycle is not None and on_cycle(report) is False:
+            break
+        if max_cycles is None or cycle < max_cycles:
+            sleep(delay)
+    return standings
+
+def print_cycle(report):
+    line = f'cycle {report["cycle"]}: {report["status"]}'
+    if 'rounds' in report:
+        res = report['rounds']
+        new = res['added'] + res['changed']
+        if new:
+            line += f', rounds {new}'
+    if 'fleets' in report:
+        res = report['fleets']
+        num = len(res['added'] + res['changed'])
+        if num:
+            line += f', {num} fleets'
+    line += f' ({report["total_s"]:.3f}s, next poll in' \
+        + f' {report["next_poll_s"]:.0f}s)'
+    print(line)
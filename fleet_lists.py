@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Fleet Lists
+
+Rebuild complete fleet lists from the DB, for many fleets at once. Fleets can
+be selected by id, by event or all together, and come back in the same
+format as fleet_parser output (with component IDs filled in):
+    {'id', 'event_id', 'player', 'faction', 'commander',
+     'ships': [{'id', 'name', 'base_cost',
+                'upgrades': [{'id', 'name', 'cost'}]}],
+     'squadrons': [{'id', 'name', 'cost', 'count'}]}
+
+sql_queries.get_fleet_list does one fleet per call. Here the canonical names
+(and costs) of the whole catalog are read once into a Names lookup, which is
+kept until the DB file changes (get_names), then each
+of the fleet tables is read in a single ordered pass for all the selected
+fleets and the rows are grouped into fleets in Python. Costs are those of the
+catalog version in effect at the fleet's event, if catalog versions have been
+imported. Exporting an event takes five queries however many fleets it has.
+
+Usage:
+    python fleet_lists.py --event 3 -o event_3.json
+    python fleet_lists.py --fleet 12 40
+
+@author: alexe
+"""
+import argparse
+import json
+import sql_queries
+import db
+
+# Display name and cost of every component, plus the commander upgrades
+class Names:
+    def __init__(self, conn):
+        self.ships = {ship_id: (name, cost) for ship_id, name, cost
+                      in conn.execute(sql_queries.get_ship_display_names)}
+        self.upgrades = {}
+        self.commanders = set()
+        for upgrade_id, name, cost, slot_id in conn.execute(
+                sql_queries.get_upgrade_display_names):
+            self.upgrades[upgrade_id] = (name, cost)
+            if slot_id == 1:
+                self.commanders.add(upgrade_id)
+        self.squadrons = {
+            squad_id: (name, cost) for squad_id, name, cost
+            in conn.execute(sql_queries.get_squadron_display_names)}
+
+# Names lookups by DB file, with the file generation they were read at
+_names = {}
+
+# Names lookup for the DB of a connection, read again only after the DB file
+# has changed. In-memory DBs are not cached.
+def get_names(conn):
+    path = conn.execute('PRAGMA database_list').fetchone()[2]
+    if not path:
+        return Names(conn)
+    gen = db.generation(path)
+    cached = _names.get(path)
+    if cached is not None and cached[0] == gen:
+        return cached[1]
+    names = Names(conn)
+    _names[path] = (gen, names)
+    return names
+
+# Fleet selection: WHERE clause on Fleets (as fl) and its parameters
+def fleet_filter(fleet_ids=None, event_id=None):
+    if fleet_ids is not None:
+        return ('fl.id IN (SELECT value FROM json_each(?))',
+                (json.dumps([int(ii) for ii in fleet_ids]),))
+    if event_id is not None:
+        return 'fl.event_id = ?', (event_id,)
+    return '1', ()
+
+# Rebuild the selected fleets (fleet_ids, else all fleets of event_id, else
+# every fleet). Returns {fleet_id: fleet} in fleet id order; ids that are not
+# in the DB are left out.
+def get_fleets(conn, fleet_ids=None, event_id=None, names=None):
+    names = names or get_names(conn)
+    where, params = fleet_filter(fleet_ids, event_id)
+    # Costs of the catalog version in effect at each event, where catalog
+    # versions have been imported (see catalog_import)
+    costs = {(ev_id, kind, obj_id): cost for ev_id, kind, obj_id, cost
+             in conn.execute(sql_queries.get_event_costs_where.format(
+                 where=where), params)}
+
+    fleets = {}
+    for fleet_id, ev_id, player, faction in conn.execute(
+            sql_queries.get_fleets_where.format(where=where), params):
+        fleets[fleet_id] = {'id': fleet_id, 'event_id': ev_id,
+                            'player': player, 'faction': faction,
+                            'commander': None, 'ships': [], 'squadrons': []}
+
+    # Ships keyed by Fleets_Ships id, so upgrades can be added to them
+    ships = {}
+    for fleet_id, fleet_ship_id, ship_id in conn.execute(
+            sql_queries.get_fleets_ships_where.format(where=where), params):
+        name, cost = names.ships.get(ship_id, (None, None))
+        cost = costs.get((fleets[fleet_id]['event_id'], 'ship', ship_id),
+                         cost)
+        ship = {'id': ship_id, 'name': name, 'base_cost': cost,
+                'upgrades': []}
+        ships[fleet_ship_id] = (fleet_id, ship)
+        fleets[fleet_id]['ships'].append(ship)
+
+    for fleet_ship_id, upgrade_id in conn.execute(
+            sql_queries.get_fleets_upgrades_where.format(where=where), params):
+        fleet_id, ship = ships[fleet_ship_id]
+        name, cost = names.upgrades.get(upgrade_id, (None, None))
+        cost = costs.get((fleets[fleet_id]['event_id'], 'upgrade',
+                          upgrade_id), cost)
+        ship['upgrades'].append({'id': upgrade_id, 'name': name,
+                                 'cost': cost})
+        if upgrade_id in names.commanders:
+            fleets[fleet_id]['commander'] = name
+
+    for fleet_id, squad_id, count in conn.execute(
+            sql_queries.get_fleets_squadrons_where.format(where=where),
+            params):
+        name, cost = names.squadrons.get(squad_id, (None, None))
+        cost = costs.get((fleets[fleet_id]['event_id'], 'squadron',
+                          squad_id), cost)
+        fleets[fleet_id]['squadrons'].append({'id': squad_id, 'name': name,
+                                              'cost': cost, 'count': count})
+    return fleets
+
+def get_fleet(conn, fleet_id, names=None):
+    return get_fleets(conn, [fleet_id], names=names).get(fleet_id)
+
+# Cost as written in fleet_text. Components that are not in the catalog
+# (e.g. unknown ids in an archive) have no cost; they are written as '?' and
+# count as 0 in the totals.
+def cost_text(cost, count=1):
+    return '?' if cost is None else count * cost
+
+# Write a rebuilt fleet as text, in the style of a fleet builder export
+def fleet_text(fleet):
+    lines = [f'Name: {fleet["player"]}', f'Faction: {fleet["faction"]}']
+    if fleet['commander']:
+        lines.append(f'Commander: {fleet["commander"]}')
+    lines.append('')
+    for ship in fleet['ships']:
+        lines.append(f'{ship["name"]} ({cost_text(ship["base_cost"])})')
+        for upgrade in ship['upgrades']:
+            lines.append(f'• {upgrade["name"]}'
+                         + f' ({cost_text(upgrade["cost"])})')
+        total = (ship['base_cost'] or 0) \
+            + sum(u['cost'] or 0 for u in ship['upgrades'])
+        lines.append(f'= {total} Points')
+        lines.append('')
+    if fleet['squadrons']:
+        lines.append('Squadrons:')
+        for squad in fleet['squadrons']:
+            lines.append(f'• {squad["count"]} x {squad["name"]}'
+                         + f' ({cost_text(squad["cost"], squad["count"])})')
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="fleet_lists",
+        description="rebuild fleet lists from the Armada SQL DB")
+    parser.add_argument("--db", type=str, default=db.DEFAULT_PATH)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--event", type=int, help="all fleets of an event")
+    group.add_argument("--fleet", type=int, nargs='+', help="fleet IDs")
+    parser.add_argument("-o", "--output", type=str,
+                        help="write the fleets to a JSON file instead of"
+                        + " printing them as text")
+    args = parser.parse_args()
+
+    try:
+        conn = db.connect_readonly(args.db)
+    except ValueError as e:
+        parser.error(str(e))
+    fleets = get_fleets(conn, fleet_ids=args.fleet, event_id=args.event)
+    conn.close()
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(list(fleets.values()), f, indent=2)
+        print(f'{len(fleets)} fleets written to {args.output}')
+    else:
+        print('\n\n'.join(fleet_text(fleet) for fleet in fleets.values()))
@@ -12,20 +12,19 @@ tournaments without hitting the limit, and means the largest tournaments take
 around 10 minutes to parse. I put my API key in a config file not included in
 the github repo, you will need to replace this with your own API key.
 
+Other models can be used through llm_backends (HuggingFace, a local llama.cpp
+model, or an offline stub). Pass backend= to parse_fleet/parse_fleets, or
+call set_backends to change the default. With several backends, requests fail
+over to the next one when a provider throttles or errors.
+
 @author: alexe
 """
 import logging
-logging.basicConfig(
-    format = "{levelname}:{message}",
-    style = "{",
-    filename = "logs/parser.log",
-    filemode = "a",
-    level = logging.WARNING)
-import json
-import time
-from huggingface_hub import InferenceClient
-from google import genai
-from config import GEMINI_API_KEY, HUGGINGFACE_API_KEY
+import copy
+import re
+from concurrent.futures import ThreadPoolExecutor
+import llm_backends
+import json_repair
 
 
 # Fleet parsers provide methods to convert text string into dictionary with
@@ -51,74 +50,129 @@ json_format = """
   }}
 """
 
-# Make sure that all required fields are present in the JSON string
+# The same format as a response schema, for structured (JSON mode) output.
+# Uses the OpenAPI subset accepted by the Gemini API.
+fleet_schema = {
+    'type': 'OBJECT',
+    'properties': {
+        'faction': {'type': 'STRING'},
+        'commander': {'type': 'STRING'},
+        'ships': {'type': 'ARRAY', 'items': {
+            'type': 'OBJECT',
+            'properties': {
+                'name': {'type': 'STRING'},
+                'base_cost': {'type': 'INTEGER'},
+                'total_cost': {'type': 'INTEGER'},
+                'upgrades': {'type': 'ARRAY', 'items': {
+                    'type': 'OBJECT',
+                    'properties': {
+                        'name': {'type': 'STRING'},
+                        'cost': {'type': 'INTEGER'},
+                        },
+                    'required': ['name'],
+                    }},
+                },
+            'required': ['name', 'upgrades'],
+            }},
+        'squadrons': {'type': 'ARRAY', 'items': {
+            'type': 'OBJECT',
+            'properties': {
+                'name': {'type': 'STRING'},
+                'cost': {'type': 'INTEGER'},
+                'count': {'type': 'INTEGER'},
+                },
+            'required': ['name'],
+            }},
+        },
+    'required': ['ships', 'squadrons'],
+    }
+
+# Batched responses are a list of fleets, each tagged with the number of the
+# input fleet it came from so results can be matched up even if the model
+# skips or reorders fleets.
+batch_schema = {
+    'type': 'ARRAY',
+    'items': {
+        'type': 'OBJECT',
+        'properties': {
+            'index': {'type': 'INTEGER'},
+            'fleet': fleet_schema,
+            },
+        'required': ['index', 'fleet'],
+        },
+    }
+
+# Marks the start of each fleet list in a batched prompt
+FLEET_DELIMITER = '### FLEET {index} ###'
+
+# Number of fleets sent per request when batching
+BATCH_SIZE = 8
+
+# Number of times a fleet is requested again after an unusable response
+MAX_RETRIES = 1
+
+# Validation uses the response schema, compiled once, plus a requirement that
+# every fleet has at least one ship.
+validation_schema = copy.deepcopy(fleet_schema)
+validation_schema['properties']['ships']['minItems'] = 1
+fleet_validator = json_repair.compile_schema(validation_schema)
+
+# Make sure that all required fields are present in the JSON string. An
+# already decoded dictionary (e.g. one fleet from a batched response) can be
+# passed instead of a string to skip straight to validation.
 def validate_json(llm_response):
-    lines = llm_response.splitlines()
-    res_json = None
+    if isinstance(llm_response, dict) or llm_response is None:
+        return validate_fleet(llm_response)
     # The expected format looks like:
     #   ```json
     #   {
     #       ...
     #   }
     #   ```
-    ii = 0
-    while ii < len(lines) and len(lines[ii]) > 0 \
-                               and "```" in lines[ii]:
-        ii += 1
-    jj = ii+1
-    while jj < len(lines) and not "```" in lines[jj]:
-        jj += 1
-    if ii < len(lines) and jj > ii:
-        try:
-            res_json = json.loads('\n'.join(lines[ii:jj]))
-        except json.decoder.JSONDecodeError as e:
-            logging.warning(f"JSONDecodeError on first pass:\n{e}")
-
-    # If first attempt fails, then try just looking for brackets
-    if not res_json:
-        ii = llm_response.index('{')
-        jj = llm_response.rindex('}')
-        if ii > 0 and jj > 0:
-            try:
-                res_json = json.loads(llm_response[ii:jj+1])
-            except json.decoder.JSONDecodeError as e:
-                logging.warning(f"JSONDecodeError on second pass:\n{e}")
-
-    # Give up after second attempt
-    if not res_json:
+    # but there may be other text around the JSON, and the JSON itself may
+    # need some repair (trailing commas, unquoted keys, missing brackets).
+    res_json = json_repair.loads(llm_response, start_chars='{')
+    if res_json is None:
+        logging.warning("No usable JSON in LLM response.")
         return None
 
     # JSON string has been successfully converted to dictionary.
-    # Now check that all required fields are present.
-    if not 'ships' in res_json or len(res_json['ships']) < 1:
-        logging.warning("No ships in fleet.")
-        return None
-    if not 'squadrons' in res_json:
-        logging.warning("No squadrons in fleet.")
+    return validate_fleet(res_json)
+
+# Check that all required fields are present in a decoded fleet. Returns the
+# fleet with values coerced to the schema types (e.g. costs given as strings)
+# and unusable optional values removed.
+def validate_fleet(res_json):
+    res_json, errors = fleet_validator(res_json)
+    if errors:
+        logging.warning(f"Fleet failed validation: {'; '.join(errors[:5])}")
         return None
-    for ship in res_json['ships']:
-        if not 'name' in ship or not 'upgrades' in ship:
-            logging.warning("Ship in fleet missing required properties.")
-            return None
-        for upgrade in ship['upgrades']:
-            if not 'name' in upgrade:
-                logging.warning("Upgrade on ship missing required properties.")
-                return None
-    for squad in res_json['squadrons']:
-        if not 'name' in squad:
-            logging.warning("Squadron in fleet missing required properties.")
-            return None
     return res_json
 
-def parse_fleet_llm(fleet):
-    if not hasattr(parse_fleet_llm, 'client'):
-        parse_fleet_llm.client = genai.Client(api_key=GEMINI_API_KEY)
-        # parse_fleet_llm.client = InferenceClient(
-        #     provider="novita",
-        #     api_key=HUGGINGFACE_API_KEY,
-        # )
+# Backends used when parse_fleet is not given one, in priority order
+default_backends = ['gemini']
+_pool = None
+
+def set_backends(members):
+    global _pool
+    _pool = llm_backends.BackendPool(members)
+    return _pool
+
+# Get a backend pool from a backend argument: None for the default pool, a
+# backend name, a list of names/Backend instances, a Backend or a BackendPool.
+def get_pool(backend=None):
+    if backend is None:
+        if _pool is None:
+            set_backends(default_backends)
+        return _pool
+    if isinstance(backend, llm_backends.BackendPool):
+        return backend
+    if isinstance(backend, (str, llm_backends.Backend)):
+        backend = [backend]
+    return llm_backends.BackendPool(backend)
 
-    prompt = f"""
+def build_prompt(fleet):
+    return f"""
     # CONTEXT #
     I want to convert a Star Wars Armada fleet list into a standardized format
     for analysis. The fleet list will contain a paragraphs listing the upgrades
@@ -145,44 +199,135 @@ def parse_fleet_llm(fleet):
 
     # {fleet}
     # """
-    def get_google_response(prompt):
-        try:
-            response = parse_fleet_llm.client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=prompt
-                )
-        # if requests per minute quota is exceeded, then wait 60s and try again
-        except genai.errors.ClientError:
-            time.sleep(60)
-            response = parse_fleet_llm.client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=prompt
-                )
-        return response.text
-
-
-    def get_huggingface_response(prompt):
-        completion = parse_fleet_llm.client.chat.completions.create(
-            model="deepseek-ai/DeepSeek-V3-0324",
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-        )
-        return completion.choices[0].message.content
+
+def build_batch_prompt(fleets):
+    inputs = '\n\n'.join(FLEET_DELIMITER.format(index=ii) + '\n' + fleet
+                           for ii, fleet in enumerate(fleets))
+    return f"""
+    # CONTEXT #
+    I want to convert {len(fleets)} Star Wars Armada fleet lists into a
+    standardized format for analysis. Each fleet list starts with a line
+    "{FLEET_DELIMITER.format(index='N')}" where N is the number of the list.
+    A fleet list will contain paragraphs listing the upgrades for each ship
+    in the fleet, and potentially a paragraph listing the squadrons in the
+    fleet. Each line will only contain one ship, upgrade or squadron. The
+    fleet list may include the costs of each ship, squadron and upgrade, as
+    well as metadata such as the name, faction and commander of the fleet.
+
+    # RESPONSE #
+    Return one entry per fleet list, with "index" set to N and "fleet" set
+    to the converted fleet list.
+
+    # INPUT DATA #
+    {inputs}
+    """
+
+# Recover the fleet text(s) from a prompt. Used by offline backends that
+# answer without a model.
+def split_prompt(prompt):
+    return prompt.split('# INPUT DATA #', 1)[-1].strip()
+
+def split_batch_prompt(prompt):
+    delim = re.escape(FLEET_DELIMITER).replace(re.escape('{index}'), r'(\d+)')
+    parts = re.split(delim, split_prompt(prompt))
+    # parts = [preamble, index, text, index, text, ...]
+    return {int(parts[ii]): parts[ii+1].strip()
+            for ii in range(1, len(parts), 2)}
+
+# The response is streamed into a StreamingJSONParser, which stops reading as
+# soon as the fleet JSON is complete. If the response turns out to be unusable
+# (no JSON, or broken beyond repair) the request is aborted early and made
+# again, up to MAX_RETRIES times.
+def parse_fleet_llm(fleet, pool=None):
+    pool = pool or get_pool()
+    prompt = build_prompt(fleet)
 
     # Query LLM, then validate that output is valid JSON with required fields.
-    response = get_google_response(prompt)
-    logging.info(response)
-    res_json = validate_json(response)
-    if not res_json:
+    res_json = None
+    for attempt in range(1 + MAX_RETRIES):
+        parser = json_repair.StreamingJSONParser(start_chars='{')
+        try:
+            response = pool.generate(prompt, on_chunk=parser.feed,
+                                     on_failover=parser.reset)
+        except llm_backends.BackendError as e:
+            logging.error(f'LLM request failed: {e}')
+            return None
+        logging.info(response)
+        if parser.failed:
+            logging.warning(f'Unusable LLM response ({parser.error}),'
+                            + ' requesting again.')
+            continue
+        res_json = validate_json(parser.result())
+        if res_json:
+            break
         logging.error(f'Failed to parse LLM response:\n{response}')
-        # TODO: try again?
 
     return res_json
 
+# Parse several fleet lists with one LLM request. The instructions are sent
+# once for the whole batch and the response schema replaces the format
+# description, so each extra fleet only costs its own text. Returns a list of
+# dictionaries (or None for fleets that failed validation) in input order.
+def parse_batch_llm(fleets, pool=None):
+    pool = pool or get_pool()
+    results = [None] * len(fleets)
+    parser = json_repair.StreamingJSONParser(start_chars='[')
+    try:
+        response = pool.generate(build_batch_prompt(fleets), batch_schema,
+                                 on_chunk=parser.feed,
+                                 on_failover=parser.reset)
+    except llm_backends.BackendError as e:
+        logging.warning(f'Batched LLM request failed: {e}')
+        return results
+    logging.info(response)
+
+    entries = parser.result()
+    if not isinstance(entries, list):
+        logging.warning("Batched response is not a list.")
+        return results
+
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        index = entry.get('index')
+        if not isinstance(index, int) or not 0 <= index < len(fleets):
+            continue
+        # Entries without a usable fleet are left for the single fleet retry
+        if not isinstance(entry.get('fleet'), dict):
+            continue
+        results[index] = validate_json(entry['fleet'])
+    return results
+
+# Parse a list of fleet lists, batch_size lists per LLM request. Fleets that
+# are missing from a batched response or fail validation are retried one at a
+# time with the single fleet prompt. Batches are sent concurrently, up to the
+# combined concurrency limit of the backends in the pool.
+def parse_fleets_llm(fleets, batch_size=BATCH_SIZE, pool=None):
+    pool = pool or get_pool()
+    if not pool.supports_schema:
+        batch_size = 1
+
+    def parse_batch(batch):
+        if len(batch) == 1:
+            return [parse_fleet_llm(batch[0], pool)]
+        parsed = parse_batch_llm(batch, pool)
+        for ii, res_json in enumerate(parsed):
+            if not res_json:
+                logging.warning('Retrying fleet individually after failed'
+                                + ' batched parse.')
+                parsed[ii] = parse_fleet_llm(batch[ii], pool)
+        return parsed
+
+    batches = [fleets[ii:ii+batch_size]
+               for ii in range(0, len(fleets), batch_size)]
+    workers = max(1, min(pool.max_concurrency, len(batches)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [res_json for parsed in executor.map(parse_batch, batches)
+                for res_json in parsed]
+
 def parse_fleet(fleet, **kwargs):
-    # TODO: switch between parsers depending on kwargs
-    return parse_fleet_llm(fleet)
\ No newline at end of file
+    return parse_fleet_llm(fleet, get_pool(kwargs.get('backend')))
+
+def parse_fleets(fleets, batch_size=BATCH_SIZE, **kwargs):
+    return parse_fleets_llm(fleets, batch_size=batch_size,
+                            pool=get_pool(kwargs.get('backend')))
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+JSON Repair
+
+Tolerant JSON handling for LLM responses.
+
+StreamingJSONParser consumes a response as it arrives. It skips any preamble
+(prose, a ```json code fence) up to the start of the JSON document, then
+tracks strings and brackets so that it knows the moment the document is
+complete, and the rest of the response can be dropped without waiting for it.
+If no document starts within the first few thousand characters, or the
+brackets cannot be matched up, the response is unusable and the parser says so
+right away, so the caller can abort the request and ask again instead of
+waiting for the whole response.
+
+repair() fixes the defects LLMs commonly produce in otherwise good JSON:
+trailing commas, unquoted keys, single quoted strings, Python literals
+(True/False/None), comments, bare word values, and strings or brackets left
+open when the response was cut short.
+
+compile_schema() turns a response schema (the OpenAPI style schema used for
+Gemini structured output) into a validation function, built once per schema
+rather than walking the schema on every response. The validator coerces
+values where the intent is clear (e.g. "12" for an integer field) and drops
+optional fields that are unusable rather than rejecting the whole response.
+
+@author: alexe
+"""
+import json
+import re
+
+# Characters of preamble allowed before the JSON document starts
+MAX_PREAMBLE = 4096
+
+closers = {'{': '}', '[': ']'}
+
+class StreamingJSONParser:
+    def __init__(self, start_chars='{[', max_preamble=MAX_PREAMBLE):
+        self.start_chars = start_chars
+        self.max_preamble = max_preamble
+        self.reset()
+
+    # Forget everything fed so far, e.g. the partial response of a request
+    # that failed and is being sent again
+    def reset(self):
+        self.buffer = []
+        self.length = 0
+        self.start = None
+        self.end = None
+        self.value = None
+        self.failed = False
+        self.error = None
+        self.repairs = 0
+        self._restart = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+
+    @property
+    def done(self):
+        return self.end is not None
+
+    def _fail(self, error):
+        self.failed = True
+        self.error = error
+
+    # Consume the next piece of the response. Returns True while more input
+    # is wanted, False once the document is complete or the response has
+    # been found to be unusable.
+    def feed(self, chunk):
+        if self.done or self.failed:
+            return False
+        offset = self.length
+        self.buffer.append(chunk)
+        self.length += len(chunk)
+        res = self._scan(chunk, offset)
+        while res is None:
+            # Restart the search for the document after a false start
+            offset = self._restart
+            res = self._scan(''.join(self.buffer)[offset:], offset)
+        return res
+
+    # Returns like feed, or None if the search for the start of the document
+    # has to go back to self._restart.
+    def _scan(self, chunk, offset):
+        for ii, c in enumerate(chunk):
+            if self.start is None:
+                if c in self.start_chars:
+                    self.start = offset + ii
+                    self._stack.append(c)
+                elif offset + ii >= self.max_preamble:
+                    self._fail('No JSON found in response')
+                    return False
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                continue
+            if c == '"':
+                self._in_string = True
+            elif c in closers:
+                self._stack.append(c)
+            elif c in '}]':
+                if closers[self._stack[-1]] != c:
+                    # Closing an outer bracket closes the ones inside it too
+                    # (repair() does the same). Anything else is hopeless.
+                    openers = [o for o in self._stack if closers[o] == c]
+                    if not openers:
+                        self._fail(f'Unmatched {c} in response')
+                        return False
+                    while closers[self._stack[-1]] != c:
+                        self._stack.pop()
+                        self.repairs += 1
+                self._stack.pop()
+                if not self._stack:
+                    return self._complete(offset + ii + 1)
+        return True
+
+    # The brackets of a document have been closed at end. If it does not
+    # decode, the opening bracket was part of the preamble (e.g. "{name}" in
+    # prose) and the search for the document goes on right after it.
+    def _complete(self, end):
+        text = ''.join(self.buffer)
+        self.value = loads_document(text[self.start:end])
+        if self.value is not None:
+            self.end = end
+            return False
+        self._restart = self.start + 1
+        self.start = None
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self.repairs = 0
+        return None
+
+    def text(self):
+        res = ''.join(self.buffer)
+        if self.start is None:
+            return ''
+        return res[self.start:self.end]
+
+    # Decode the document, repairing it if needed. Returns None if there is
+    # nothing usable.
+    def result(self):
+        if self.failed or self.start is None:
+            return None
+        if self.done:
+            return self.value
+        return loads_document(self.text())
+
+# Decode a JSON document, falling back to repair() if it is malformed
+def loads_document(text):
+    try:
+        return json.loads(text)
+    except json.decoder.JSONDecodeError:
+        pass
+    try:
+        return json.loads(repair(text))
+    except json.decoder.JSONDecodeError:
+        return None
+
+# Find and decode the JSON document in a complete response
+def loads(response, start_chars='{['):
+    parser = StreamingJSONParser(start_chars=start_chars,
+                                 max_preamble=len(response))
+    parser.feed(response)
+    return parser.result()
+
+identifier = re.compile(r'[A-Za-z_$][A-Za-z0-9_$]*')
+literals = {'true': 'true', 'false': 'false', 'null': 'null',
+            'True': 'true', 'False': 'false', 'None': 'null'}
+
+def _strip_trailing_comma(out):
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ',':
+        out.pop()
+
+def _last_significant(out):
+    for token in reversed(out):
+        if not token.isspace():
+            return token[-1]
+    return ''
+
+# Fix common defects in an LLM-written JSON document. The result is valid JSON
+# for anything with a recoverable structure; it is not guaranteed to decode
+# for arbitrary input.
+def repair(text):
+    out = []
+    stack = []
+    ii = 0
+    n = len(text)
+    while ii < n:
+        c = text[ii]
+        if c in '"\'':
+            # Read to the matching quote, re-emitting as a double quoted
+            # string. Unterminated strings are closed at the end of input.
+            jj = ii + 1
+            chars = []
+            while jj < n and text[jj] != c:
+                if text[jj] == '\\' and jj + 1 < n:
+                    if c == "'" and text[jj+1] == "'":
+                        chars.append("'")
+                    else:
+                        chars.append(text[jj:jj+2])
+                    jj += 2
+                    continue
+                if text[jj] == '"':
+                    chars.append('\\"')
+                elif text[jj] == '\n':
+                    chars.append('\\n')
+                else:
+                    chars.append(text[jj])
+                jj += 1
+            out.append('"' + ''.join(chars) + '"')
+            ii = jj + 1
+        elif c in closers:
+            stack.append(c)
+            out.append(c)
+            ii += 1
+        elif c in '}]':
+            if c not in [closers[o] for o in stack]:
+                # Stray closer, drop it
+                ii += 1
+                continue
+            _strip_trailing_comma(out)
+            if _last_significant(out) == ':':
+                out.append('null')
+            while closers[stack[-1]] != c:
+                out.append(closers[stack.pop()])
+            stack.pop()
+            out.append(c)
+            ii += 1
+        elif c == '/' and text.startswith('//', ii):
+            ii = text.find('\n', ii)
+            ii = n if ii < 0 else ii
+        elif c == '/' and text.startswith('/*', ii):
+            ii = text.find('*/', ii)
+            ii = n if ii < 0 else ii + 2
+        elif identifier.match(text, ii):
+            word = identifier.match(text, ii).group()
+            end = ii + len(word)
+            rest = text[end:].lstrip(' \t')
+            if rest.startswith(':') and stack and stack[-1] == '{':
+                # Unquoted key
+                out.append(json.dumps(word))
+                ii = end
+            elif word in literals:
+                out.append(literals[word])
+                ii = end
+            else:
+                # Bare word value, read to the next delimiter and quote it
+                jj = ii
+                while jj < n and text[jj] not in ',}]\n':
+                    jj += 1
+                out.append(json.dumps(text[ii:jj].strip()))
+                ii = jj
+        else:
+            out.append(c)
+            ii += 1
+
+    # Close anything left open by a truncated response
+    _strip_trailing_comma(out)
+    if _last_significant(out) == ':':
+        out.append('null')
+    while stack:
+        _strip_trailing_comma(out)
+        out.append(closers[stack.pop()])
+    return ''.join(out)
+
+leading_int = re.compile(r'\s*(-?\d+)')
+
+# Build a validation function for a response schema. The function takes a
+# decoded value and returns (value, errors): the value with coercions applied
+# and a list of error strings, empty if the value is valid. The schema may
+# also use minItems on arrays.
+def compile_schema(schema):
+    kind = schema.get('type', '').upper()
+
+    if kind == 'OBJECT':
+        properties = {key: compile_schema(sub) for key, sub
+                      in schema.get('properties', {}).items()}
+        required = schema.get('required', [])
+        def check(value, path='$'):
+            if not isinstance(value, dict):
+                return None, [f'{path}: expected object']
+            errors = [f'{path}.{key}: missing' for key in required
+                      if value.get(key) is None]
+            res = dict(value)
+            for key, sub in properties.items():
+                if value.get(key) is None:
+                    continue
+                sub_value, sub_errors = sub(value[key], f'{path}.{key}')
+                if not sub_errors:
+                    res[key] = sub_value
+                elif key in required:
+                    errors += sub_errors
+                else:
+                    # Unusable optional field, drop it
+                    del res[key]
+            return res, errors
+        return check
+
+    if kind == 'ARRAY':
+        items = compile_schema(schema.get('items', {}))
+        min_items = schema.get('minItems', 0)
+        def check(value, path='$'):
+            if not isinstance(value, list):
+                return None, [f'{path}: expected array']
+            res = []
+            errors = []
+            for ii, item in enumerate(value):
+                item_value, item_errors = items(item, f'{path}[{ii}]')
+                res.append(item_value)
+                errors += item_errors
+            if len(res) < min_items:
+                errors.append(f'{path}: expected at least {min_items} items')
+            return res, errors
+        return check
+
+    if kind == 'INTEGER':
+        def check(value, path='$'):
+            if isinstance(value, bool):
+                return None, [f'{path}: expected integer']
+            if isinstance(value, int):
+                return value, []
+            if isinstance(value, float) and value.is_integer():
+                return int(value), []
+            if isinstance(value, str):
+                match = leading_int.match(value)
+                if match:
+                    return int(match.group(1)), []
+            return None, [f'{path}: expected integer']
+        return check
+
+    if kind == 'NUMBER':
+        def check(value, path='$'):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return value, []
+            try:
+                return float(value), []
+            except (TypeError, ValueError):
+                return None, [f'{path}: expected number']
+        return check
+
+    if kind == 'STRING':
+        def check(value, path='$'):
+            if isinstance(value, str):
+                return value, []
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return str(value), []
+            return None, [f'{path}: expected string']
+        return check
+
+    if kind == 'BOOLEAN':
+        def check(value, path='$'):
+            if isinstance(value, bool):
+                return value, []
+            return None, [f'{path}: expected boolean']
+        return check
+
+    # No type given, anything goes
+    return lambda value, path='$': (value, [])
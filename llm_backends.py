@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""
+LLM Backends
+
+Interchangeable text generation backends for fleet parsing. Every backend
+takes a prompt (and optionally a response schema for structured JSON output)
+and returns the response text. Available backends:
+    gemini - Google Gemini API (free tier is enough for most events)
+    huggingface - HuggingFace Inference API chat models
+    llama - local GGUF model through llama-cpp-python
+    stub - deterministic rule-based parser for fleet builder exports. Needs
+        no network or API key, for tests and offline runs.
+
+SDKs and API keys are only loaded when a backend is first used, so choosing
+one backend does not require the others to be installed or configured.
+
+Each backend limits how many requests it has in flight at once and records
+latency, size and estimated cost for every call. Backends are combined in a
+BackendPool, which sends each request to the first healthy backend in
+priority order. A backend that is throttled (rate limit hit) or keeps failing
+is put in cooldown and requests fail over to the next one until it recovers.
+
+@author: alexe
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+import profiling
+
+class BackendError(Exception):
+    pass
+
+# Raised when a provider rejects a request because of rate limits or quota
+class BackendThrottled(BackendError):
+    pass
+
+# Raised when no backend in a pool can take a request
+class NoBackendAvailable(BackendError):
+    pass
+
+# Rough token estimate for providers that do not report usage
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+# Convert a Gemini (OpenAPI subset) response schema into JSON Schema, as used
+# by llama.cpp and most other structured output APIs.
+def to_json_schema(schema):
+    res = {}
+    for key, value in schema.items():
+        if key == 'type':
+            res['type'] = value.lower()
+        elif key == 'properties':
+            res['properties'] = {k: to_json_schema(v)
+                                 for k, v in value.items()}
+        elif key == 'items':
+            res['items'] = to_json_schema(value)
+        else:
+            res[key] = value
+    return res
+
+# Running totals of calls made to a backend
+class CallStats:
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.throttled = 0
+        self.latency = 0.
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost = 0.
+        self.lock = threading.Lock()
+
+    def to_dict(self):
+        return {'calls': self.calls,
+                'failures': self.failures,
+                'throttled': self.throttled,
+                'total_latency_s': round(self.latency, 3),
+                'mean_latency_s': round(self.latency / self.calls, 3)
+                                  if self.calls else 0.,
+                'input_tokens': self.input_tokens,
+                'output_tokens': self.output_tokens,
+                'cost_usd': round(self.cost, 6)}
+
+class Backend:
+    name = 'base'
+    # Whether the backend can enforce a response schema
+    supports_schema = False
+    # Price in USD per million tokens, for cost accounting
+    input_price = 0.
+    output_price = 0.
+
+    def __init__(self, max_concurrency=1, max_failures=3, cooldown=60.):
+        self.max_concurrency = max_concurrency
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.stats = CallStats()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._failures = 0
+        self._retry_at = 0.
+
+    # Subclasses implement this. Returns (text, input_tokens, output_tokens),
+    # with None for token counts the provider does not report.
+    def _generate(self, prompt, schema=None):
+        raise NotImplementedError
+
+    # Streaming version of _generate, yielding (chunk, input_tokens,
+    # output_tokens). Backends without a streaming API return the whole
+    # response as one chunk.
+    def _generate_stream(self, prompt, schema=None):
+        yield self._generate(prompt, schema)
+
+    def healthy(self):
+        return time.monotonic() >= self._retry_at
+
+    def retry_at(self):
+        return self._retry_at
+
+    # Get the response to a prompt. If on_chunk is given, the response is
+    # streamed and on_chunk is called with each piece as it arrives; if it
+    # returns False the rest of the response is dropped (e.g. the JSON is
+    # already complete, or clearly unusable) and what was received so far is
+    # returned.
+    def generate(self, prompt, schema=None, on_chunk=None):
+        if schema is not None and not self.supports_schema:
+            raise BackendError(f'{self.name} does not support schemas')
+        with self._slots, profiling.span(f'llm:{self.name}'):
+            t0 = time.perf_counter()
+            chunks = []
+            tokens_in = tokens_out = None
+            stream = ()
+            try:
+                if on_chunk is None:
+                    stream = [self._generate(prompt, schema)]
+                else:
+                    stream = self._generate_stream(prompt, schema)
+                for chunk, chunk_in, chunk_out in stream:
+                    chunks.append(chunk or '')
+                    tokens_in = chunk_in or tokens_in
+                    tokens_out = chunk_out or tokens_out
+                    if on_chunk is not None \
+                            and on_chunk(chunk or '') is False:
+                        break
+            except BackendThrottled:
+                self._record_failure(time.perf_counter() - t0, True)
+                raise
+            except Exception as e:
+                self._record_failure(time.perf_counter() - t0, False)
+                if isinstance(e, BackendError):
+                    raise
+                raise BackendError(f'{self.name}: {e}') from e
+            finally:
+                if hasattr(stream, 'close'):
+                    stream.close()
+            elapsed = time.perf_counter() - t0
+        text = ''.join(chunks)
+
+        tokens_in = tokens_in or estimate_tokens(prompt)
+        tokens_out = tokens_out or estimate_tokens(text)
+        with self.stats.lock:
+            self.stats.calls += 1
+            self.stats.latency += elapsed
+            self.stats.input_tokens += tokens_in
+            self.stats.output_tokens += tokens_out
+            self.stats.cost += (tokens_in * self.input_price
+                                + tokens_out * self.output_price) / 1e6
+            self._failures = 0
+        logging.info(f'{self.name}: {elapsed:.2f}s, {tokens_in} tokens in,'
+                     + f' {tokens_out} tokens out')
+        return text
+
+    # Throttled backends go straight into cooldown, others only after
+    # max_failures consecutive failures.
+    def _record_failure(self, elapsed, throttled):
+        with self.stats.lock:
+            self.stats.calls += 1
+            self.stats.failures += 1
+            self.stats.latency += elapsed
+            self._failures += 1
+            if throttled:
+                self.stats.throttled += 1
+            if throttled or self._failures >= self.max_failures:
+                self._retry_at = time.monotonic() + self.cooldown
+                self._failures = 0
+                logging.warning(f'{self.name} unavailable, cooling down for'
+                                + f' {self.cooldown:.0f}s')
+
+class GeminiBackend(Backend):
+    name = 'gemini'
+    supports_schema = True
+    input_price = 0.10
+    output_price = 0.40
+
+    def __init__(self, model="gemini-2.0-flash", api_key=None, client=None,
+                 max_concurrency=4, **kwargs):
+        super().__init__(max_concurrency=max_concurrency, **kwargs)
+        self.model = model
+        self.api_key = api_key
+        self.client = client
+
+    def _get_client(self):
+        if self.client is None:
+            from google import genai
+            api_key = self.api_key
+            if api_key is None:
+                from config import GEMINI_API_KEY as api_key
+            self.client = genai.Client(api_key=api_key)
+        return self.client
+
+    def _request(self, prompt, schema=None):
+        kwargs = {'model': self.model, 'contents': prompt}
+        if schema is not None:
+            kwargs['config'] = {'response_mime_type': 'application/json',
+                                'response_schema': schema}
+        return kwargs
+
+    @staticmethod
+    def _unpack(response):
+        usage = getattr(response, 'usage_metadata', None)
+        return (response.text,
+                getattr(usage, 'prompt_token_count', None),
+                getattr(usage, 'candidates_token_count', None))
+
+    # Requests per minute quota exceeded
+    def _check_throttled(self, e):
+        if getattr(e, 'code', None) == 429:
+            raise BackendThrottled(f'{self.name}: {e}') from e
+
+    def _generate(self, prompt, schema=None):
+        client = self._get_client()
+        try:
+            response = client.models.generate_content(
+                **self._request(prompt, schema))
+        except Exception as e:
+            self._check_throttled(e)
+            raise
+        return self._unpack(response)
+
+    def _generate_stream(self, prompt, schema=None):
+        client = self._get_client()
+        try:
+            for response in client.models.generate_content_stream(
+                    **self._request(prompt, schema)):
+                yield self._unpack(response)
+        except Exception as e:
+            self._check_throttled(e)
+            raise
+
+class HuggingFaceBackend(Backend):
+    name = 'huggingface'
+
+    def __init__(self, model="deepseek-ai/DeepSeek-V3-0324", provider="novita",
+                 api_key=None, client=None, max_concurrency=2, **kwargs):
+        super().__init__(max_concurrency=max_concurrency, **kwargs)
+        self.model = model
+        self.provider = provider
+        self.api_key = api_key
+        self.client = client
+
+    def _get_client(self):
+        if self.client is None:
+            from huggingface_hub import InferenceClient
+            api_key = self.api_key
+            if api_key is None:
+                from config import HUGGINGFACE_API_KEY as api_key
+            self.client = InferenceClient(provider=self.provider,
+                                          api_key=api_key)
+        return self.client
+
+    def _generate(self, prompt, schema=None):
+        client = self._get_client()
+        try:
+            completion = client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                )
+        except Exception as e:
+            status = getattr(getattr(e, 'response', None), 'status_code',
+                             None)
+            if status == 429:
+                raise BackendThrottled(f'{self.name}: {e}') from e
+            raise
+        usage = getattr(completion, 'usage', None)
+        return (completion.choices[0].message.content,
+                getattr(usage, 'prompt_tokens', None),
+                getattr(usage, 'completion_tokens', None))
+
+# Local model through llama-cpp-python. The model path is taken from the
+# model_path argument, the ARMADA_LLAMA_MODEL environment variable, or
+# LLAMA_MODEL_PATH in config, in that order.
+class LlamaCppBackend(Backend):
+    name = 'llama'
+    supports_schema = True
+
+    def __init__(self, model_path=None, n_ctx=8192, max_concurrency=1,
+                 **kwargs):
+        super().__init__(max_concurrency=max_concurrency, **kwargs)
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.llm = None
+        self._load_lock = threading.Lock()
+
+    def _get_model(self):
+        with self._load_lock:
+            if self.llm is None:
+                from llama_cpp import Llama
+                path = self.model_path or os.environ.get('ARMADA_LLAMA_MODEL')
+                if not path:
+                    from config import LLAMA_MODEL_PATH as path
+                self.llm = Llama(model_path=path, n_ctx=self.n_ctx,
+                                 verbose=False)
+        return self.llm
+
+    def _generate(self, prompt, schema=None):
+        llm = self._get_model()
+        kwargs = {}
+        if schema is not None:
+            kwargs['response_format'] = {'type': 'json_object',
+                                         'schema': to_json_schema(schema)}
+        res = llm.create_chat_completion(
+            messages=[{"role": "user", "content": prompt}], **kwargs)
+        usage = res.get('usage', {})
+        return (res['choices'][0]['message']['content'],
+                usage.get('prompt_tokens'), usage.get('completion_tokens'))
+
+# Lines in a fleet builder export: "Name (12)", "• Name (12)" and for
+# squadrons "• 2 x Name (24)". Costs in parentheses are optional.
+stub_item = re.compile(
+    r'^\s*(?:[•\-\*]\s*)?(?:(?P<count>\d+)\s*x\s+)?(?P<name>.+?)'
+    r'\s*(?:\((?P<cost>\d+)\))?\s*$')
+
+# Parse a fleet list without an LLM. This only understands the common fleet
+# builder export layout (header lines, one paragraph per ship with upgrades
+# as bullets, a "Squadrons" paragraph), which is enough for tests and for
+# lists exported from the usual builders.
+def rule_based_parse(text):
+    fleet = {'ships': [], 'squadrons': []}
+    in_squadrons = False
+    ship = None
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith('='):
+            if not stripped:
+                ship = None
+            continue
+        if ':' in stripped and not stripped.startswith(('•', '-', '*')):
+            key, value = [t.strip() for t in stripped.split(':', 1)]
+            key = key.lower()
+            if key.startswith('squadron'):
+                in_squadrons = True
+            elif key in ('faction', 'commander') and value:
+                fleet[key] = value
+            continue
+        match = stub_item.match(stripped)
+        if not match:
+            continue
+        name = match.group('name')
+        cost = match.group('cost')
+        cost = int(cost) if cost else None
+        is_bullet = stripped.startswith(('•', '-', '*'))
+        if in_squadrons:
+            squad = {'name': name, 'count': int(match.group('count') or 1)}
+            if cost is not None:
+                squad['cost'] = cost // squad['count']
+            fleet['squadrons'].append(squad)
+        elif is_bullet and ship is not None:
+            upgrade = {'name': name}
+            if cost is not None:
+                upgrade['cost'] = cost
+            ship['upgrades'].append(upgrade)
+        else:
+            ship = {'name': name, 'upgrades': []}
+            if cost is not None:
+                ship['base_cost'] = cost
+            fleet['ships'].append(ship)
+    return fleet
+
+# Deterministic offline backend. By default it answers with rule_based_parse
+# of the fleet text(s) found in the prompt; a different parse function (e.g.
+# a lookup of known answers) can be passed in. An optional latency mimics a
+# remote model.
+class StubBackend(Backend):
+    name = 'stub'
+    supports_schema = True
+
+    def __init__(self, parse=rule_based_parse, latency=0.,
+                 max_concurrency=8, **kwargs):
+        super().__init__(max_concurrency=max_concurrency, **kwargs)
+        self.parse = parse
+        self.latency = latency
+
+    def _generate(self, prompt, schema=None):
+        import fleet_parser
+        if self.latency:
+            time.sleep(self.latency)
+        if schema is not None:
+            fleets = fleet_parser.split_batch_prompt(prompt)
+            text = json.dumps([{'index': index, 'fleet': self.parse(fleet)}
+                               for index, fleet in sorted(fleets.items())])
+        else:
+            fleet = fleet_parser.split_prompt(prompt)
+            text = '```json\n' + json.dumps(self.parse(fleet)) + '\n```'
+        return text, None, None
+
+backends = {
+    'gemini': GeminiBackend,
+    'huggingface': HuggingFaceBackend,
+    'llama': LlamaCppBackend,
+    'stub': StubBackend,
+    }
+
+# Backends in priority order. Each request goes to the first healthy backend
+# (that supports the schema, if one is given); on failure it is retried on the
+# next one. If every backend is cooling down, wait for the first to recover.
+class BackendPool:
+    def __init__(self, members, max_wait=120.):
+        self.members = [backends[m]() if isinstance(m, str) else m
+                        for m in members]
+        self.max_wait = max_wait
+
+    @property
+    def max_concurrency(self):
+        return sum(b.max_concurrency for b in self.members)
+
+    @property
+    def supports_schema(self):
+        return any(b.supports_schema for b in self.members)
+
+    # Send a prompt to the first healthy backend, failing over to the next
+    # one on errors. When streaming, a backend may fail after part of its
+    # response has been passed to on_chunk; on_failover (if given) is called
+    # before the request is tried again, so the consumer can drop that
+    # partial response.
+    def generate(self, prompt, schema=None, on_chunk=None, on_failover=None):
+        candidates = [b for b in self.members
+                      if schema is None or b.supports_schema]
+        if not candidates:
+            raise NoBackendAvailable('No backend supports response schemas')
+        deadline = time.monotonic() + self.max_wait
+        errors = []
+        while True:
+            for backend in candidates:
+                if not backend.healthy():
+                    continue
+                try:
+                    return backend.generate(prompt, schema, on_chunk)
+                except BackendError as e:
+                    logging.warning(f'{backend.name} failed: {e}')
+                    errors.append(e)
+                    if on_failover is not None:
+                        on_failover()
+            # Everything is cooling down (or just failed). Wait for the
+            # first backend to come back, unless that is past the deadline.
+            next_retry = min(b.retry_at() for b in candidates)
+            now = time.monotonic()
+            if next_retry <= now:
+                raise errors[-1] if errors else \
+                    NoBackendAvailable('All backends failed')
+            if next_retry > deadline:
+                raise NoBackendAvailable('All backends cooling down')
+            time.sleep(next_retry - now)
+
+    def report(self):
+        return {b.name: b.stats.to_dict() for b in self.members}
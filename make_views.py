@@ -21,49 +21,66 @@ The views are:
         among fleets running this squadron, average bid among fleets running
         this squadron
 
+Components are named by their canonical name (see migrations), and costed
+with the catalog version in effect on the date of the event (see
+catalog_import), so views built before those migrations need rebuilding with
+--force.
 
 @author: alexe
 """
-import sqlite3
-import pandas as pd
 import argparse
 import os
+import profiling
+import sql_queries
+import db
+
+# Cost of a component as of its fleet's event: the cost in the catalog version
+# in effect then (see catalog_import), or the current cost if there is none.
+# Needs the ec CTE (sql_queries.event_catalog) and the fleet as f.
+def dated_cost(kind, table):
+    return f"""
+LEFT JOIN ec ON ec.event_id = f.event_id
+LEFT JOIN CatalogCosts AS cc_{table} ON cc_{table}.version_id = ec.version_id
+    AND cc_{table}.kind = '{kind}' AND cc_{table}.component_id = {table}.id"""
+
+def cost(table):
+    return f'COALESCE(cc_{table}.cost, {table}.cost)'
 
 # Used as CTE to add number of ships to fleet summary
-get_ships_summary = """
+get_ships_summary = f"""
 SELECT f.id AS fleet_id,
     COUNT(fs.id) AS num_ships,
     SUM(CASE WHEN s.size = "Huge" THEN 1 ELSE 0 END) AS num_huge,
     SUM(CASE WHEN s.size = "Large" THEN 1 ELSE 0 END) AS num_large,
     SUM(CASE WHEN s.size = "Medium" THEN 1 ELSE 0 END) AS num_medium,
     SUM(CASE WHEN s.size = "Small" THEN 1 ELSE 0 END) AS num_small,
-    SUM(s.cost) AS ships_cost
+    SUM({cost('s')}) AS ships_cost
 FROM Fleets_Ships AS fs
 INNER JOIN Fleets AS f ON f.id = fs.fleet_id
-INNER JOIN Ships AS s ON s.id = fs.ship_id
+INNER JOIN Ships AS s ON s.id = fs.ship_id{dated_cost('ship', 's')}
 GROUP BY f.id
 """
 
 # Used as CTE to add number of squadrons to fleet summary
-get_squadrons_summary = """
+get_squadrons_summary = f"""
 SELECT f.id AS fleet_id,
     SUM(fq.count) AS num_squadrons,
     SUM(s.uniq) AS num_uniques,
-    SUM(s.cost * fq.count) AS squadrons_cost
+    SUM({cost('s')} * fq.count) AS squadrons_cost
 FROM Fleets_Squadrons AS fq
 INNER JOIN Fleets AS f ON f.id = fq.fleet_id
-INNER JOIN Squadrons AS s ON s.id = fq.squadron_id
+INNER JOIN Squadrons AS s ON s.id = fq.squadron_id{dated_cost('squadron', 's')}
 GROUP BY f.id
 """
 
 # Used as CTE to add upgrade info to fleet summary
-get_upgrades_summary = """
+get_upgrades_summary = f"""
 SELECT f.id AS fleet_id,
-    SUM(u.cost) AS upgrades_cost
+    SUM({cost('u')}) AS upgrades_cost
 FROM Fleets_Upgrades AS fu
 INNER JOIN Fleets_Ships AS fs ON fu.fleet_ship_id = fs.id
 INNER JOIN Fleets AS f ON f.id = fs.fleet_id
-INNER JOIN Upgrades AS u ON u.id = fu.upgrade_id
+INNER JOIN Upgrades AS u ON u.id = fu.upgrade_id{dated_cost('upgrade', 'u')}
 GROUP BY f.id
 """
 
@@ -76,11 +93,11 @@ from Fleets_Upgrades AS fu
 INNER JOIN Upgrades AS u ON fu.upgrade_id = u.id
 INNER JOIN UpgradeNames AS un
     ON fu.upgrade_id = un.upgrade_id
-    AND un.name IN (SELECT MIN(name) FROM UpgradeNames GROUP BY upgrade_id)
+    AND un.canonical = 1
 INNER JOIN Fleets_Ships AS fs ON fu.fleet_ship_id = fs.id
 INNER JOIN ShipNames AS sn
     ON fs.ship_id = sn.ship_id
-    AND sn.name IN (SELECT MAX(name) FROM ShipNames GROUP BY ship_id)
+    AND sn.canonical = 1
 INNER JOIN Fleets AS f ON f.id = fs.fleet_id
 WHERE u.slot_id = 1
 """
@@ -102,6 +119,7 @@ player_agg AS (
         AVG(sc1.tournament_points) AS avg_tp
     FROM Scores AS sc1
     LEFT JOIN Scores AS sc2 ON sc1.opponent = sc2.player
+        AND sc1.event_id = sc2.event_id AND sc1.round = sc2.round
     GROUP BY sc1.player, sc1.event_id
     ),
 pe AS (
@@ -127,7 +145,8 @@ pe AS (
 # factions and commanders, size of bids and squad-balls, etc.
 view_fleet_summary = f"""
 CREATE VIEW IF NOT EXISTS Fleet_Summary AS
-WITH co AS ({get_commander}),
+WITH ec AS ({sql_queries.event_catalog}),
+co AS ({get_commander}),
 fs AS ({get_ships_summary}),
 fq AS ({get_squadrons_summary}),
 fu AS ({get_upgrades_summary}),
@@ -170,16 +189,18 @@ LEFT JOIN pe ON pe.player = fl.player AND pe.event_id = fl.event_id
 
 # Add ship-level summary to DB for ship-to-ship comparisons. Popularity of
 # ships, average number and cost of upgrades, etc.
-view_ship_summary = """
+view_ship_summary = f"""
 CREATE VIEW IF NOT EXISTS Ship_Summary AS
-WITH up AS (
+WITH ec AS ({sql_queries.event_catalog}),
+up AS (
     SELECT fs.id AS id,
         fs.ship_id AS ship_id,
         SUM(CASE WHEN u.id IS NULL THEN 0 ELSE 1 END) AS num_upgrades,
-        COALESCE(SUM(u.cost), 0) AS cost_upgrades
+        COALESCE(SUM({cost('u')}), 0) AS cost_upgrades
     FROM Fleets_Ships AS fs
+    INNER JOIN Fleets AS f ON f.id = fs.fleet_id
     LEFT JOIN Fleets_Upgrades AS fu ON fs.id = fu.fleet_ship_id
-    LEFT JOIN Upgrades AS u ON u.id = fu.upgrade_id
+    LEFT JOIN Upgrades AS u ON u.id = fu.upgrade_id{dated_cost('upgrade', 'u')}
     WHERE u.slot_id <> 1
     GROUP BY fs.id
     )
@@ -197,7 +218,7 @@ SELECT
 FROM Ships AS s
 INNER JOIN Factions AS fn ON fn.id = s.faction_id
 INNER JOIN ShipNames AS sn ON s.id = sn.ship_id
-    AND sn.name IN (SELECT MAX(name) FROM ShipNames GROUP BY ship_id)
+    AND sn.canonical = 1
 LEFT JOIN Fleets_Ships AS fs ON s.id = fs.ship_id
 LEFT JOIN Fleet_Summary AS fl ON fl.id = fs.fleet_id
 LEFT JOIN up ON s.id = up.ship_id
@@ -219,62 +240,123 @@ SELECT
 FROM Squadrons AS q
 INNER JOIN Factions AS fn ON fn.id = q.faction_id
 INNER JOIN SquadronNames AS qn ON q.id = qn.squadron_id
-    AND qn.name IN (SELECT MAX(name) FROM SquadronNames GROUP BY squadron_id)
+    AND qn.canonical = 1
 LEFT JOIN Fleets_Squadrons AS fq ON q.id = fq.squadron_id
 LEFT JOIN Fleet_Summary AS fl ON fl.id = fq.fleet_id
 GROUP BY q.id, fl.event_id
 """
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        prog="make_views",
-        description="program to add summary statistics to Armada SQL DB")
-    parser.add_argument("db_path", type=str, default='data/armada_events.sql')
+# Views to build, in dependency order (ship and squadron summaries are built
+# on top of Fleet_Summary), with the csv file each one is exported to.
+views = [
+    ('Fleet_Summary', view_fleet_summary, 'fleet_summary.csv'),
+    ('Ship_Summary', view_ship_summary, 'ship_summary.csv'),
+    ('Squadron_Summary', view_squadron_summary, 'squadron_summary.csv'),
+    ]
+
+# Add the summary views to the DB. If force is set, existing views are
+# dropped and recreated (e.g. after the view definitions have changed).
+def build_views(conn, names=None, force=False):
+    cursor = conn.cursor()
+    for name, view_str, _ in views:
+        if names is not None and name not in names:
+            continue
+        with profiling.span(f'create_view:{name}'):
+            if force:
+                cursor.execute(f'DROP VIEW IF EXISTS {name}')
+            cursor.execute(view_str)
+            conn.commit()
+
+# Materialize the summary views and write them to csv files in out_dir
+def export_views(conn, names=None, out_dir='data'):
+    import pandas as pd
+    for name, _, filename in views:
+        if names is not None and name not in names:
+            continue
+        with profiling.span(f'view:{name}'):
+            df = pd.read_sql_query(f'SELECT * FROM {name}', conn)
+        with profiling.span(f'export:{filename}'):
+            df.to_csv(os.path.join(out_dir, filename), index=False)
+
+# Rewrite the rows of one event in the csv files exported to out_dir from the
+# views, after the event has changed (see event_sync). Ship and squadron rows
+# with no event (components no fleet runs) are rewritten too. Files that have
+# not been exported, or whose view is not in the DB, are left alone. Returns
+# the names of the views refreshed.
+def refresh_event(conn, ev_id, names=None, out_dir='data'):
+    import pandas as pd
+    built = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'view'")}
+    refreshed = []
+    for name, _, filename in views:
+        path = os.path.join(out_dir, filename)
+        if names is not None and name not in names or name not in built \
+                or not os.path.isfile(path):
+            continue
+        with profiling.span(f'refresh:{name}'):
+            df = pd.read_csv(path)
+            keep = df['event_id'] != ev_id
+            query = f'SELECT * FROM {name} WHERE event_id = ?'
+            if name != 'Fleet_Summary':
+                keep &= df['event_id'].notna()
+                query += ' OR event_id IS NULL'
+            new = pd.read_sql_query(query, conn, params=(ev_id,))
+            frames = [frame for frame in (df[keep], new) if len(frame)]
+            df = pd.concat(frames, ignore_index=True) if frames else new
+            tmp_path = path + '.tmp'
+            df.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, path)
+        refreshed.append(name)
+    return refreshed
+
+def add_arguments(parser):
+    parser.add_argument("db_path", type=str, nargs='?', default=db.DEFAULT_PATH)
     parser.add_argument("-f", "--force", action='store_true',
-                        description="Overwrite views in DB if they exist")
+                        help="Overwrite views in DB if they exist")
     parser.add_argument("--no-fleets", action='store_true')
     parser.add_argument("--no-ships", action='store_true')
     parser.add_argument("--no-squadrons", action='store_true')
-    args = parser.parse_args()
+    parser.add_argument("--profile", type=str, metavar="REPORT",
+                        help="write a JSON timing report for the run to"
+                        + " REPORT")
+    parser.add_argument("--cprofile", action='store_true',
+                        help="include a cProfile capture in the timing"
+                        + " report (written to"
+                        + f" {profiling.DEFAULT_REPORT} without --profile)")
+
+def main(args, parser=None):
+    if args.cprofile and not args.profile:
+        args.profile = profiling.DEFAULT_REPORT
+    if args.profile:
+        profiling.enable(cprofile=args.cprofile)
 
     sql_path = args.db_path
     if not os.path.isfile(sql_path):
         print('DB path must be a file.')
-        parser.print_usage()
+        if parser is not None:
+            parser.print_usage()
         exit()
 
-    do_fleets = not args.no_fleets
-    do_ships = not args.no_ships
-    do_squadrons = not args.no_squadrons
-
-    conn = sqlite3.connect(sql_path)
-    cursor = conn.cursor()
-
-    if do_fleets:
-        if args.force:
-            cursor.execute('DROP VIEW Fleet_Summary')
-        res = cursor.execute(view_fleet_summary)
-        conn.commit()
-
-        df_fleet = pd.read_sql_query('SELECT * FROM Fleet_Summary', conn)
-        df_fleet.to_csv('data/fleet_summary.csv', index=False)
-
-    if do_ships:
-        if args.force:
-            cursor.execute('DROP VIEW Ship_Summary')
-        res = cursor.execute(view_ship_summary)
-        conn.commit()
+    names = []
+    if not args.no_fleets:
+        names.append('Fleet_Summary')
+    if not args.no_ships:
+        names.append('Ship_Summary')
+    if not args.no_squadrons:
+        names.append('Squadron_Summary')
 
-        df_ship = pd.read_sql_query('SELECT * FROM Ship_Summary', conn)
-        df_ship.to_csv('data/ship_summary.csv', index=False)
+    conn = db.connect(sql_path)
+    build_views(conn, names, force=args.force)
+    export_views(conn, names)
+    conn.close()
 
-    if do_squadrons:
-        if args.force:
-            cursor.execute('DROP VIEW Squadron_Summary')
-        res = cursor.execute(view_squadron_summary)
-        conn.commit()
+    if args.profile:
+        profiling.write_report(args.profile)
+        print(f'Timing report written to {args.profile}')
 
-        df_squad = pd.read_sql_query('SELECT * FROM Squadron_Summary', conn)
-        df_squad.to_csv('data/squadron_summary.csv', index=False)
-
-    conn.close()
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="make_views",
+        description="program to add summary statistics to Armada SQL DB")
+    add_arguments(parser)
+    main(parser.parse_args(), parser)
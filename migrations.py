@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Migrations
+
+Schema changes to the events DB, applied in order. The number of migrations
+applied so far is stored in the DB header (PRAGMA user_version), so each one
+runs exactly once per DB. db.connect applies any pending migrations whenever
+a DB is opened for writing; they can also be applied by hand with
+    python migrations.py data/armada_events.sql
+Read-only tools (db.connect_readonly) never migrate, and refuse to open a DB
+that is not up to date.
+
+Each migration runs in one transaction together with the version bump, so a
+failed migration leaves the DB as it was.
+
+1 - Canonical names. Components have several names (aliases) in ShipNames,
+    UpgradeNames and SquadronNames, and the views used to pick a display name
+    with name IN (SELECT MIN/MAX(name) ... GROUP BY id). That re-aggregates the
+    whole names table in every join, and matches the wrong component when
+    one component's display name is an alias of another (e.g. the three
+    "Darth Vader" upgrades), counting it twice. Instead, exactly one name
+    per component is flagged canonical = 1, chosen the same way as before,
+    and queries join on the id and the flag. A partial unique index enforces
+    one canonical name per component, and triggers keep one when names are
+    added or the canonical one is deleted.
+
+2 - Catalog versions. CatalogVersions lists the points/errata releases
+    loaded by catalog_import, with the date each took effect, and
+    CatalogCosts holds the cost of every component in each of them. Fleets
+    are costed with the version in effect on the date of their event.
+
+3 - Event dates. Events scraped before this migration were stored with the
+    month one too low and single-digit days padded on the right (5 Apr was
+    stored as 2025-03-50), so fleets were costed with the wrong catalog
+    version. Every event in the DB when it is migrated came from the
+    scraper, so all dates are shifted back by a month, and days ending in 0
+    that cannot be right (40-90, or past the end of the month) are read as
+    single digits. Days 1-3 and 10, 20, 30 were stored the same way and are
+    left as 10, 20 and 30 when both are valid dates.
+
+4 - Event sync tables. RoundFingerprints and FleetFingerprints hold the
+    fingerprints event_sync compares a page against, and EventRevisions the
+    revision of each event, bumped whenever its data changes. Consumers of
+    event data (csv exports, the query service cache, cooccurrence and
+    attribution) compare revisions to find out what is stale. DBs synced
+    before this migration already have the tables, which are kept.
+
+@author: alexe
+"""
+import argparse
+import sqlite3
+
+# (table, id column, order of names the canonical one is the first of)
+name_tables = [
+    ('ShipNames', 'ship_id', 'name DESC'),
+    ('UpgradeNames', 'upgrade_id', 'name ASC'),
+    ('SquadronNames', 'squadron_id', 'name DESC'),
+    ]
+
+def canonical_names(table, id_col, order):
+    return [
+        f"ALTER TABLE {table} ADD COLUMN canonical INTEGER NOT NULL DEFAULT 0",
+        f"""
+        UPDATE {table} SET canonical = 1 WHERE rowid IN (
+            SELECT (SELECT n.rowid FROM {table} AS n
+                    WHERE n.{id_col} = ids.{id_col}
+                    ORDER BY n.{order}, n.rowid LIMIT 1)
+            FROM (SELECT DISTINCT {id_col} FROM {table}) AS ids)
+        """,
+        f"""
+        CREATE UNIQUE INDEX {table}_canonical ON {table} ({id_col})
+        WHERE canonical = 1
+        """,
+        # The first name added for a component becomes its canonical name
+        f"""
+        CREATE TRIGGER {table}_add_canonical AFTER INSERT ON {table}
+        WHEN NOT EXISTS (SELECT 1 FROM {table}
+                         WHERE {id_col} = NEW.{id_col} AND canonical = 1)
+        BEGIN
+            UPDATE {table} SET canonical = 1 WHERE rowid = NEW.rowid;
+        END
+        """,
+        # Deleting the canonical name promotes another of the same component
+        f"""
+        CREATE TRIGGER {table}_keep_canonical AFTER DELETE ON {table}
+        WHEN OLD.canonical = 1
+        BEGIN
+            UPDATE {table} SET canonical = 1 WHERE rowid = (
+                SELECT rowid FROM {table} WHERE {id_col} = OLD.{id_col}
+                ORDER BY {order}, rowid LIMIT 1);
+        END
+        """,
+        ]
+
+catalog_versions = [
+    """
+    CREATE TABLE CatalogVersions (
+        id INTEGER PRIMARY KEY,
+        version TEXT NOT NULL,
+        effective_date TEXT NOT NULL,
+        imported TEXT NOT NULL,
+        source TEXT,
+        digest TEXT
+        )
+    """,
+    """
+    CREATE TABLE CatalogCosts (
+        version_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        component_id INTEGER NOT NULL,
+        cost INTEGER NOT NULL,
+        PRIMARY KEY (version_id, kind, component_id),
+        FOREIGN KEY (version_id) REFERENCES CatalogVersions (id)
+        ) WITHOUT ROWID
+    """,
+    "CREATE INDEX CatalogVersions_date ON CatalogVersions (effective_date)",
+    ]
+
+# Only dates of the form YYYY-MM-DD are touched
+DATE_GLOB = '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+
+event_dates = [
+    f"""
+    UPDATE Events SET date = substr(date, 1, 5)
+        || printf('%02d', CAST(substr(date, 6, 2) AS INTEGER) + 1)
+        || substr(date, 8)
+    WHERE date GLOB '{DATE_GLOB}' AND CAST(substr(date, 6, 2) AS INTEGER) < 12
+    """,
+    f"""
+    UPDATE Events SET date = substr(date, 1, 8) || '0' || substr(date, 9, 1)
+    WHERE date GLOB '{DATE_GLOB}' AND substr(date, 10, 1) = '0'
+        AND (substr(date, 9, 1) BETWEEN '4' AND '9'
+             OR date(date, '+0 days') IS NOT date)
+    """,
+    ]
+
+event_sync_tables = [
+    """
+    CREATE TABLE IF NOT EXISTS RoundFingerprints (
+        event_id INTEGER NOT NULL,
+        round INTEGER NOT NULL,
+        digest TEXT NOT NULL,
+        PRIMARY KEY (event_id, round),
+        FOREIGN KEY (event_id) REFERENCES Events (id)
+        )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS FleetFingerprints (
+        event_id INTEGER NOT NULL,
+        player TEXT NOT NULL,
+        digest TEXT NOT NULL,
+        PRIMARY KEY (event_id, player),
+        FOREIGN KEY (event_id) REFERENCES Events (id)
+        )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS EventRevisions (
+        event_id INTEGER PRIMARY KEY,
+        revision INTEGER NOT NULL DEFAULT 0,
+        updated TEXT,
+        FOREIGN KEY (event_id) REFERENCES Events (id)
+        )
+    """,
+    ]
+
+# migrations[ii] takes the DB from user_version ii to ii + 1
+migrations = [
+    [stmt for args in name_tables for stmt in canonical_names(*args)],
+    catalog_versions,
+    event_dates,
+    event_sync_tables,
+    ]
+
+SCHEMA_VERSION = len(migrations)
+
+def get_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+# Raise ValueError unless the DB is at the current schema version. For
+# read-only connections, which cannot apply migrations themselves.
+def check_version(conn, path=''):
+    version = get_version(conn)
+    if version < SCHEMA_VERSION:
+        raise ValueError(f'{path} is at schema version {version}, expected'
+                         + f' {SCHEMA_VERSION}: run migrations first'
+                         + f' (python migrations.py {path})')
+    if version > SCHEMA_VERSION:
+        raise ValueError(f'{path} is at schema version {version}, newer than'
+                         + f' this code ({SCHEMA_VERSION})')
+
+# Apply pending migrations. DBs without the component tables (e.g. a new
+# empty file) are left alone. Returns the number of migrations applied.
+def migrate(conn):
+    version = get_version(conn)
+    if version >= SCHEMA_VERSION:
+        return 0
+    tables = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if not all(table in tables for table, _, _ in name_tables):
+        return 0
+    conn.commit()
+    for ii in range(version, SCHEMA_VERSION):
+        conn.execute('BEGIN')
+        try:
+            for stmt in migrations[ii]:
+                conn.execute(stmt)
+            conn.execute(f'PRAGMA user_version = {ii + 1}')
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        conn.commit()
+    return SCHEMA_VERSION - version
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="migrations",
+        description="bring the schema of an Armada SQL DB up to date")
+    parser.add_argument("db_path", type=str, nargs='?',
+                        default='data/armada_events.sql')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db_path)
+    applied = migrate(conn)
+    print(f'{applied} migrations applied, schema version {get_version(conn)}')
+    conn.close()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling
+
+Instrumentation for the ingest and view building tools. When profiling is
+enabled, SQLite connections opened through this module record the number of
+executions, total time and number of rows fetched for every distinct statement,
+and named timing spans can be wrapped around the expensive stages of a run
+(LLM calls, HTML parsing, name resolution, view materialization). At the end
+of a run everything is written out as a single JSON report, optionally
+together with a cProfile capture of the whole run.
+
+When profiling is disabled (the default) spans are no-ops and connect() returns
+a plain sqlite3 connection, so instrumented code pays almost nothing.
+
+Usage:
+    profiling.enable(cprofile=True)
+    conn = profiling.connect('data/armada_events.sql')
+    with profiling.span('get_scores'):
+        ...
+    profiling.write_report('logs/profile.json')
+
+@author: alexe
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Collapse whitespace so that the same query string formatted differently (or
+# built from a triple quoted string) is counted as one statement.
+def normalize_sql(query):
+    return ' '.join(query.split())
+
+# Running totals for a single statement or span
+class Timing:
+    __slots__ = ('count', 'total', 'max', 'rows')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.rows = 0
+
+    def add(self, elapsed, rows=0):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.rows += rows
+
+    def to_dict(self):
+        return {'count': self.count,
+                'total_s': round(self.total, 6),
+                'mean_s': round(self.total / self.count, 6)
+                          if self.count else 0.,
+                'max_s': round(self.max, 6),
+                'rows': self.rows}
+
+# Spans and statements may be recorded from worker threads (e.g. concurrent
+# LLM requests), so all updates to the totals are made under a lock.
+class Profiler:
+    def __init__(self, cprofile=False):
+        self.statements = {}
+        self.spans = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.cprofile = cProfile.Profile() if cprofile else None
+        if self.cprofile:
+            self.cprofile.enable()
+
+    def record_statement(self, query, elapsed, rows=0):
+        key = normalize_sql(query)
+        with self.lock:
+            timing = self.statements.get(key)
+            if timing is None:
+                timing = self.statements[key] = Timing()
+            timing.add(elapsed, rows)
+
+    # Rows are only known once results are fetched, so they are added to the
+    # statement afterwards without bumping the execution count.
+    def record_rows(self, query, elapsed, rows):
+        key = normalize_sql(query)
+        with self.lock:
+            timing = self.statements.get(key)
+            if timing is not None:
+                timing.total += elapsed
+                timing.rows += rows
+
+    def record_span(self, name, elapsed):
+        with self.lock:
+            timing = self.spans.get(name)
+            if timing is None:
+                timing = self.spans[name] = Timing()
+            timing.add(elapsed)
+
+    def report(self, top=25):
+        with self.lock:
+            statements = sorted(self.statements.items(),
+                                key=lambda kv: kv[1].total, reverse=True)
+            spans = sorted(self.spans.items(),
+                           key=lambda kv: kv[1].total, reverse=True)
+        res = {
+            'wall_time_s': round(time.perf_counter() - self.start, 6),
+            'spans': {name: t.to_dict() for name, t in spans},
+            'statements': [dict(sql=sql, **t.to_dict())
+                           for sql, t in statements],
+            }
+        if self.cprofile:
+            self.cprofile.disable()
+            stream = io.StringIO()
+            stats = pstats.Stats(self.cprofile, stream=stream)
+            stats.sort_stats('cumulative').print_stats(top)
+            res['cprofile'] = stream.getvalue().splitlines()
+        return res
+
+# Report written by the tools when a cProfile capture is asked for without
+# a report path
+DEFAULT_REPORT = 'logs/profile.json'
+
+# Module level profiler, None unless profiling has been enabled for this run
+_profiler = None
+
+def enable(cprofile=False):
+    global _profiler
+    _profiler = Profiler(cprofile=cprofile)
+    return _profiler
+
+def disable():
+    global _profiler
+    if _profiler and _profiler.cprofile:
+        _profiler.cprofile.disable()
+    _profiler = None
+
+def is_enabled():
+    return _profiler is not None
+
+# Time a named stage of the run. Spans with the same name are aggregated.
+@contextmanager
+def span(name):
+    if _profiler is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _profiler.record_span(name, time.perf_counter() - t0)
+
+# Cursor that reports statement timings to the module profiler. Rows are
+# counted as they are fetched; iterating over the cursor directly is not
+# counted.
+class ProfiledCursor(sqlite3.Cursor):
+    _last_query = None
+
+    def execute(self, query, params=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(query, params)
+        finally:
+            if _profiler:
+                self._last_query = query
+                _profiler.record_statement(query, time.perf_counter() - t0)
+
+    def executemany(self, query, seq_of_params):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(query, seq_of_params)
+        finally:
+            if _profiler:
+                self._last_query = query
+                _profiler.record_statement(query, time.perf_counter() - t0)
+
+    def _fetch(self, method, *args):
+        t0 = time.perf_counter()
+        res = method(*args)
+        if _profiler and self._last_query:
+            if isinstance(res, list):
+                nrows = len(res)
+            else:
+                nrows = 0 if res is None else 1
+            _profiler.record_rows(self._last_query,
+                                  time.perf_counter() - t0, nrows)
+        return res
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._fetch(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+class ProfiledConnection(sqlite3.Connection):
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    # Connection.execute creates its cursor internally without going
+    # through cursor(), so route the shortcuts explicitly.
+    def execute(self, query, params=()):
+        return self.cursor().execute(query, params)
+
+    def executemany(self, query, seq_of_params):
+        return self.cursor().executemany(query, seq_of_params)
+
+# Open an SQLite connection, instrumented if profiling is enabled
+def connect(path, **kwargs):
+    if _profiler is not None:
+        kwargs.setdefault('factory', ProfiledConnection)
+    return sqlite3.connect(path, **kwargs)
+
+# Write the JSON report for this run. If cProfile was enabled, the raw stats
+# are also dumped next to the report for use with snakeviz, pstats, etc.
+def write_report(path, top=25):
+    if _profiler is None:
+        return None
+    res = _profiler.report(top=top)
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    if _profiler.cprofile:
+        prof_path = os.path.splitext(path)[0] + '.prof'
+        _profiler.cprofile.dump_stats(prof_path)
+        res['cprofile_dump'] = prof_path
+    with open(path, 'w') as f:
+        f.write(json.dumps(res, indent=2))
+    return res
@@ -0,0 +1,598 @@
+# -*- coding: utf-8 -*-
+"""
+Query Service
+
+Small local HTTP service for querying the events DB without copying it or
+opening the dashboard. It only needs the standard library (asyncio, sqlite3).
+Every response is JSON. The endpoints are:
+    /events                     - events in the DB
+    /fleets                     - Fleet_Summary rows
+    /fleets/<id>                - the list of one fleet
+    /lists                      - the lists of all fleets of an event
+                                  (?event_id=) or of some fleets (?ids=1,2)
+    /popularity/<kind>          - ships, squadrons or upgrades by the number
+                                  of fleets running them
+    /matchups                   - games, wins and average margin between
+                                  factions (?by=faction) or commanders
+                                  (?by=commander)
+    /status                     - request and cache counters
+The list endpoints take query parameters to filter on (e.g.
+/fleets?event_id=3&faction=Empire) and limit/offset for paging.
+
+Queries run on a thread pool, each worker with its own read-only connection
+(analytics.connect_readonly with immutable=False), so the service can stay
+up while events are being ingested. The service never writes to the DB, so
+it does not apply migrations: a DB with an older schema is refused at
+startup (run python migrations.py on it first). Responses are kept in an LRU cache keyed
+by the request. Every commit to the DB (ingest, event_sync, make_views)
+changes the size or modification time of the DB file or its -wal file. When
+it does, the service reads the revision of every event (see event_sync) and
+keeps the cached responses for a single event (?event_id=) whose revision
+has not changed; responses over several events, or for events that changed,
+are dropped and the query runs again. Any change to the catalog or the
+schema drops everything. Identical requests that arrive while the query is
+running wait for the same result instead of running it again.
+
+Every response has an ETag (hash of the body). A request with a matching
+If-None-Match gets 304 Not Modified and no body, so clients that poll (e.g.
+a dashboard refresh) only download results that changed.
+
+Usage:
+    python query_service.py --port 8080
+    curl "http://127.0.0.1:8080/fleets?event_id=1&limit=5"
+
+benchmarks/loadtest.py measures requests per second against a running
+service.
+
+@author: alexe
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qsl
+import analytics
+import fleet_lists
+import make_views
+import sql_queries
+import db
+
+# Largest page of rows a list endpoint will return
+MAX_LIMIT = 10000
+
+# Longest request line or header line accepted
+MAX_LINE = 8192
+
+reasons = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request',
+           404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error'}
+
+# Error response for a request that cannot be answered
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# Query text per endpoint. {where} is replaced with the filters given in the
+# request, before any grouping, so aggregates only cover the filtered rows.
+events_query = """
+SELECT e.id AS id, e.name AS name, e.date AS date, e.region AS region,
+    e.url AS url, COALESCE(r.revision, 0) AS revision
+FROM Events AS e
+LEFT JOIN EventRevisions AS r ON r.event_id = e.id
+{where}
+ORDER BY e.date, e.id
+"""
+
+fleets_query = """
+SELECT * FROM Fleet_Summary
+{where}
+ORDER BY event_id, tp DESC, mov DESC
+"""
+
+ships_query = """
+SELECT * FROM Ship_Summary
+{where}
+ORDER BY num_fleets_containing DESC, name
+"""
+
+squadrons_query = """
+SELECT * FROM Squadron_Summary
+{where}
+ORDER BY num_fleets_containing DESC, name
+"""
+
+upgrades_query = f"""
+WITH ec AS ({sql_queries.event_catalog})
+SELECT u.id AS id,
+    f.event_id AS event_id,
+    un.name AS name,
+    us.name AS slot,
+    COUNT(DISTINCT fs.fleet_id) AS num_fleets_containing,
+    {make_views.cost('u')} AS cost
+FROM Fleets_Upgrades AS fu
+INNER JOIN Upgrades AS u ON u.id = fu.upgrade_id
+INNER JOIN UpgradeSlots AS us ON us.id = u.slot_id
+INNER JOIN UpgradeNames AS un
+    ON fu.upgrade_id = un.upgrade_id
+    AND un.canonical = 1
+INNER JOIN Fleets_Ships AS fs ON fs.id = fu.fleet_ship_id
+INNER JOIN Fleets AS f ON f.id = fs.fleet_id
+INNER JOIN Factions AS fn ON fn.id = f.faction_id{make_views.dated_cost('upgrade', 'u')}
+{{where}}
+GROUP BY u.id, f.event_id
+ORDER BY num_fleets_containing DESC, name
+"""
+
+# Every game from both sides, with the faction and commander of each fleet.
+# {side} is the column to compare (faction or commander).
+matchups_query = f"""
+WITH co AS ({make_views.get_commander}),
+sides AS (
+    SELECT fl.event_id AS event_id,
+        fl.player AS player,
+        fn.name AS faction,
+        co.commander AS commander
+    FROM Fleets AS fl
+    INNER JOIN Factions AS fn ON fn.id = fl.faction_id
+    LEFT JOIN co ON co.fleet_id = fl.id
+    )
+SELECT s1.{{side}} AS {{side}},
+    s2.{{side}} AS opponent,
+    COUNT(*) AS games,
+    SUM(CASE WHEN sc1.points > sc2.points THEN 1 ELSE 0 END) AS wins,
+    ROUND(AVG(sc1.tournament_points), 2) AS avg_tp,
+    ROUND(AVG(sc1.points - sc2.points), 1) AS avg_margin
+FROM Scores AS sc1
+INNER JOIN Scores AS sc2 ON sc1.opponent = sc2.player
+    AND sc1.event_id = sc2.event_id AND sc1.round = sc2.round
+INNER JOIN sides AS s1 ON s1.player = sc1.player
+    AND s1.event_id = sc1.event_id
+INNER JOIN sides AS s2 ON s2.player = sc2.player
+    AND s2.event_id = sc2.event_id
+{{where}}
+GROUP BY s1.{{side}}, s2.{{side}}
+ORDER BY games DESC, {{side}}, opponent
+"""
+
+# Filters accepted by each list endpoint: parameter -> (column, type)
+event_filters = {'event_id': ('event_id', int)}
+summary_filters = {**event_filters, 'faction': ('faction', str)}
+
+# Query, filters and conditions that always apply, for each list endpoint
+routes = {
+    'events': (events_query, {'region': ('e.region', str)}, []),
+    'fleets': (fleets_query, {**summary_filters,
+                              'commander': ('commander', str),
+                              'player': ('player', str)}, []),
+    'popularity/ships': (ships_query, summary_filters,
+                         ['num_fleets_containing > 0']),
+    'popularity/squadrons': (squadrons_query, summary_filters,
+                             ['num_fleets_containing > 0']),
+    'popularity/upgrades': (upgrades_query, {
+        'event_id': ('f.event_id', int),
+        'faction': ('fn.name', str),
+        'slot': ('us.name', str)}, []),
+    'matchups': (matchups_query, {'event_id': ('sc1.event_id', int),
+                                  'faction': ('s1.faction', str)}, []),
+    }
+
+# Columns matchups can be grouped by
+matchup_sides = ('faction', 'commander')
+
+# What responses depend on besides the data of each event: the schema (views
+# rebuilt by make_views) and the catalog versions (costs)
+get_catalog_state = """
+SELECT (SELECT schema_version FROM pragma_schema_version),
+    (SELECT MAX(id) FROM CatalogVersions)
+"""
+
+# Fixed set of read-only connections, one per query thread
+class ConnectionPool:
+    def __init__(self, path=db.DEFAULT_PATH, size=4):
+        self.path = path
+        self.size = size
+        self._idle = queue.SimpleQueue()
+        for _ in range(size):
+            self._idle.put(analytics.connect_readonly(path, immutable=False))
+
+    # Call func(conn, *args) with a connection from the pool
+    def run(self, func, *args):
+        conn = self._idle.get()
+        try:
+            return func(conn, *args)
+        finally:
+            self._idle.put(conn)
+
+    def execute(self, query, params=()):
+        def fetch(conn):
+            cursor = conn.execute(query, params)
+            return [d[0] for d in cursor.description], cursor.fetchall()
+        return self.run(fetch)
+
+    def close(self):
+        for _ in range(self.size):
+            self._idle.get().close()
+
+# LRU cache of response bodies. Entries are only returned for the
+# generation (DB file signature) they were made for. Each entry also has the
+# event it covers (None for responses over several events).
+class ResponseCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.kept = 0
+
+    def get(self, key, generation):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != generation:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def put(self, key, generation, etag, body, event_id=None):
+        self.entries[key] = (generation, etag, body, event_id)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    # The DB went from generation old to new: keep the entries of old for
+    # events in unchanged, and drop the rest
+    def revalidate(self, old, new, unchanged):
+        for key, entry in list(self.entries.items()):
+            if entry[0] == old and entry[3] in unchanged:
+                self.entries[key] = (new,) + entry[1:]
+                self.kept += 1
+            else:
+                del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+def make_etag(body):
+    return '"' + hashlib.sha1(body).hexdigest()[:24] + '"'
+
+def etag_matches(header, etag):
+    if header is None:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+def to_json(value):
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+def parse_int(params, name, default=None):
+    if name not in params:
+        return default
+    try:
+        return int(params[name])
+    except ValueError:
+        raise RequestError(400, f'{name} must be an integer')
+
+# Event a response only depends on the data of, or None
+def response_event(route, params):
+    if route in ('events', 'status') or route.startswith('fleets/') \
+            or 'ids' in params:
+        return None
+    try:
+        return int(params['event_id'])
+    except (KeyError, ValueError):
+        return None
+
+class QueryService:
+    def __init__(self, path=db.DEFAULT_PATH, pool_size=4, cache_size=256):
+        # The service never writes: fail early if the schema is out of date
+        db.connect_readonly(path).close()
+        self.path = path
+        self.pool = ConnectionPool(path, pool_size)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.cache = ResponseCache(cache_size)
+        self.requests = 0
+        self.not_modified = 0
+        self.queries = 0
+        self._pending = {}
+        # DB generation the cache is valid for, with the event revisions and
+        # catalog state read at that generation
+        self.generation = None
+        self.revisions = {}
+        self.catalog_state = None
+        self._state_lock = asyncio.Lock()
+
+    # Build the query and parameters for a list endpoint
+    def list_query(self, route, params):
+        query, filters, conditions = routes[route]
+        conditions = list(conditions)
+        args = []
+        for name, (column, kind) in filters.items():
+            if name not in params:
+                continue
+            conditions.append(f'{column} = ?')
+            args.append(parse_int(params, name) if kind is int
+                        else params[name])
+        if route == 'matchups':
+            side = params.get('by', 'faction')
+            if side not in matchup_sides:
+                raise RequestError(400, 'by must be one of '
+                                   + ', '.join(matchup_sides))
+            query = query.replace('{side}', side)
+        where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+        query = query.replace('{where}', where)
+
+        limit = parse_int(params, 'limit', MAX_LIMIT)
+        offset = parse_int(params, 'offset', 0)
+        # SQLite reads a negative limit as no limit
+        if not 0 <= limit <= MAX_LIMIT:
+            raise RequestError(400, f'limit must be from 0 to {MAX_LIMIT}')
+        if offset < 0:
+            raise RequestError(400, 'offset must not be negative')
+        return query + ' LIMIT ? OFFSET ?', args + [limit, offset]
+
+    def fleets(self, fleet_ids=None, event_id=None):
+        return self.pool.run(fleet_lists.get_fleets, fleet_ids, event_id)
+
+    def lists(self, params):
+        if 'ids' in params:
+            try:
+                ids = [int(ii) for ii in params['ids'].split(',') if ii]
+            except ValueError:
+                raise RequestError(400, 'ids must be integers')
+            return self.fleets(fleet_ids=ids)
+        if 'event_id' in params:
+            return self.fleets(event_id=parse_int(params, 'event_id'))
+        raise RequestError(400, 'lists needs event_id or ids')
+
+    # Run the query for a request (on a pool thread) and encode the result
+    def answer(self, route, params):
+        self.queries += 1
+        if route.startswith('fleets/'):
+            try:
+                fleet_id = int(route.split('/', 1)[1])
+            except ValueError:
+                raise RequestError(404, f'unknown path /{route}')
+            fleet = self.fleets([fleet_id]).get(fleet_id)
+            if fleet is None:
+                raise RequestError(404, f'no fleet with id {fleet_id}')
+            return to_json(fleet)
+        if route == 'lists':
+            return to_json(list(self.lists(params).values()))
+        if route not in routes:
+            raise RequestError(404, f'unknown path /{route}')
+        query, args = self.list_query(route, params)
+        names, rows = self.pool.execute(query, args)
+        return to_json([dict(zip(names, row)) for row in rows])
+
+    # Event revisions and catalog state of the DB
+    def read_state(self):
+        def fetch(conn):
+            revisions = dict(conn.execute(
+                sql_queries.get_event_revisions_where.format(where='1')))
+            return revisions, conn.execute(get_catalog_state).fetchone()
+        return self.pool.run(fetch)
+
+    # After the DB has changed, keep cached responses for events whose
+    # revision has not changed (as long as the catalog and schema have not
+    # either) and drop the others, so an ingest of one event does not empty
+    # the cache for all of them
+    async def refresh(self, gen):
+        async with self._state_lock:
+            if gen == self.generation:
+                return
+            loop = asyncio.get_running_loop()
+            revisions, catalog_state = await loop.run_in_executor(
+                self.executor, self.read_state)
+            unchanged = set()
+            if catalog_state == self.catalog_state:
+                unchanged = {ev_id for ev_id, rev in revisions.items()
+                             if self.revisions.get(ev_id) == rev}
+            self.cache.revalidate(self.generation, gen, unchanged)
+            self.generation = gen
+            self.revisions = revisions
+            self.catalog_state = catalog_state
+
+    def status(self):
+        return {'requests': self.requests,
+                'not_modified': self.not_modified,
+                'queries': self.queries,
+                'cache_entries': len(self.cache.entries),
+                'cache_hits': self.cache.hits,
+                'cache_misses': self.cache.misses,
+                'cache_kept': self.cache.kept,
+                'pool_size': self.pool.size}
+
+    # Response body and ETag for a GET request, from the cache if the DB has
+    # not changed since it was made
+    async def get(self, target):
+        parts = urlsplit(target)
+        route = parts.path.strip('/')
+        if route == 'status':
+            body = to_json(self.status())
+            return make_etag(body), body
+        params = dict(parse_qsl(parts.query))
+        key = (route, tuple(sorted(params.items())))
+        gen = db.generation(self.path)
+        if gen != self.generation:
+            await self.refresh(gen)
+        cached = self.cache.get(key, gen)
+        if cached is not None:
+            return cached
+
+        # The query is shared by identical requests and stored in the cache
+        # when done, even if the client that started it has gone
+        pending = self._pending.get((key, gen))
+        if pending is None:
+            loop = asyncio.get_running_loop()
+            pending = loop.run_in_executor(self.executor, self.answer, route,
+                                           params)
+            self._pending[(key, gen)] = pending
+            event_id = response_event(route, params)
+            def store(future):
+                del self._pending[(key, gen)]
+                if not future.cancelled() and future.exception() is None:
+                    body = future.result()
+                    self.cache.put(key, gen, make_etag(body), body, event_id)
+            pending.add_done_callback(store)
+        body = await asyncio.shield(pending)
+        return make_etag(body), body
+
+    async def respond(self, method, target, headers):
+        if method not in ('GET', 'HEAD'):
+            raise RequestError(405, f'{method} is not supported')
+        try:
+            etag, body = await self.get(target)
+        except RequestError:
+            raise
+        except Exception as e:
+            logging.exception(f'Request for {target} failed')
+            raise RequestError(500, f'{type(e).__name__}: {e}')
+        if etag_matches(headers.get('if-none-match'), etag):
+            self.not_modified += 1
+            return 304, etag, b''
+        return 200, etag, body
+
+    # Serve requests on one client connection, keeping it open between
+    # requests unless the client asks otherwise
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    await self.write(writer, 400, None,
+                                     to_json({'error': 'bad request line'}),
+                                     False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' \
+                    if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+                self.requests += 1
+                try:
+                    status, etag, body = await self.respond(method, target,
+                                                            headers)
+                except RequestError as e:
+                    status, etag = e.status, None
+                    body = to_json({'error': str(e)})
+                if method == 'HEAD':
+                    body = b''
+                await self.write(writer, status, etag, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def write(self, writer, status, etag, body, keep_alive):
+        head = [f'HTTP/1.1 {status} {reasons[status]}',
+                'Content-Type: application/json',
+                f'Content-Length: {len(body)}',
+                'Cache-Control: no-cache',
+                'Connection: ' + ('keep-alive' if keep_alive else 'close')]
+        if etag:
+            head.append(f'ETag: {etag}')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+                     + body)
+        await writer.drain()
+
+    async def start(self, host='127.0.0.1', port=8080):
+        return await asyncio.start_server(self.handle, host, port,
+                                          limit=MAX_LINE)
+
+    def close(self):
+        self.executor.shutdown()
+        self.pool.close()
+
+# Run a service on its own event loop in a background thread, for tests,
+# benchmarks and scripts that want a server next to other work.
+class ServiceThread:
+    def __init__(self, path=db.DEFAULT_PATH, port=0, **kwargs):
+        self.service = QueryService(path, **kwargs)
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self._server = self.loop.run_until_complete(
+            self.service.start(port=self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started.set()
+        self.loop.run_forever()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self):
+        async def shutdown():
+            self._server.close()
+            await self._server.wait_closed()
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        self.service.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+async def serve(path, host, port, pool_size, cache_size):
+    service = QueryService(path, pool_size, cache_size)
+    server = await service.start(host, port)
+    print(f'Serving {path} at http://{host}:{port}')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="query_service",
+        description="read-only HTTP query service over the Armada SQL DB")
+    parser.add_argument("--db", type=str, default=db.DEFAULT_PATH)
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--pool-size", type=int, default=4,
+                        help="number of read-only connections (and query"
+                        + " threads)")
+    parser.add_argument("--cache-size", type=int, default=256,
+                        help="number of responses kept in the cache")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.db, args.host, args.port,
+                          max(1, args.pool_size), args.cache_size))
+    except ValueError as e:
+        parser.error(str(e))
+    except KeyboardInterrupt:
+        pass
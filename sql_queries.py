@@ -12,6 +12,28 @@ one row and column.
 
 get_event_from_url = "SELECT id FROM Events WHERE url = ?"
 
+# Event revisions (see event_sync). Events with no row in EventRevisions are
+# at revision 0.
+get_event_revision = """
+SELECT revision FROM EventRevisions WHERE event_id = ?
+"""
+
+bump_event_revision = """
+INSERT INTO EventRevisions (event_id, revision, updated)
+VALUES (?, 1, datetime('now'))
+ON CONFLICT (event_id) DO UPDATE
+SET revision = revision + 1, updated = excluded.updated
+"""
+
+# Revision of every event in a selection. {where} is a condition on Events
+# (as e).
+get_event_revisions_where = """
+SELECT e.id, COALESCE(r.revision, 0) FROM Events AS e
+LEFT JOIN EventRevisions AS r ON r.event_id = e.id
+WHERE {where}
+ORDER BY e.id
+"""
+
 get_fleet_from_event_player = """
 SELECT id FROM Fleets WHERE event_id = ? AND player = ?
 """
@@ -24,10 +46,10 @@ WHERE LOWER(name) = ? OR LOWER(alias) = ?
 get_faction_from_ship = "SELECT faction_id FROM Ships WHERE id = ?"
 
 get_commander_from_upgrades = """
-SELECT MIN(n.name) FROM UpgradeNames AS n
+SELECT n.name FROM UpgradeNames AS n
 LEFT JOIN Upgrades AS u ON n.upgrade_id = u.id
-WHERE u.slot_id = 1 AND u.id IN (SELECT value FROM json_each(?))
-GROUP BY n.upgrade_id
+WHERE u.slot_id = 1 AND n.canonical = 1
+    AND u.id IN (SELECT value FROM json_each(?))
 """
 
 get_ship_from_name = """
@@ -116,7 +138,7 @@ SELECT fl.id AS fleet_id,
 FROM Fleets_Upgrades AS fu
 INNER JOIN UpgradeNames AS un
     ON fu.upgrade_id = un.upgrade_id
-    AND un.name IN (SELECT MIN(name) FROM UpgradeNames GROUP BY upgrade_id)
+    AND un.canonical = 1
 LEFT JOIN Fleets_Ships as fs ON fs.id = fu.fleet_ship_id
 LEFT JOIN Fleets as fl ON fl.id = fs.fleet_id
 WHERE fl.id = ?
@@ -125,13 +147,115 @@ SELECT fs.fleet_id AS fleet_id,
     sn.name AS name
 FROM Fleets_Ships AS fs
 INNER JOIN ShipNames AS sn ON fs.ship_id = sn.ship_id
-    AND sn.name IN (SELECT MAX(name) FROM ShipNames GROUP BY ship_id)
+    AND sn.canonical = 1
 WHERE fs.fleet_id = ?
 UNION
 SELECT fq.fleet_id AS fleet_id,
     qn.name AS name
 FROM Fleets_Squadrons AS fq
 INNER JOIN SquadronNames AS qn ON fq.squadron_id = qn.squadron_id
-    AND qn.name IN (SELECT MAX(name) FROM SquadronNames GROUP BY squadron_id)
+    AND qn.canonical = 1
 WHERE fq.fleet_id = ?
-"""
\ No newline at end of file
+"""
+# Catalog version in effect for each event: the latest one that took effect on
+# or before the event date (the latest of all for events without a date).
+# version_id is NULL if no catalog versions have been imported. Used as a CTE.
+event_catalog = """
+SELECT e.id AS event_id,
+    (SELECT v.id FROM CatalogVersions AS v
+     WHERE v.effective_date <= COALESCE(e.date, '9999-12-31')
+     ORDER BY v.effective_date DESC, v.id DESC LIMIT 1) AS version_id
+FROM Events AS e
+"""
+
+# Costs of the catalog version in effect for the events of a selection of
+# fleets (see fleet_lists)
+get_event_costs_where = f"""
+WITH ec AS ({event_catalog})
+SELECT ec.event_id, cc.kind, cc.component_id, cc.cost FROM ec
+INNER JOIN CatalogCosts AS cc ON cc.version_id = ec.version_id
+WHERE ec.event_id IN (SELECT DISTINCT fl.event_id FROM Fleets AS fl
+                      WHERE {{where}})
+"""
+
+# Canonical name of every component with its cost, for rebuilding fleet
+# lists (see fleet_lists)
+get_ship_display_names = """
+SELECT s.id, n.name, s.cost FROM Ships AS s
+INNER JOIN ShipNames AS n ON n.ship_id = s.id AND n.canonical = 1
+"""
+
+get_upgrade_display_names = """
+SELECT u.id, n.name, u.cost, u.slot_id FROM Upgrades AS u
+INNER JOIN UpgradeNames AS n ON n.upgrade_id = u.id AND n.canonical = 1
+"""
+
+get_squadron_display_names = """
+SELECT q.id, n.name, q.cost FROM Squadrons AS q
+INNER JOIN SquadronNames AS n ON n.squadron_id = q.id AND n.canonical = 1
+"""
+
+# Rows of the fleet tables for a selection of fleets, in list order. {where}
+# is a condition on Fleets (as fl), see fleet_lists.fleet_filter.
+get_fleets_where = """
+SELECT fl.id, fl.event_id, fl.player, fn.name FROM Fleets AS fl
+LEFT JOIN Factions AS fn ON fn.id = fl.faction_id
+WHERE {where}
+ORDER BY fl.id
+"""
+
+# Same selection with the faction id (0 if none), for compact_fleet
+get_fleet_ids_where = """
+SELECT fl.id, fl.event_id, fl.player, COALESCE(fl.faction_id, 0)
+FROM Fleets AS fl
+WHERE {where}
+ORDER BY fl.id
+"""
+
+get_fleets_ships_where = """
+SELECT fs.fleet_id, fs.id, fs.ship_id FROM Fleets_Ships AS fs
+INNER JOIN Fleets AS fl ON fl.id = fs.fleet_id
+WHERE {where}
+ORDER BY fs.fleet_id, fs.id
+"""
+
+get_fleets_upgrades_where = """
+SELECT fu.fleet_ship_id, fu.upgrade_id FROM Fleets_Upgrades AS fu
+INNER JOIN Fleets_Ships AS fs ON fs.id = fu.fleet_ship_id
+INNER JOIN Fleets AS fl ON fl.id = fs.fleet_id
+WHERE {where}
+ORDER BY fu.rowid
+"""
+
+get_fleets_squadrons_where = """
+SELECT fq.fleet_id, fq.squadron_id, fq.count FROM Fleets_Squadrons AS fq
+INNER JOIN Fleets AS fl ON fl.id = fq.fleet_id
+WHERE {where}
+ORDER BY fq.rowid
+"""
+
+# Games between two players who both have a fleet in the DB, once per game
+# (from the side of the player whose name sorts first), for attribution.
+# {where} is a condition on Events (as e).
+get_games_where = """
+SELECT s1.event_id, s1.round, f1.id, f2.id,
+    s1.tournament_points, s2.tournament_points
+FROM Scores AS s1
+INNER JOIN Scores AS s2 ON s2.event_id = s1.event_id
+    AND s2.round = s1.round AND s2.player = s1.opponent
+INNER JOIN Fleets AS f1 ON f1.event_id = s1.event_id
+    AND f1.player = s1.player
+INNER JOIN Fleets AS f2 ON f2.event_id = s2.event_id
+    AND f2.player = s2.player
+INNER JOIN Events AS e ON e.id = s1.event_id
+WHERE s1.player < s2.player AND {where}
+ORDER BY s1.event_id, s1.round, f1.id
+"""
+
+# Tournament points of every game of an event window, for the player
+# strength covariate (see attribution)
+get_player_games_where = """
+SELECT sc.player, sc.event_id, sc.tournament_points FROM Scores AS sc
+INNER JOIN Events AS e ON e.id = sc.event_id
+WHERE {where}
+"""
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures shared by the tests: generated events DBs and a guard against
+prompts for user input
+
+@author: alexe
+"""
+import builtins
+import sqlite3
+import pytest
+import db
+from benchmarks import generator
+
+# Size and seed of the generated events DB. Override it in a test module with
+# a fixture of the same name, or for one test with
+# @pytest.mark.parametrize('db_params', [{...}])
+@pytest.fixture
+def db_params():
+    return {'num_players': 6, 'num_rounds': 2, 'num_events': 2, 'seed': 1}
+
+# Factory for generated events DBs in the test's tmp_path. make_db(**params)
+# takes the generator.generate_database arguments and returns the path and
+# the generated events.
+@pytest.fixture
+def make_db(tmp_path):
+    def make(name='events.sql', **params):
+        path = str(tmp_path / name)
+        return path, generator.generate_database(db.DEFAULT_PATH, path,
+                                                 **params)
+    return make
+
+# Events DB generated with db_params: (path, generated events)
+@pytest.fixture
+def generated(make_db, db_params):
+    return make_db(**db_params)
+
+# Plain sqlite3 connection to the generated events DB
+@pytest.fixture
+def conn(generated):
+    conn = sqlite3.connect(generated[0])
+    yield conn
+    conn.close()
+
+# Fail the test instead of waiting for input() when the code asks the user
+@pytest.fixture
+def no_input(monkeypatch):
+    def no_input(prompt=''):
+        raise RuntimeError(f'asked for user input: {prompt}')
+    monkeypatch.setattr(builtins, 'input', no_input)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for analytics, reading a generated events DB into Arrow tables
+
+@author: alexe
+"""
+import pytest
+pa = pytest.importorskip('pyarrow')
+import analytics
+
+def test_readonly_uri(generated):
+    path, _ = generated
+    uri = analytics.readonly_uri(path)
+    assert uri.startswith('file:/') and 'mode=ro' in uri
+    assert 'immutable=1' in uri
+    assert 'immutable' not in analytics.readonly_uri(path, immutable=False)
+
+    # An open WAL means recent rows are not in the DB file yet
+    with open(path + '-wal', 'wb'):
+        pass
+    assert 'immutable' not in analytics.readonly_uri(path)
+
+def test_column_array():
+    assert analytics.column_array([1, 2, None]).type == pa.int64()
+    mixed = analytics.column_array([1, 'a', 2.5, None])
+    assert mixed.type == pa.string()
+    assert mixed.to_pylist() == ['1', 'a', '2.5', None]
+    for values in ([None, None], []):
+        arr = analytics.column_array(values)
+        assert arr.type == pa.string() and arr.null_count == len(values)
+
+def test_query_table(generated):
+    path, _ = generated
+    table = analytics.query_table('SELECT id, player, faction_id'
+                                  + ' FROM Fleets ORDER BY id', path=path)
+    assert table.num_rows == 12
+    assert table.column_names == ['id', 'player', 'faction_id']
+    assert table.column('id').to_pylist() == list(range(1, 13))
+
+    # Empty results keep their columns
+    empty = analytics.query_table('SELECT id, player FROM Fleets WHERE 0',
+                                  path=path)
+    assert empty.num_rows == 0 and empty.column_names == ['id', 'player']
+
+    batches = list(analytics.query_batches('SELECT * FROM Scores',
+                                           path=path, batch_size=5))
+    assert all(batch.num_rows <= 5 for batch in batches)
+    assert sum(batch.num_rows for batch in batches) == analytics.query_table(
+        'SELECT COUNT(*) AS n FROM Scores', path=path).column('n')[0].as_py()
+
+@pytest.mark.parametrize('ext', ['csv', 'parquet', 'arrow'])
+def test_export_round_trip(generated, tmp_path, ext):
+    path, _ = generated
+    query = 'SELECT * FROM Scores ORDER BY rowid'
+    out = str(tmp_path / f'scores.{ext}')
+    table = analytics.query_table(query, path=path)
+    assert analytics.export(query, out, path=path) == table.num_rows
+    if ext == 'csv':
+        import pyarrow.csv as pa_csv
+        read = pa_csv.read_csv(out)
+    elif ext == 'parquet':
+        import pyarrow.parquet as pq
+        read = pq.read_table(out)
+    else:
+        import pyarrow.feather as feather
+        read = feather.read_table(out)
+    assert read.column_names == table.column_names
+    assert read.to_pylist() == table.to_pylist()
+
+    with pytest.raises(ValueError):
+        analytics.export(query, str(tmp_path / 'scores.xlsx'), path=path)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the armada command line and the imports made at startup
+
+@author: alexe
+"""
+import csv
+import subprocess
+import sys
+import pytest
+import armada
+from benchmarks import importtime
+
+# Modules loaded by importing module in a fresh interpreter, run in an empty
+# directory
+def loaded_modules(module, cwd):
+    code = (f'import sys; sys.path.insert(0, {importtime.ROOT!r}); '
+            + f'import {module}; print(" ".join(sys.modules))')
+    res = subprocess.run([sys.executable, '-c', code], cwd=cwd,
+                         capture_output=True, text=True, check=True)
+    return set(res.stdout.split())
+
+@pytest.mark.parametrize('module', ['event_to_file', 'event_sync',
+                                    'web_scraper', 'make_views', 'armada'])
+def test_import_side_effects(module, tmp_path):
+    modules = loaded_modules(module, tmp_path)
+    assert module in modules
+    assert not modules & set(importtime.heavy_modules)
+    # No log directory or files are created by importing
+    assert not list(tmp_path.iterdir())
+
+# Sync and watch modes are only loaded when they are used
+def test_scrape_imports(tmp_path):
+    modules = loaded_modules('web_scraper', tmp_path)
+    assert not modules & {'event_sync', 'event_watch', 'urllib.request'}
+
+@pytest.mark.parametrize('name', ['scrape', 'ingest', 'views'])
+def test_command_startup(name):
+    res = importtime.command_startup(name)
+    assert res['modules'] > 0
+    assert res['heavy'] == []
+
+def test_dispatch(make_db, tmp_path, capsys):
+    pytest.importorskip('pyarrow')
+    path, _ = make_db(num_players=8, num_rounds=2, num_events=1, seed=3)
+    out = str(tmp_path / 'players.csv')
+    armada.main(['export', 'Scores', '-o', out, '--db', path])
+    assert 'Wrote' in capsys.readouterr().out
+    with open(out, newline='') as f:
+        rows = list(csv.reader(f))
+    assert len(rows) > 1
+
+    with pytest.raises(SystemExit):
+        armada.main(['unknown'])
+    with pytest.raises(SystemExit):
+        armada.main(['export'])
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for attribution, on simulated games and a generated events DB
+
+@author: alexe
+"""
+import os
+import numpy as np
+import pytest
+import attribution
+import compact_fleet
+import cooccurrence
+import event_to_file
+import fleet_lists
+import sql_queries
+
+@pytest.fixture
+def db_params():
+    return {'num_players': 16, 'num_rounds': 3, 'num_events': 3,
+            'seed': 13}
+
+# Games between random fleets of num_features components, won according to
+# a logistic model with the given true effects
+def simulated(true_w, num_games, seed):
+    rng = np.random.default_rng(seed)
+    x = rng.random((num_games, 2, len(true_w))) < 0.3
+    diff = x[:, 0].astype(float) - x[:, 1]
+    y = rng.random(num_games) < 1. / (1. + np.exp(-diff @ true_w))
+    rows, cols = np.nonzero(diff)
+    return {'rows': rows, 'cols': cols, 'vals': diff[rows, cols],
+            'y': y.astype(float), 'num_features': len(true_w)}
+
+def test_fit():
+    true_w = np.array([1.5, -1., 0., 0.5, 0., -0.5])
+    data = simulated(true_w, 4000, seed=1)
+    w = attribution.fit(data, l2=1.)
+    assert np.abs(w - true_w).max() < 0.3
+    # Optimal: the gradient of the regularized loss is zero
+    p = 1. / (1. + np.exp(-attribution.matvec(data, w)))
+    grad = attribution.rmatvec(data, p - data['y']) + w
+    assert np.abs(grad).max() < 1e-2
+
+    # Weights of 2 are the same as duplicating games
+    weights = np.ones(4000)
+    weights[:100] = 2.
+    doubled = {key: data[key] for key in data}
+    extra = data['rows'] < 100
+    doubled['rows'] = np.concatenate([data['rows'],
+                                      data['rows'][extra] + 4000])
+    doubled['cols'] = np.concatenate([data['cols'], data['cols'][extra]])
+    doubled['vals'] = np.concatenate([data['vals'], data['vals'][extra]])
+    doubled['y'] = np.concatenate([data['y'], data['y'][:100]])
+    assert np.allclose(attribution.fit(data, weights=weights, tol=1e-9),
+                       attribution.fit(doubled, tol=1e-9), atol=1e-4)
+
+def test_dataset(conn):
+    data = attribution.build_dataset(conn, min_fleets=2, strength=True)
+    games = conn.execute(
+        'SELECT COUNT(*) FROM Scores AS s1 INNER JOIN Scores AS s2'
+        + ' ON s2.event_id = s1.event_id AND s2.round = s1.round'
+        + ' AND s2.player = s1.opponent'
+        + ' WHERE s1.player < s2.player'
+        + ' AND s1.tournament_points <> s2.tournament_points').fetchone()[0]
+    assert len(data['y']) == games > 0
+    assert data['num_features'] == len(data['items']) + 1
+    assert set(data['y']) <= {0., 1.}
+    assert all(n >= 2 for n in data['num_fleets'])
+
+    # First game: +1 for components only in the first fleet, -1 for those
+    # only in the second
+    _, _, f1, f2, _, _ = next(
+        row for row in conn.execute(sql_queries.get_games_where.format(
+            where='1'))
+        if row[4] != row[5])
+    archive = compact_fleet.FleetArchive.from_db(conn, [f1, f2])
+    commanders = fleet_lists.get_names(conn).commanders
+    items = {archive.ids[ii]: cooccurrence.fleet_items(archive, ii,
+                                                       commanders)
+             for ii in range(2)}
+    first = data['rows'] == 0
+    row = {data['items'][c]: v for c, v in zip(data['cols'][first],
+                                               data['vals'][first])
+           if c < len(data['items'])}
+    expected = {i: 1. for i in items[f1] - items[f2]} \
+        | {i: -1. for i in items[f2] - items[f1]}
+    assert row == {i: v for i, v in expected.items() if i in data['items']}
+
+    window = attribution.build_dataset(conn, event_ids=[2])
+    assert 0 < len(window['y']) < len(data['y'])
+
+def test_fit_window(conn, tmp_path):
+    cache = str(tmp_path / 'models')
+    model = attribution.fit_window(conn, bootstrap=4, workers=2,
+                                   cache_dir=cache)
+    assert len(os.listdir(cache)) == 1
+    assert attribution.fit_window(conn, bootstrap=4, workers=2,
+                                  cache_dir=cache) is model
+    table = model.table()
+    assert len(table) == len(model.items)
+    assert [row[1] for row in table] == sorted((row[1] for row in table),
+                                               reverse=True)
+    assert all(lower <= upper for _, _, lower, upper, _ in table)
+
+    # Loaded from the cache directory once the in-memory cache is gone
+    attribution._models.clear()
+    loaded = attribution.fit_window(conn, bootstrap=4, workers=2,
+                                    cache_dir=cache)
+    assert np.array_equal(loaded.coef, model.coef)
+
+def test_window_revisions(conn, monkeypatch):
+    calls = []
+    build_dataset = attribution.build_dataset
+    def counted(*args):
+        calls.append(args)
+        return build_dataset(*args)
+    monkeypatch.setattr(attribution, 'build_dataset', counted)
+    model = attribution.fit_window(conn, min_fleets=2)
+    assert attribution.fit_window(conn, min_fleets=2) is model
+    assert len(calls) == 1
+
+    # Changing an event's games and bumping its revision refits the window
+    conn.execute('DELETE FROM Scores WHERE event_id = 2 AND round = 1')
+    event_to_file.invalidate(conn, 2)
+    refit = attribution.fit_window(conn, min_fleets=2)
+    assert len(calls) == 2
+    assert refit.num_games < model.num_games
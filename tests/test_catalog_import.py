@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for catalog_import, loading releases into a generated events DB
+
+@author: alexe
+"""
+import json
+import random
+import pytest
+import catalog_import
+import db
+import event_to_file
+import fleet_lists
+import make_views
+import sql_queries
+from benchmarks import generator
+
+@pytest.fixture
+def db_params():
+    return {'num_players': 6, 'num_rounds': 2, 'num_events': 2,
+            'seed': 5}
+
+@pytest.fixture
+def events_db(generated):
+    conn = db.connect(generated[0])
+    conn.execute("UPDATE Events SET date = '2025-01-10' WHERE id = 1")
+    conn.execute("UPDATE Events SET date = '2025-03-10' WHERE id = 2")
+    conn.commit()
+    make_views.build_views(conn, force=True)
+    yield conn
+    conn.close()
+
+def write_release(tmp_path, catalog, version, date):
+    path = str(tmp_path / f'{version}.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({**catalog, 'version': version, 'effective_date': date}, f)
+    return path
+
+def fleet_costs(conn):
+    return dict(conn.execute('SELECT id, total_cost FROM Fleet_Summary'))
+
+def test_round_trip(events_db, tmp_path):
+    conn = events_db
+    catalog = catalog_import.export_catalog(conn)
+    costs = fleet_costs(conn)
+    path = write_release(tmp_path, catalog, 'same', '2025-02-01')
+    res = catalog_import.import_release(conn, path)
+    assert all(not kind['added'] and not kind['changed']
+               and not kind['missing'] for kind in res['diff'].values())
+    assert catalog_import.export_catalog(conn) == catalog
+    assert fleet_costs(conn) == costs
+    # Baseline and the release
+    assert conn.execute('SELECT COUNT(*) FROM CatalogVersions').fetchone() \
+        == (2,)
+    again = catalog_import.import_release(conn, path)
+    assert again['skipped'] and again['version_id'] is None
+
+def test_dated_costs(events_db, tmp_path):
+    conn = events_db
+    catalog = catalog_import.export_catalog(conn)
+    old_costs = fleet_costs(conn)
+    ship_id = conn.execute('SELECT ship_id FROM Fleets_Ships'
+                           + ' GROUP BY ship_id ORDER BY COUNT(*) DESC'
+                           ).fetchone()[0]
+    ship = next(e for e in catalog['ships'] if e['id'] == ship_id)
+    ship['cost'] += 10
+    # Added by name, without an id
+    catalog['squadrons'].append({'name': 'Test Squadron', 'faction': 'rebel',
+                                 'cost': 11, 'uniq': 0})
+    path = write_release(tmp_path, catalog, 'errata', '2025-02-01')
+
+    res = catalog_import.import_release(conn, path, dry_run=True)
+    assert res['version_id'] is None
+    assert res['diff']['ship']['changed'] == {
+        ship['name']: {'cost': [ship['cost'] - 10, ship['cost']]}}
+    assert res['diff']['squadron']['added'] == ['Test Squadron']
+    assert catalog_import.export_catalog(conn) != catalog
+
+    res = catalog_import.import_release(conn, path)
+    assert res['version_id'] is not None
+    assert conn.execute('SELECT cost FROM Ships WHERE id = ?',
+                        (ship_id,)).fetchone() == (ship['cost'],)
+    assert conn.execute("SELECT squadron_id FROM SquadronNames"
+                        + " WHERE name = 'Test Squadron' AND canonical = 1"
+                        ).fetchone()
+
+    # Fleets of the event before the errata keep the old costs
+    new_costs = fleet_costs(conn)
+    counts = dict(conn.execute(
+        'SELECT f.id, COUNT(fs.id) FROM Fleets AS f'
+        + ' LEFT JOIN Fleets_Ships AS fs'
+        + ' ON fs.fleet_id = f.id AND fs.ship_id = ? GROUP BY f.id',
+        (ship_id,)))
+    events = dict(conn.execute('SELECT id, event_id FROM Fleets'))
+    for fleet_id, cost in new_costs.items():
+        extra = 10 * counts[fleet_id] if events[fleet_id] == 2 else 0
+        assert cost == old_costs[fleet_id] + extra
+    assert any(counts[f] for f in counts if events[f] == 2)
+
+    fleets = fleet_lists.get_fleets(conn)
+    for fleet in fleets.values():
+        for s in fleet['ships']:
+            if s['id'] == ship_id:
+                assert s['base_cost'] == ship['cost'] \
+                    - (10 if fleet['event_id'] == 1 else 0)
+
+    # An older release only adds its snapshot
+    catalog['ships'][0]['cost'] += 100
+    path = write_release(tmp_path, catalog, 'older', '2025-01-01')
+    catalog_import.import_release(conn, path)
+    assert catalog_import.export_catalog(conn)['ships'][0]['cost'] \
+        == catalog['ships'][0]['cost'] - 100
+
+def test_bad_release(events_db, tmp_path):
+    conn = events_db
+    catalog = catalog_import.export_catalog(conn)
+    catalog['upgrades'][0]['slot'] = 'Nonsense'
+    path = write_release(tmp_path, catalog, 'bad', '2025-02-01')
+    with pytest.raises(ValueError):
+        catalog_import.import_release(conn, path)
+    assert conn.execute('SELECT COUNT(*) FROM CatalogVersions').fetchone() \
+        == (0,)
+
+# Events added from their page get the version in effect on the page's date
+def test_event_page_dates(events_db, tmp_path):
+    bs4 = pytest.importorskip('bs4')
+    conn = events_db
+    catalog = catalog_import.export_catalog(conn)
+    catalog['ships'][0]['cost'] += 10
+    version_id = catalog_import.import_release(
+        conn, write_release(tmp_path, catalog, 'errata', '2025-04-05')
+        )['version_id']
+    catalog['ships'][0]['cost'] += 10
+    catalog_import.import_release(
+        conn, write_release(tmp_path, catalog, 'later', '2025-04-06'))
+
+    event = generator.generate_event(random.Random(2),
+                                     generator.Catalog(conn), 4, 1, 'Dated')
+    versions = {}
+    for date in ('2025-04-04', '2025-04-05', '2025-12-31'):
+        event.update(date=date, url=f'https://t4.tools/e/Dated_{date}')
+        soup = bs4.BeautifulSoup(generator.event_html(event), 'html5lib')
+        ev_id = event_to_file.get_event(soup, conn, event['url'], date)
+        assert conn.execute('SELECT date FROM Events WHERE id = ?',
+                            (ev_id,)).fetchone() == (date,)
+        versions[date] = conn.execute(
+            f'SELECT version_id FROM ({sql_queries.event_catalog})'
+            + ' WHERE event_id = ?', (ev_id,)).fetchone()[0]
+    assert versions['2025-04-05'] == version_id
+    assert versions['2025-04-04'] < version_id < versions['2025-12-31']
+
+def test_component_without_name(events_db, tmp_path):
+    conn = events_db
+    ship_id = conn.execute('SELECT MAX(id) FROM Ships').fetchone()[0]
+    conn.execute('DELETE FROM ShipNames WHERE ship_id = ?', (ship_id,))
+    conn.commit()
+    catalog = catalog_import.export_catalog(conn)
+    nameless = next(e for e in catalog['ships'] if e['id'] == ship_id)
+    assert nameless['name'] is None
+    # A release matched by name only, without the nameless ship
+    catalog['ships'] = [{k: v for k, v in e.items() if k != 'id'}
+                        for e in catalog['ships'] if e['id'] != ship_id]
+    path = write_release(tmp_path, catalog, 'names', '2025-02-01')
+    res = catalog_import.import_release(conn, path)
+    assert res['diff']['ship']['added'] == []
+    assert res['diff']['ship']['missing'] == [None]
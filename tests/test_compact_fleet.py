@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for compact_fleet, packing generated fleets
+
+@author: alexe
+"""
+import pytest
+import compact_fleet
+import fleet_lists
+
+@pytest.fixture
+def db_params():
+    return {'num_players': 6, 'num_rounds': 2, 'num_events': 2,
+            'seed': 7}
+
+def test_same_as_fleet_lists(conn):
+    archive = compact_fleet.FleetArchive.from_db(conn)
+    fleets = fleet_lists.get_fleets(conn)
+    factions = dict(conn.execute('SELECT id, name FROM Factions'))
+    names = fleet_lists.get_names(conn)
+    assert len(archive) == len(fleets) == 12
+    for fleet, compact in zip(fleets.values(), archive):
+        assert compact.to_dict(names, factions) == fleet
+        assert compact == compact_fleet.CompactFleet.from_dict(
+            fleet, {v: k for k, v in factions.items()})
+
+def test_bytes(conn, tmp_path):
+    archive = compact_fleet.FleetArchive.from_db(conn)
+    fleet = archive[3]
+    copy = compact_fleet.CompactFleet.from_bytes(fleet.to_bytes())
+    assert copy.to_bytes() == fleet.to_bytes()
+    assert (copy.id, copy.player) == (fleet.id, fleet.player)
+
+    path = str(tmp_path / 'fleets.bin')
+    archive.save(path)
+    loaded = compact_fleet.FleetArchive.load(path)
+    assert loaded.to_bytes() == archive.to_bytes()
+    assert [f.to_bytes() for f in loaded] == [f.to_bytes() for f in archive]
+    with pytest.raises(ValueError):
+        compact_fleet.FleetArchive.from_bytes(b'nope')
+
+def test_canonical_form(conn):
+    archive = compact_fleet.FleetArchive.from_db(conn)
+    fleet = archive[0]
+    # Same list in another order, from another player
+    shuffled = fleet.to_dict()
+    shuffled['faction'] = fleet.faction_id
+    shuffled['player'] = 'Someone else'
+    shuffled['ships'].reverse()
+    for ship in shuffled['ships']:
+        ship['upgrades'].reverse()
+    shuffled['squadrons'].reverse()
+    other = compact_fleet.CompactFleet.from_dict(
+        shuffled, {fleet.faction_id: fleet.faction_id})
+    assert other == fleet and other.key() == fleet.key()
+    assert len({other, fleet}) == 1
+
+    archive.append(other)
+    groups = archive.dedupe()
+    assert groups[fleet.key()] == [0, len(archive) - 1]
+
+    # Moving an upgrade to another ship makes a different list
+    if len(fleet.ships) > 1 and len(fleet.upgrades):
+        moved = compact_fleet.CompactFleet(
+            faction_id=fleet.faction_id, ships=fleet.ships,
+            upgrade_offsets=[0] + [len(fleet.upgrades)] * len(fleet.ships),
+            upgrades=fleet.upgrades, squadrons=fleet.squadrons,
+            counts=fleet.counts)
+        assert moved != fleet
+
+def test_unknown_faction(conn):
+    fleet = fleet_lists.get_fleet(conn, 1)
+    factions = dict(conn.execute('SELECT name, id FROM Factions'))
+    for faction in (None, 'Unknown'):
+        compact = compact_fleet.CompactFleet.from_dict(
+            {**fleet, 'faction': faction}, factions)
+        assert compact.faction_id == 0
+
+    conn.execute('UPDATE Fleets SET faction_id = NULL WHERE id = 1')
+    archive = compact_fleet.FleetArchive.from_db(conn, fleet_ids=[1])
+    assert archive[0].faction_id == 0
+
+def test_scans(conn):
+    archive = compact_fleet.FleetArchive.from_db(conn)
+    for kind, table, column in [('ship', 'Fleets_Ships', 'ship_id'),
+                                ('squadron', 'Fleets_Squadrons',
+                                 'squadron_id')]:
+        expected = dict(conn.execute(
+            f'SELECT {column}, COUNT(DISTINCT fleet_id) FROM {table}'
+            + f' GROUP BY {column}'))
+        assert dict(archive.popularity(kind)) == expected
+    expected = dict(conn.execute(
+        'SELECT fu.upgrade_id, COUNT(DISTINCT fs.fleet_id)'
+        + ' FROM Fleets_Upgrades AS fu INNER JOIN Fleets_Ships AS fs'
+        + ' ON fs.id = fu.fleet_ship_id GROUP BY fu.upgrade_id'))
+    popularity = archive.popularity('upgrade')
+    assert dict(popularity) == expected
+
+    upgrade_id = popularity.most_common(1)[0][0]
+    found = archive.find('upgrade', upgrade_id)
+    assert len(found) == popularity[upgrade_id]
+    assert all(upgrade_id in archive[ii].upgrades for ii in found)
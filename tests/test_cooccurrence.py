@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for cooccurrence, mining generated fleets
+
+@author: alexe
+"""
+import itertools
+import pytest
+import compact_fleet
+import cooccurrence
+import event_to_file
+import fleet_lists
+
+@pytest.fixture
+def db_params():
+    return {'num_players': 12, 'num_rounds': 2, 'num_events': 4,
+            'seed': 11}
+
+def brute_force(fleets, min_count, max_size):
+    res = {}
+    for items in fleets:
+        for size in range(1, max_size + 1):
+            for itemset in itertools.combinations(sorted(items), size):
+                res[itemset] = res.get(itemset, 0) + 1
+    return {k: v for k, v in res.items() if v >= min_count}
+
+def test_exact_over_partitions(conn):
+    archive = compact_fleet.FleetArchive.from_db(conn)
+    events = cooccurrence.archive_items(
+        archive, fleet_lists.get_names(conn).commanders)
+    fleets = [items for event in events.values() for items in event]
+    expected = brute_force(fleets, cooccurrence.min_count(0.1, len(fleets)),
+                           3)
+
+    # One partition per event, mined in worker processes
+    miner = cooccurrence.Miner(0.1, 3, partition_size=1, workers=2)
+    assert miner.update(conn) == 4
+    assert miner.itemsets() == expected
+
+    # Events added one at a time, some sharing a partition
+    miner = cooccurrence.Miner(0.1, 3, partition_size=20, workers=1)
+    for event_id, event in events.items():
+        miner.add_events({event_id: event})
+    assert len(miner.partitions) == 2
+    assert miner.itemsets() == expected
+    assert miner.update(conn) == 0
+
+def test_flagship(conn):
+    archive = compact_fleet.FleetArchive.from_db(conn)
+    commanders = fleet_lists.get_names(conn).commanders
+    items = cooccurrence.archive_items(archive, commanders)[1][0]
+    fleet = archive[0]
+    flagships = {cooccurrence.encode('flagship', ship_id)
+                 for ii, ship_id in enumerate(fleet.ships)
+                 if commanders & set(fleet.ship_upgrades(ii))}
+    assert {i for i in items
+            if cooccurrence.decode(i)[0] == 'flagship'} == flagships
+
+def test_rules(tmp_path):
+    a, b, c, d = (cooccurrence.encode('upgrade', ii) for ii in range(1, 5))
+    fleets = [{a, b}, {a, b}, {a, b, c}, {a}, {c}, {c, d}, {d}, {b, c}]
+    miner = cooccurrence.Miner(0.3, 2, workers=1)
+    miner.add_events({1: fleets})
+    rules = {(r.antecedent, r.consequent): r for r in miner.rules(0, 0)}
+    assert set(rules) == {((a,), b), ((b,), a)}
+    rule = rules[((a,), b)]
+    # 3 of 8 fleets have a and b, a is in 4 and b in 4
+    assert rule.count == 3 and rule.support == 3 / 8
+    assert rule.confidence == 3 / 4
+    assert rule.lift == pytest.approx(3 / 4 / (4 / 8))
+
+    path = str(tmp_path / 'miner.pickle')
+    miner.save(path)
+    loaded = cooccurrence.Miner.load(path)
+    loaded.add_events({2: [{c, d}, {c, d}]})
+    assert ((c,), d) in {(r.antecedent, r.consequent)
+                         for r in loaded.rules(0, 0)}
+
+def test_revisions(conn):
+    miner = cooccurrence.Miner(0.1, 3, partition_size=20, workers=1)
+    miner.update(conn)
+    assert miner.update(conn) == 0
+
+    # Event 2 loses a fleet, event 3 loses all of them
+    fleet_id = conn.execute('SELECT MIN(id) FROM Fleets WHERE event_id = 2'
+                            ).fetchone()[0]
+    conn.execute('UPDATE Fleets SET event_id = 0 WHERE id = ?', (fleet_id,))
+    conn.execute('UPDATE Fleets SET event_id = 0 WHERE event_id = 3')
+    for ev_id in (2, 3):
+        event_to_file.invalidate(conn, ev_id)
+    assert miner.update(conn) > 0
+    assert miner.update(conn) == 0
+
+    archive = compact_fleet.FleetArchive.from_db(conn)
+    events = cooccurrence.archive_items(
+        archive, fleet_lists.get_names(conn).commanders)
+    fleets = [items for ev_id, event in events.items() if ev_id
+              for items in event]
+    assert miner.num_fleets == len(fleets) == 12 * 3 - 1
+    assert miner.itemsets() == brute_force(
+        fleets, cooccurrence.min_count(0.1, len(fleets)), 3)
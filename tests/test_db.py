@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for db connections, journaling and the lookup statement table
+
+@author: alexe
+"""
+import os
+import sqlite3
+import pytest
+import db
+import migrations
+import sql_queries
+
+def journal_mode(path):
+    conn = sqlite3.connect(path)
+    res = conn.execute('PRAGMA journal_mode').fetchone()[0]
+    conn.close()
+    return res.lower()
+
+def test_pragmas(generated):
+    path, _ = generated
+    conn = db.connect(path)
+    assert conn.execute('PRAGMA synchronous').fetchone() == (1,)
+    assert conn.execute('PRAGMA cache_size').fetchone() == \
+        (db.pragmas['cache_size'],)
+    assert conn.execute('PRAGMA temp_store').fetchone() == (2,)
+    assert migrations.get_version(conn) == migrations.SCHEMA_VERSION
+    conn.close()
+    assert journal_mode(path) == 'delete'
+
+def test_statements():
+    assert set(db.statements) == {'ship', 'upgrade', 'squadron'}
+    order = [fields for _, fields in db.lookup_fields]
+    for obj, lookups in db.statements.items():
+        fields = [f for f, _ in lookups]
+        # Lookups keep the order of lookup_fields, skipping missing ones
+        assert fields == [f for f in order if f in fields]
+        for key, key_fields in db.lookup_fields:
+            query = getattr(sql_queries, f'get_{obj}_from_{key}', None)
+            assert (key_fields, query) in lookups or query is None
+    # The same string objects every time, for SQLite's statement cache
+    again = db.build_statements()
+    assert all(a[1] is b[1] for obj in again
+               for a, b in zip(again[obj], db.statements[obj]))
+
+def test_shared_connection_checkpoints_on_close(generated):
+    path, _ = generated
+    conn = db.get_connection(path)
+    assert db.get_connection(path) is conn
+    assert journal_mode(path) == 'wal'
+    conn.execute("UPDATE Events SET name = 'Checkpointed' WHERE id = 1")
+    conn.commit()
+    assert os.path.exists(path + '-wal')
+
+    db.close_connection(path)
+    # The WAL is folded into the DB file, which is a single file again
+    assert not os.path.exists(path + '-wal')
+    assert journal_mode(path) == 'delete'
+    conn = sqlite3.connect(f'file:{path}?mode=ro&immutable=1', uri=True)
+    assert conn.execute('SELECT name FROM Events WHERE id = 1').fetchone() \
+        == ('Checkpointed',)
+    conn.close()
+
+def test_close_with_other_reader(generated):
+    path, _ = generated
+    conn = db.connect(path, wal=True)
+    reader = sqlite3.connect(path)
+    reader.execute('BEGIN')
+    reader.execute('SELECT COUNT(*) FROM Events').fetchone()
+    # Switching back fails while another connection reads; close still works
+    db.close(conn)
+    reader.rollback()
+    reader.close()
+    other = db.connect(path, wal=True)
+    db.close(other)
+    assert journal_mode(path) == 'delete'
+
+def test_connect_readonly(generated):
+    path, _ = generated
+    conn = db.connect_readonly(path)
+    assert conn.execute('SELECT COUNT(*) FROM Events').fetchone() == (2,)
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("UPDATE Events SET name = 'x'")
+    conn.close()
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA user_version = 0')
+    conn.close()
+    with pytest.raises(ValueError, match='run migrations first'):
+        db.connect_readonly(path)
+    with pytest.raises(FileNotFoundError):
+        db.connect_readonly(path + '.missing')
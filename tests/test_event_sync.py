@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for event_sync, on a generated event page and a stub LLM
+
+@author: alexe
+"""
+import copy
+import random
+import sqlite3
+import pytest
+bs4 = pytest.importorskip('bs4')
+import db
+import event_sync
+import fleet_parser
+import make_views
+from benchmarks import generator
+from benchmarks.stubs import StubParser
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch, no_input):
+    path = str(tmp_path / 'events.sql')
+    conn = generator.copy_catalog(db.DEFAULT_PATH, path)
+    catalog = generator.Catalog(conn)
+    conn.close()
+    event = generator.generate_event(random.Random(1), catalog, 6, 3, 'Sync')
+    stub = StubParser([event])
+    monkeypatch.setattr(fleet_parser, 'parse_fleet', stub)
+    monkeypatch.setattr(fleet_parser, 'parse_fleets',
+                        lambda fleets, **kwargs: [stub(f) for f in fleets])
+    yield path, event, stub
+    db.close_all()
+
+def sync(path, event):
+    soup = bs4.BeautifulSoup(generator.event_html(event), 'html5lib')
+    return event_sync.sync_site(soup, event['url'], event['name'],
+                                sql_path=path)
+
+def scores(path, rnd):
+    conn = sqlite3.connect(path)
+    res = conn.execute('SELECT round, player, points, tournament_points,'
+                       + ' opponent FROM Scores WHERE round = ?',
+                       (rnd,)).fetchall()
+    conn.close()
+    return sorted(res, key=repr)
+
+def test_sync(setup):
+    path, event, stub = setup
+    res = sync(path, event)
+    assert res['rounds']['added'] == [1, 2, 3]
+    assert sorted(res['fleets']['added']) == event['players']
+    assert res['revision'] == 1
+    assert stub.calls == 6
+
+    # Nothing changed: no LLM requests, no new revision
+    res = sync(path, event)
+    assert not any(res['rounds'].values())
+    assert not any(res['fleets'].values())
+    assert res['revision'] == 1
+    assert stub.calls == 6
+
+    # One corrected score, one replaced list, one list with only whitespace
+    # changes, one list removed
+    event = copy.deepcopy(event)
+    players = event['players']
+    rows = event['rounds'][1]
+    row = next(r for r in rows if r[4] is not None)
+    rows[rows.index(row)] = row[:2] + (row[2] + 1,) + row[3:]
+    event['fleets'][players[0]] = event['fleets'][players[1]]
+    event['fleets'][players[2]]['text'] = \
+        event['fleets'][players[2]]['text'].replace('\n', '  \n')
+    event['players'] = players[:-1]
+    res = sync(path, event)
+    assert res['rounds'] == {'added': [], 'changed': [2], 'removed': [],
+                             'adopted': []}
+    assert res['fleets'] == {'added': [], 'changed': [players[0]],
+                             'removed': [players[-1]], 'adopted': [],
+                             'failed': []}
+    assert res['revision'] == 2
+    assert stub.calls == 7
+    assert scores(path, 2) == sorted(rows, key=repr)
+
+def test_adopt_unsynced_event(setup):
+    path, event, stub = setup
+    conn = sqlite3.connect(path)
+    generator.insert_event(conn, event)
+    conn.close()
+    res = sync(path, event)
+    assert res['rounds']['adopted'] == [1, 2, 3]
+    assert sorted(res['fleets']['adopted']) == event['players']
+    assert res['revision'] == 0
+    assert stub.calls == 0
+
+def test_refresh_exports(setup, tmp_path):
+    pd = pytest.importorskip('pandas')
+    path, event, stub = setup
+    sync(path, event)
+    conn = db.connect(path)
+    make_views.build_views(conn, force=True)
+    make_views.export_views(conn, out_dir=str(tmp_path))
+    conn.close()
+
+    # Replace a list: the event's rows in every export are rewritten
+    event = copy.deepcopy(event)
+    players = event['players']
+    event['fleets'][players[0]] = event['fleets'][players[1]]
+    soup = bs4.BeautifulSoup(generator.event_html(event), 'html5lib')
+    res = event_sync.sync_site(soup, event['url'], event['name'],
+                               sql_path=path, out_dir=str(tmp_path))
+    assert res['refreshed'] == [name for name, _, _ in make_views.views]
+    db.close_all()
+
+    # Same as exporting everything again
+    fresh = tmp_path / 'fresh'
+    fresh.mkdir()
+    conn = db.connect(path)
+    make_views.export_views(conn, out_dir=str(fresh))
+    conn.close()
+    for _, _, filename in make_views.views:
+        refreshed, exported = [
+            df.sort_values(list(df.columns)).reset_index(drop=True)
+            for df in (pd.read_csv(tmp_path / filename),
+                       pd.read_csv(fresh / filename))]
+        pd.testing.assert_frame_equal(refreshed, exported, check_dtype=False)
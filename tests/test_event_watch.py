@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for event_watch, polling a local server that replays an event round by
+round
+
+@author: alexe
+"""
+import csv
+import os
+import random
+import sqlite3
+import pytest
+pytest.importorskip('bs4')
+import db
+import event_watch
+import fleet_parser
+import make_views
+from benchmarks import generator, replay
+from benchmarks.stubs import StubParser
+
+def view_standings(path):
+    conn = sqlite3.connect(path)
+    make_views.build_views(conn, ['Fleet_Summary'], force=True)
+    cursor = conn.execute('SELECT player, mov, tp, sos, avg_tp, var_tp'
+                          + ' FROM Fleet_Summary')
+    res = {row[0]: dict(zip(event_watch.standings_columns, row[1:]))
+           for row in cursor.fetchall()}
+    conn.close()
+    return res
+
+def write_summary(path, out_dir):
+    conn = sqlite3.connect(path)
+    make_views.build_views(conn, ['Fleet_Summary'], force=True)
+    cursor = conn.execute('SELECT * FROM Fleet_Summary')
+    with open(os.path.join(out_dir, 'fleet_summary.csv'), 'w',
+              newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([d[0] for d in cursor.description])
+        writer.writerows([['' if v is None else v for v in row]
+                          for row in cursor.fetchall()])
+    conn.close()
+
+def assert_close(value, expected):
+    if expected is None:
+        assert value in (None, '')
+    else:
+        assert float(value) == pytest.approx(expected, abs=0.011)
+
+def test_watch(tmp_path, monkeypatch, no_input):
+    path = str(tmp_path / 'events.sql')
+    conn = generator.copy_catalog(db.DEFAULT_PATH, path)
+    catalog = generator.Catalog(conn)
+    conn.close()
+    event = generator.generate_event(random.Random(2), catalog, 9, 4, 'Live')
+    stub = StubParser([event])
+    monkeypatch.setattr(fleet_parser, 'parse_fleet', stub)
+    monkeypatch.setattr(fleet_parser, 'parse_fleets',
+                        lambda fleets, **kwargs: [stub(f) for f in fleets])
+
+    reports = []
+    delays = []
+    with replay.ReplayServer(replay.snapshots(event)) as server:
+        fetcher = event_watch.HTTPFetcher(server.url)
+        kwargs = {'url': event['url'], 'name': event['name'],
+                  'sql_path': path, 'out_dir': str(tmp_path),
+                  'interval': 1., 'max_interval': 4.,
+                  'on_cycle': reports.append,
+                  'sleep': lambda delay: (delays.append(delay),
+                                          server.advance())}
+        # Fleet lists only, then export the summary the watcher will update
+        event_watch.watch(fetcher, max_cycles=1, **kwargs)
+        write_summary(path, str(tmp_path))
+        server.advance()
+        # One round per cycle, then three polls with nothing new
+        standings = event_watch.watch(fetcher, max_cycles=7, **kwargs)
+        assert server.not_modified == 3
+    db.close_all()
+
+    assert [r['status'] for r in reports] == \
+        ['updated'] * 5 + ['unchanged'] * 3
+    assert [r['rounds']['added'] for r in reports[1:5]] == \
+        [[1], [2], [3], [4]]
+    assert stub.calls == 9
+    assert delays[-3:] == [1., 2., 4.]
+    assert reports[-1]['next_poll_s'] == 4.
+    for report in reports:
+        assert report['total_s'] >= report['fetch_s']
+
+    expected = view_standings(path)
+    table = standings.table()
+    assert set(table) == set(event['players'])
+    with open(tmp_path / 'fleet_summary.csv', newline='') as f:
+        rows = {row['player']: row for row in csv.DictReader(f)}
+    for player, values in expected.items():
+        for column, value in values.items():
+            assert_close(table[player][column], value)
+            assert_close(rows[player][column], value)
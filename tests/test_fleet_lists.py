@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for fleet_lists, rebuilding generated fleets from the DB
+
+@author: alexe
+"""
+import pytest
+import compact_fleet
+import fleet_lists
+import sql_queries
+
+@pytest.fixture
+def db_params():
+    return {'num_players': 6, 'num_rounds': 2, 'num_events': 2,
+            'seed': 3}
+
+@pytest.mark.parametrize('db_params', [
+    {'num_players': 6, 'num_rounds': 2, 'num_events': 2, 'seed': 3},
+    {'num_players': 9, 'num_rounds': 1, 'num_events': 3, 'seed': 4}])
+def test_get_fleets(conn, generated, db_params):
+    _, events = generated
+    fleets = fleet_lists.get_fleets(conn)
+    assert len(fleets) == db_params['num_players'] * db_params['num_events']
+    rebuilt = iter(fleets.values())
+    for ev_id, event in enumerate(events, 1):
+        for player in event['players']:
+            fleet = next(rebuilt)
+            expected = event['fleets'][player]['fleet']
+            assert (fleet['event_id'], fleet['player']) == (ev_id, player)
+            assert fleet['commander'] == expected.get('commander')
+            assert [(s['id'], s['name'], s['base_cost'])
+                    for s in fleet['ships']] == \
+                [(s['id'], s['name'], s['base_cost'])
+                 for s in expected['ships']]
+            assert [[(u['id'], u['name'], u['cost']) for u in s['upgrades']]
+                    for s in fleet['ships']] == \
+                [[(u['id'], u['name'], u['cost']) for u in s['upgrades']]
+                 for s in expected['ships']]
+            assert [(q['id'], q['name'], q['count'])
+                    for q in fleet['squadrons']] == \
+                [(q['id'], q['name'], q['count'])
+                 for q in expected['squadrons']]
+
+def test_same_names_as_single_fleet_query(conn):
+    fleets = fleet_lists.get_fleets(conn, event_id=2)
+    assert {f['event_id'] for f in fleets.values()} == {2}
+    for fleet_id, fleet in fleets.items():
+        names = {row[1] for row in conn.execute(sql_queries.get_fleet_list,
+                                                (fleet_id,) * 3)}
+        rebuilt = {s['name'] for s in fleet['ships']} \
+            | {u['name'] for s in fleet['ships'] for u in s['upgrades']} \
+            | {q['name'] for q in fleet['squadrons']}
+        assert rebuilt == names
+
+def test_selection(conn):
+    names = fleet_lists.Names(conn)
+    fleets = fleet_lists.get_fleets(conn, [3, 1, 999], names=names)
+    assert list(fleets) == [1, 3]
+    assert fleet_lists.get_fleet(conn, 999) is None
+    text = fleet_lists.fleet_text(fleet_lists.get_fleet(conn, 1))
+    assert text.startswith('Name: ')
+
+def test_unknown_components(conn):
+    names = fleet_lists.Names(conn)
+    ship_id = next(iter(names.ships))
+    # Ids that are not in the catalog have no name or cost
+    compact = compact_fleet.CompactFleet(1, 1, 'Player', 1, [ship_id, 60000],
+                                         [0, 1, 1], [60000], [60000], [2])
+    fleet = compact.to_dict(names)
+    assert fleet['ships'][1]['base_cost'] is None
+    text = fleet_lists.fleet_text(fleet)
+    base_cost = names.ships[ship_id][1]
+    assert f'• None (?)\n= {base_cost} Points' in text
+    assert 'None (?)\n= 0 Points' in text
+    assert '• 2 x None (?)' in text
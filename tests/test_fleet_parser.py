@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for fleet_parser response handling, using backends that need no network
+
+@author: alexe
+"""
+import json
+import fleet_parser
+import llm_backends
+
+fleet = {'ships': [{'name': 'CR90 A', 'base_cost': 44, 'upgrades': []}],
+         'squadrons': []}
+
+# Backend that streams a canned response, optionally failing part way
+class CannedBackend(llm_backends.Backend):
+    name = 'canned'
+    supports_schema = True
+
+    def __init__(self, response, fail_after=None):
+        super().__init__(max_failures=1)
+        self.response = response
+        self.fail_after = fail_after
+        self.requests = 0
+
+    def _generate(self, prompt, schema=None):
+        return self.response, None, None
+
+    def _generate_stream(self, prompt, schema=None):
+        self.requests += 1
+        for ii in range(0, len(self.response), 8):
+            if self.fail_after is not None and ii >= self.fail_after:
+                raise ConnectionError('connection reset')
+            yield self.response[ii:ii+8], None, None
+
+def test_parse_fleet():
+    backend = CannedBackend('```json\n' + json.dumps(fleet) + '\n```')
+    assert fleet_parser.parse_fleet('CR90 A (44)', backend=backend) == fleet
+
+def test_failover_drops_partial_response():
+    bad = CannedBackend('{"ships": [{"name": "Garbage", "upgrades": []}]}',
+                        fail_after=16)
+    good = CannedBackend(json.dumps(fleet))
+    pool = llm_backends.BackendPool([bad, good])
+    assert fleet_parser.parse_fleet('CR90 A (44)', backend=pool) == fleet
+    assert good.requests == 1
+
+def test_batch_skips_entries_without_fleet():
+    response = json.dumps([{'index': 0}, {'index': 1, 'fleet': 'CR90 A'},
+                           {'index': 2, 'fleet': fleet}])
+    pool = llm_backends.BackendPool([CannedBackend(response)])
+    assert fleet_parser.parse_batch_llm(['a', 'b', 'c'], pool) == \
+        [None, None, fleet]
+
+# Backend that answers from the fleet texts in the prompt, with fleets
+# mapping each text to its parsed fleet. Batched answers list the entries in
+# reverse order and leave out the texts in skip.
+class LookupBackend(llm_backends.Backend):
+    name = 'lookup'
+    supports_schema = True
+
+    def __init__(self, fleets, skip=()):
+        super().__init__(max_concurrency=2, max_failures=1)
+        self.fleets = fleets
+        self.skip = skip
+        self.batched = []
+
+    def _generate(self, prompt, schema=None):
+        self.batched.append(schema is not None)
+        if schema is None:
+            text = fleet_parser.split_prompt(prompt)
+            return json.dumps(self.fleets[text]), None, None
+        entries = [{'index': ii, 'fleet': self.fleets[text]} for ii, text
+                   in fleet_parser.split_batch_prompt(prompt).items()
+                   if text not in self.skip]
+        return json.dumps(entries[::-1]), None, None
+
+    def _generate_stream(self, prompt, schema=None):
+        yield self._generate(prompt, schema)
+
+def lookup_fleets(num):
+    return {f'Ship {ii} ({40 + ii})\n• Upgrade ({ii})':
+            {'ships': [{'name': f'Ship {ii}', 'base_cost': 40 + ii,
+                        'upgrades': [{'name': 'Upgrade', 'cost': ii}]}],
+             'squadrons': []}
+            for ii in range(num)}
+
+def test_batch_prompt_round_trip():
+    texts = list(lookup_fleets(3)) + ['Squadrons:\n\n• 2 x X-wing (26)']
+    prompt = fleet_parser.build_batch_prompt(texts)
+    assert fleet_parser.split_batch_prompt(prompt) == dict(enumerate(texts))
+    assert fleet_parser.split_prompt(fleet_parser.build_prompt(texts[0])) \
+        == texts[0]
+
+def test_batch_matches_entries_by_index():
+    fleets = lookup_fleets(5)
+    texts = list(fleets)
+    backend = LookupBackend(fleets, skip={texts[1]})
+    parsed = fleet_parser.parse_fleets(texts, batch_size=3, backend=backend)
+    assert parsed == [fleets[text] for text in texts]
+    # Two batches, then the fleet missing from the first one on its own
+    assert sorted(backend.batched) == [False, True, True]
+
+    # Batches of one use the single fleet prompt
+    backend = LookupBackend(fleets)
+    assert fleet_parser.parse_fleets(texts, batch_size=1,
+                                     backend=backend) == list(fleets.values())
+    assert backend.batched == [False] * 5
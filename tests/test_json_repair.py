@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for json_repair
+
+@author: alexe
+"""
+import json
+import pytest
+import json_repair
+
+fleet = {'ships': [{'name': 'CR90 A', 'base_cost': 44,
+                    'upgrades': [{'name': 'Leia Organa', 'cost': 3}]}],
+         'squadrons': [{'name': 'X-wing Squadron', 'count': 2}]}
+fleet_text = json.dumps(fleet)
+
+@pytest.mark.parametrize('text', [
+    # trailing commas
+    '{"ships": [{"name": "CR90 A", "base_cost": 44, "upgrades": '
+    '[{"name": "Leia Organa", "cost": 3,},],},], "squadrons": '
+    '[{"name": "X-wing Squadron", "count": 2},],}',
+    # unquoted keys
+    '{ships: [{name: "CR90 A", base_cost: 44, upgrades: '
+    '[{name: "Leia Organa", cost: 3}]}], squadrons: '
+    '[{name: "X-wing Squadron", count: 2}]}',
+    # single quotes
+    "{'ships': [{'name': 'CR90 A', 'base_cost': 44, 'upgrades': "
+    "[{'name': 'Leia Organa', 'cost': 3}]}], 'squadrons': "
+    "[{'name': 'X-wing Squadron', 'count': 2}]}",
+    # comments
+    '{"ships": [{"name": "CR90 A", "base_cost": 44, // ship\n'
+    '"upgrades": [{"name": "Leia Organa", "cost": 3}]}], /* squads */ '
+    '"squadrons": [{"name": "X-wing Squadron", "count": 2}]}',
+    ])
+def test_repair(text):
+    assert json_repair.loads(text) == fleet
+
+def test_repair_literals_and_bare_words():
+    text = "{'a': True, 'b': None, 'c': CR90 A}"
+    assert json_repair.loads(text) == {'a': True, 'b': None, 'c': 'CR90 A'}
+
+def test_repair_escaped_quotes():
+    assert json_repair.loads("{'name': 'Ackbar\\'s \"fleet\"'}") == \
+        {'name': 'Ackbar\'s "fleet"'}
+
+def test_truncated():
+    text = fleet_text[:fleet_text.index('Organa') + 3]
+    assert json_repair.loads(text) == \
+        {'ships': [{'name': 'CR90 A', 'base_cost': 44,
+                    'upgrades': [{'name': 'Leia Org'}]}]}
+
+def test_truncated_after_key():
+    assert json_repair.loads('{"ships": [], "squadrons":') == \
+        {'ships': [], 'squadrons': None}
+
+def test_code_fence_preamble():
+    text = 'Here is the fleet:\n```json\n' + fleet_text + '\n```\nDone.'
+    assert json_repair.loads(text, start_chars='{') == fleet
+
+def test_preamble_with_braces():
+    text = 'Here {note} then ' + fleet_text
+    assert json_repair.loads(text, start_chars='{') == fleet
+
+def test_no_json():
+    assert json_repair.loads('no fleet here') is None
+
+def test_stream_stops_when_complete():
+    parser = json_repair.StreamingJSONParser(start_chars='{')
+    chunks = ['Sure! {no', 'te} ```json\n', fleet_text[:20],
+              fleet_text[20:] + '\n```', 'more text']
+    wanted = [parser.feed(chunk) for chunk in chunks[:4]]
+    assert wanted == [True, True, True, False]
+    assert parser.done
+    assert parser.feed(chunks[4]) is False
+    assert parser.result() == fleet
+
+def test_stream_fails_on_long_preamble():
+    parser = json_repair.StreamingJSONParser(max_preamble=10)
+    assert parser.feed('a' * 20) is False
+    assert parser.failed
+    assert parser.result() is None
+
+def test_stream_fails_on_unmatched_closer():
+    parser = json_repair.StreamingJSONParser()
+    assert parser.feed('{"a": 1]') is False
+    assert parser.failed
+
+def test_stream_reset():
+    parser = json_repair.StreamingJSONParser(start_chars='{')
+    parser.feed('{"ships": [{"name": "Garb')
+    parser.reset()
+    parser.feed(fleet_text)
+    assert parser.result() == fleet
+
+schema = {
+    'type': 'OBJECT',
+    'properties': {
+        'name': {'type': 'STRING'},
+        'cost': {'type': 'INTEGER'},
+        'items': {'type': 'ARRAY', 'minItems': 1,
+                  'items': {'type': 'INTEGER'}},
+        },
+    'required': ['name', 'items'],
+    }
+check = json_repair.compile_schema(schema)
+
+def test_schema_valid():
+    assert check({'name': 'A', 'cost': 3, 'items': [1]}) == \
+        ({'name': 'A', 'cost': 3, 'items': [1]}, [])
+
+def test_schema_coercion():
+    value, errors = check({'name': 12, 'cost': '7 pts', 'items': [2.0]})
+    assert errors == []
+    assert value == {'name': '12', 'cost': 7, 'items': [2]}
+
+def test_schema_drops_bad_optional_field():
+    value, errors = check({'name': 'A', 'cost': 'free', 'items': [1]})
+    assert errors == []
+    assert value == {'name': 'A', 'items': [1]}
+
+def test_schema_errors():
+    assert check({'name': 'A', 'items': []})[1] == \
+        ['$.items: expected at least 1 items']
+    assert check({'items': [1]})[1] == ['$.name: missing']
+    assert check({'name': 'A', 'items': [True]})[1] == \
+        ['$.items[0]: expected integer']
+    assert check([])[1] == ['$: expected object']
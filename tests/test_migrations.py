@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for migrations, on a copy of the real DB
+
+@author: alexe
+"""
+import sqlite3
+import pytest
+import db
+import make_views
+import migrations
+
+@pytest.fixture
+def conn(tmp_path):
+    src = sqlite3.connect(db.DEFAULT_PATH)
+    conn = sqlite3.connect(str(tmp_path / 'copy.sql'))
+    src.backup(conn)
+    src.close()
+    yield conn
+    conn.close()
+
+def test_canonical_names(conn):
+    old_commanders = conn.execute(
+        f'SELECT fleet_id, commander FROM ({make_views.get_commander})'
+        .replace('un.canonical = 1', 'un.name IN (SELECT MIN(name)'
+                 + ' FROM UpgradeNames GROUP BY upgrade_id)')
+        .replace('sn.canonical = 1', 'sn.name IN (SELECT MAX(name)'
+                 + ' FROM ShipNames GROUP BY ship_id)')).fetchall()
+    assert migrations.get_version(conn) == 0
+    assert migrations.migrate(conn) == migrations.SCHEMA_VERSION
+    assert migrations.migrate(conn) == 0
+
+    for table, id_col, order in migrations.name_tables:
+        agg = 'MAX' if 'DESC' in order else 'MIN'
+        expected = dict(conn.execute(f'SELECT {id_col}, {agg}(name)'
+                                     + f' FROM {table} GROUP BY {id_col}'))
+        canonical = conn.execute(f'SELECT {id_col}, name FROM {table}'
+                                 + ' WHERE canonical = 1').fetchall()
+        assert dict(canonical) == expected
+        assert len(canonical) == len(expected)
+
+    # One commander per fleet; the old join could match shared aliases
+    commanders = conn.execute(
+        f'SELECT fleet_id, commander FROM ({make_views.get_commander})'
+        ).fetchall()
+    assert len(commanders) == len({fleet_id for fleet_id, _ in commanders})
+    assert set(commanders) <= set(old_commanders)
+
+def test_triggers(conn):
+    migrations.migrate(conn)
+    ship_id = conn.execute('SELECT MAX(ship_id) FROM ShipNames').fetchone()[0]
+    new_id = ship_id + 1000
+    conn.execute("INSERT INTO ShipNames VALUES (?, 'b name', 0)", (new_id,))
+    conn.execute("INSERT INTO ShipNames VALUES (?, 'a name', 0)", (new_id,))
+    rows = conn.execute('SELECT name, canonical FROM ShipNames'
+                        + ' WHERE ship_id = ? ORDER BY name', (new_id,))
+    assert rows.fetchall() == [('a name', 0), ('b name', 1)]
+    conn.execute("DELETE FROM ShipNames WHERE name = 'b name'")
+    rows = conn.execute('SELECT name, canonical FROM ShipNames'
+                        + ' WHERE ship_id = ?', (new_id,))
+    assert rows.fetchall() == [('a name', 1)]
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute('UPDATE ShipNames SET canonical = 1 WHERE ship_id = ?',
+                     (ship_id,))
+
+def test_event_dates(conn):
+    # The real DB was scraped with the month one too low
+    assert conn.execute('SELECT date FROM Events ORDER BY id').fetchall() \
+        == [('2025-02-27',), ('2025-02-28',), ('2025-02-29',)]
+    migrations.migrate(conn)
+    assert conn.execute('SELECT date FROM Events ORDER BY id').fetchall() \
+        == [('2025-03-27',), ('2025-03-28',), ('2025-03-29',)]
+
+    conn.executemany('INSERT INTO Events (name, url, date, region)'
+                     + " VALUES (?, '', ?, '')",
+                     [('a', '2025-03-50'), ('b', '2025-00-30'),
+                      ('c', '2025-01-30'), ('d', '2025-11-10')])
+    conn.execute('PRAGMA user_version = 2')
+    migrations.migrate(conn)
+    assert conn.execute("SELECT date FROM Events WHERE name IN"
+                        + " ('a', 'b', 'c', 'd') ORDER BY name").fetchall() \
+        == [('2025-04-05',), ('2025-01-30',), ('2025-02-03',),
+            ('2025-12-10',)]
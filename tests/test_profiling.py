@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for profiling: statement and span timings, and the JSON report
+
+@author: alexe
+"""
+import json
+import os
+import sqlite3
+import pytest
+import profiling
+
+@pytest.fixture
+def profiler():
+    yield profiling.enable()
+    profiling.disable()
+
+def test_disabled(tmp_path):
+    assert not profiling.is_enabled()
+    conn = profiling.connect(':memory:')
+    assert type(conn) is sqlite3.Connection
+    conn.close()
+    with profiling.span('nothing'):
+        pass
+    path = str(tmp_path / 'profile.json')
+    assert profiling.write_report(path) is None
+    assert not os.path.exists(path)
+
+def test_statements(profiler):
+    conn = profiling.connect(':memory:')
+    assert isinstance(conn, profiling.ProfiledConnection)
+    conn.execute('CREATE TABLE t (x INTEGER)')
+    conn.executemany('INSERT INTO t VALUES (?)', [(ii,) for ii in range(5)])
+    for _ in range(3):
+        # Same statement, formatted differently
+        conn.execute('SELECT x\n    FROM t').fetchall()
+    conn.execute('SELECT x FROM t WHERE x = 1').fetchone()
+    conn.execute('SELECT x FROM t WHERE x = 9').fetchone()
+    cursor = conn.cursor()
+    cursor.execute('SELECT x FROM t')
+    cursor.fetchmany(2)
+    conn.close()
+
+    statements = {s['sql']: s for s in profiler.report()['statements']}
+    assert statements['SELECT x FROM t']['count'] == 4
+    assert statements['SELECT x FROM t']['rows'] == 3 * 5 + 2
+    assert statements['SELECT x FROM t WHERE x = 1']['rows'] == 1
+    assert statements['SELECT x FROM t WHERE x = 9']['rows'] == 0
+    assert statements['INSERT INTO t VALUES (?)']['count'] == 1
+
+def test_spans_and_report(tmp_path):
+    profiling.enable(cprofile=True)
+    try:
+        for _ in range(2):
+            with profiling.span('stage'):
+                sum(range(1000))
+        with pytest.raises(KeyError):
+            with profiling.span('failed'):
+                raise KeyError('x')
+        path = str(tmp_path / 'logs' / 'profile.json')
+        res = profiling.write_report(path, top=5)
+    finally:
+        profiling.disable()
+
+    with open(path) as f:
+        report = json.load(f)
+    assert report['spans']['stage']['count'] == 2
+    # Spans are recorded even when the block raises
+    assert report['spans']['failed']['count'] == 1
+    assert report['spans']['stage']['max_s'] <= report['spans']['stage'][
+        'total_s']
+    assert report['cprofile'] and res['cprofile_dump'].endswith('.prof')
+    assert os.path.exists(res['cprofile_dump'])
+
+# --cprofile without --profile writes the default report
+def test_cprofile_default_report(generated, tmp_path, monkeypatch):
+    pytest.importorskip('pandas')
+    import armada
+    path, _ = generated
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('data')
+    try:
+        armada.main(['views', path, '--no-ships', '--no-squadrons',
+                     '--cprofile'])
+    finally:
+        profiling.disable()
+    with open(profiling.DEFAULT_REPORT) as f:
+        report = json.load(f)
+    assert 'view:Fleet_Summary' in report['spans'] and report['cprofile']
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for query_service, against a generated events DB
+
+@author: alexe
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+import urllib.error
+import urllib.request
+import pytest
+import catalog_import
+import db
+import event_to_file
+import make_views
+import query_service
+from benchmarks import loadtest
+
+@pytest.fixture
+def db_params():
+    return {'num_players': 8, 'num_rounds': 3, 'num_events': 2,
+            'seed': 1}
+
+@pytest.fixture
+def events_db(generated):
+    path, _ = generated
+    conn = db.connect(path)
+    make_views.build_views(conn, force=True)
+    conn.close()
+    return path
+
+def get(url, etag=None):
+    request = urllib.request.Request(url)
+    if etag:
+        request.add_header('If-None-Match', etag)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers.get('ETag'), \
+                json.loads(response.read() or 'null')
+    except urllib.error.HTTPError as e:
+        body = e.read()
+        return e.code, e.headers.get('ETag'), json.loads(body or 'null')
+
+def test_endpoints(events_db):
+    with query_service.ServiceThread(events_db) as service:
+        status, _, events = get(service.url + '/events')
+        assert status == 200 and len(events) == 2
+
+        _, _, fleets = get(service.url + '/fleets?event_id=1')
+        assert len(fleets) == 8
+        assert {row['event_id'] for row in fleets} == {1}
+        _, _, page = get(service.url + '/fleets?limit=3&offset=2')
+        assert len(page) == 3
+
+        status, _, fleet = get(service.url + f'/fleets/{fleets[0]["id"]}')
+        assert status == 200 and fleet['player'] == fleets[0]['player']
+        assert fleet['ships']
+        assert fleet['commander'] == fleets[0]['commander']
+        _, _, lists = get(service.url + '/lists?event_id=1')
+        assert [f['id'] for f in lists] == [row['id'] for row in
+                                            sorted(fleets,
+                                                   key=lambda f: f['id'])]
+        _, _, lists = get(service.url + f'/lists?ids={fleets[0]["id"]},0')
+        assert len(lists) == 1
+
+        for kind in ('ships', 'squadrons', 'upgrades'):
+            status, _, rows = get(service.url + f'/popularity/{kind}')
+            assert status == 200
+            assert all(row['num_fleets_containing'] > 0 for row in rows)
+
+        _, _, matchups = get(service.url + '/matchups?event_id=2')
+        # Every game is counted once from each side
+        assert sum(row['games'] for row in matchups) == 8 * 3
+        _, _, by_commander = get(service.url + '/matchups?by=commander')
+        assert 'commander' in by_commander[0]
+
+        assert get(service.url + '/fleets?event_id=x')[0] == 400
+        assert get(service.url + '/matchups?by=player')[0] == 400
+        assert get(service.url + '/fleets/100000')[0] == 404
+        assert get(service.url + '/nothing')[0] == 404
+        assert get(service.url + '/lists')[0] == 400
+        for params in ('limit=-1', 'offset=-1',
+                       f'limit={query_service.MAX_LIMIT + 1}'):
+            assert get(service.url + '/fleets?' + params)[0] == 400
+        assert len(get(service.url + '/fleets?limit=2&offset=1')[2]) == 2
+
+def test_cache_and_etag(events_db):
+    with query_service.ServiceThread(events_db) as service:
+        url = service.url + '/events'
+        _, etag, events = get(url)
+        assert get(url, etag)[0] == 304
+        assert service.service.queries == 1
+
+        # A write to the DB invalidates cached responses
+        conn = db.connect(events_db)
+        conn.execute("UPDATE Events SET name = 'Renamed' WHERE id = 1")
+        conn.commit()
+        conn.close()
+        status, new_etag, new_events = get(url, etag)
+        assert status == 200 and new_etag != etag
+        assert {ev['id']: ev['name'] for ev in new_events}[1] == 'Renamed'
+        assert service.service.queries == 2
+
+def test_load(events_db):
+    with query_service.ServiceThread(events_db) as service:
+        res = loadtest.load_test(service.url, requests=400, concurrency=8,
+                                 conditional=True)
+    assert res['requests'] == 400
+    assert set(res['statuses']) <= {'200', '304'}
+
+def test_cache_revisions(events_db):
+    with query_service.ServiceThread(events_db) as service:
+        urls = [service.url + f'/fleets?event_id={ev_id}' for ev_id in (1, 2)]
+        before = [get(url)[2] for url in urls]
+        assert service.service.queries == 2
+
+        # Event 2 changes: only its responses run again
+        conn = db.connect(events_db)
+        conn.execute('UPDATE Scores SET tournament_points = 0'
+                     + ' WHERE event_id = 2')
+        event_to_file.invalidate(conn, 2)
+        conn.close()
+        after = [get(url)[2] for url in urls]
+        assert service.service.queries == 3
+        assert after[0] == before[0] and after[1] != before[1]
+        assert service.service.cache.kept == 1
+        status, _, events = get(service.url + '/events')
+        assert {ev['id']: ev['revision'] for ev in events} == {1: 0, 2: 1}
+
+def test_errors_and_shared_queries(events_db, monkeypatch):
+    with query_service.ServiceThread(events_db) as service:
+        answer = service.service.answer
+        def broken(route, params):
+            if route == 'events':
+                raise KeyError('no column')
+            return answer(route, params)
+        monkeypatch.setattr(service.service, 'answer', broken)
+        status, _, body = get(service.url + '/events')
+        assert status == 500 and 'KeyError' in body['error']
+        assert get(service.url + '/fleets')[0] == 200
+
+    # A waiter that goes away does not cancel the query for the others
+    service = query_service.QueryService(events_db)
+    answer = service.answer
+    release = threading.Event()
+    def slow(route, params):
+        release.wait(5)
+        return answer(route, params)
+    monkeypatch.setattr(service, 'answer', slow)
+    async def requests():
+        first = asyncio.create_task(service.get('/fleets?event_id=1'))
+        second = asyncio.create_task(service.get('/fleets?event_id=1'))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await second
+    _, body = asyncio.run(requests())
+    assert json.loads(body)
+    assert len(service.cache.entries) == 1
+    service.close()
+
+def test_old_schema(events_db):
+    conn = sqlite3.connect(events_db)
+    conn.execute('PRAGMA user_version = 1')
+    conn.close()
+    with open(events_db, 'rb') as f:
+        before = f.read()
+    with pytest.raises(ValueError, match='run migrations first'):
+        query_service.QueryService(events_db)
+    # Nothing is written to the DB
+    with open(events_db, 'rb') as f:
+        assert f.read() == before
+
+def test_dated_upgrade_costs(events_db, tmp_path):
+    conn = db.connect(events_db)
+    conn.execute("UPDATE Events SET date = '2025-01-10' WHERE id = 1")
+    conn.execute("UPDATE Events SET date = '2025-03-10' WHERE id = 2")
+    conn.commit()
+    catalog = catalog_import.export_catalog(conn)
+    upgrade_id = conn.execute('SELECT upgrade_id FROM Fleets_Upgrades'
+                              + ' GROUP BY upgrade_id ORDER BY COUNT(*) DESC'
+                              ).fetchone()[0]
+    upgrade = next(e for e in catalog['upgrades'] if e['id'] == upgrade_id)
+    upgrade['cost'] += 5
+    path = str(tmp_path / 'errata.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({**catalog, 'version': 'errata',
+                   'effective_date': '2025-02-01'}, f)
+    catalog_import.import_release(conn, path)
+    conn.close()
+
+    # Each event's rows have the cost in effect at the event
+    service = query_service.QueryService(events_db)
+    rows = json.loads(service.answer('popularity/upgrades', {}))
+    service.close()
+    costs = {row['event_id']: row['cost'] for row in rows
+             if row['id'] == upgrade_id}
+    assert costs == {1: upgrade['cost'] - 5, 2: upgrade['cost']}
@@ -10,45 +10,127 @@ results. The html tree is sent to event_to_file for parsing.
 """
 
 import argparse
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
 import time
-from bs4 import BeautifulSoup
 import event_to_file
+import profiling
+import db
+import llm_backends
 
-def parse_webpage(url, name, do_scores=True, do_fleets=True):
+# Headless Chrome. selenium is only imported when a page is fetched, so the
+# CLI starts quickly.
+def headless_chrome():
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
     chrome_options = Options()
     chrome_options.add_argument("--headless")
+    return webdriver.Chrome(options=chrome_options)
 
-    driver = webdriver.Chrome(options=chrome_options)
+# event_sync is only imported for --sync, like event_watch for --watch, so a
+# plain scrape (and --help) does not load them.
+def parse_webpage(url, name, do_scores=True, do_fleets=True,
+                  sql_path=db.DEFAULT_PATH, batch_size=1, backend=None,
+                  sync=False, out_dir='data'):
+    from bs4 import BeautifulSoup
+    driver = headless_chrome()
+    try:
+        with profiling.span('load_page'):
+            driver.get(url)
+            # Wait for Javascript to load
+            time.sleep(2)
 
-    driver.get(url)
-    # Wait for Javascript to load
-    time.sleep(2)
+        # Fleet info loaded into html source, just need to parse it
+        with profiling.span('parse_html'):
+            soup = BeautifulSoup(driver.page_source, 'html5lib')
+    finally:
+        driver.quit()
 
-    # Fleet info loaded into html source, just need to parse it
-    soup = BeautifulSoup(driver.page_source, 'html5lib')
     kwargs = {'url': url, 'name': name,
               'do_scores': do_scores,
-              'do_fleets': do_fleets}
-    event_to_file.parse_site(soup, **kwargs)
+              'do_fleets': do_fleets,
+              'sql_path': sql_path,
+              'batch_size': batch_size,
+              'backend': backend}
+    if sync:
+        import event_sync
+        event_sync.print_report(event_sync.sync_site(soup, out_dir=out_dir,
+                                                     **kwargs))
+    else:
+        event_to_file.parse_site(soup, **kwargs)
 
-    driver.quit()
+# Fetches an event page through a headless browser, for event_watch. Browsers
+# do not make conditional requests, so every fetch returns the rendered page
+# and the watcher skips it if the content has not changed.
+class BrowserFetcher:
+    def __init__(self, url, wait=2):
+        self.driver = headless_chrome()
+        self.url = url
+        self.wait = wait
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        prog="web_scraper",
-        description="program to get SW Armada event data from T4.tools")
+    def fetch(self):
+        with profiling.span('load_page'):
+            self.driver.get(self.url)
+            # Wait for Javascript to load
+            time.sleep(self.wait)
+        return self.driver.page_source
+
+    def close(self):
+        self.driver.quit()
+
+def add_arguments(parser):
     parser.add_argument("url", type=str,
                     help="URL of tournament that you want to analyze")
     parser.add_argument("-n", "--name", type=str,
                         help="Name for tournament within DB (taken from"
                         + " URL if not specified)")
+    parser.add_argument("--db", type=str, default=db.DEFAULT_PATH,
+                        help="SQLite DB to add the event to (default:"
+                        + f" {db.DEFAULT_PATH})")
     parser.add_argument("--no-scores", action='store_true',
                         help="flag to skip storing tournament results")
     parser.add_argument("--no-fleets", action='store_true',
                         help="flag to skip storing fleet information")
-    args = parser.parse_args()
+    parser.add_argument("--sync", action='store_true',
+                        help="update an event that is already in the DB,"
+                        + " re-parsing only rounds and fleet lists that"
+                        + " changed on the page")
+    parser.add_argument("--watch", action='store_true',
+                        help="keep polling the event page and add rounds"
+                        + " and fleet lists as they are posted")
+    parser.add_argument("--interval", type=float, default=60.,
+                        help="seconds between polls in watch mode, doubled"
+                        + " after every poll with no changes (default: 60)")
+    parser.add_argument("--max-interval", type=float, default=600.,
+                        help="longest wait between polls (default: 600)")
+    parser.add_argument("--cycles", type=int,
+                        help="stop watching after this many polls")
+    parser.add_argument("--http", action='store_true',
+                        help="fetch pages with plain (conditional) HTTP"
+                        + " requests instead of a browser in watch mode,"
+                        + " e.g. from benchmarks.replay")
+    parser.add_argument("--out-dir", type=str, default='data',
+                        help="directory of the exported csv files to update"
+                        + " in sync and watch modes (default: data)")
+    parser.add_argument("-b", "--batch-size", type=int, default=1,
+                        help="number of fleet lists to send to the LLM per"
+                        + " request (default: 1)")
+    parser.add_argument("--llm", type=str, nargs='+', default=['gemini'],
+                        choices=sorted(llm_backends.backends),
+                        help="LLM backends for fleet parsing, in order of"
+                        + " preference (default: gemini)")
+    parser.add_argument("--profile", type=str, metavar="REPORT",
+                        help="write a JSON timing report for the run to"
+                        + " REPORT")
+    parser.add_argument("--cprofile", action='store_true',
+                        help="include a cProfile capture in the timing"
+                        + " report (written to"
+                        + f" {profiling.DEFAULT_REPORT} without --profile)")
+
+def main(args):
+    event_to_file.configure_logging()
+    if args.cprofile and not args.profile:
+        args.profile = profiling.DEFAULT_REPORT
+    if args.profile:
+        profiling.enable(cprofile=args.cprofile)
     url = args.url
     name = args.name
     if not name:
@@ -56,5 +138,45 @@ if __name__ == '__main__':
 
     kwargs = {'url': url, 'name': name,
               'do_scores': not args.no_scores,
-              'do_fleets': not args.no_fleets}
-    parse_webpage(**kwargs)
\ No newline at end of file
+              'do_fleets': not args.no_fleets,
+              'sql_path': args.db,
+              'batch_size': max(1, args.batch_size),
+              'backend': llm_backends.BackendPool(args.llm),
+              'sync': args.sync,
+              'out_dir': args.out_dir}
+    if args.watch:
+        import event_watch
+        if args.http:
+            fetcher = event_watch.HTTPFetcher(url)
+        else:
+            fetcher = BrowserFetcher(url)
+        try:
+            event_watch.watch(fetcher, url, name, sql_path=args.db,
+                              interval=args.interval,
+                              max_interval=args.max_interval,
+                              max_cycles=args.cycles,
+                              do_fleets=not args.no_fleets,
+                              out_dir=args.out_dir,
+                              batch_size=kwargs['batch_size'],
+                              backend=kwargs['backend'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            fetcher.close()
+    else:
+        parse_webpage(**kwargs)
+    db.close_all()
+    if not args.no_fleets:
+        for name, stats in kwargs['backend'].report().items():
+            print(f'{name}: {stats}')
+
+    if args.profile:
+        profiling.write_report(args.profile)
+        print(f'Timing report written to {args.profile}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="web_scraper",
+        description="program to get SW Armada event data from T4.tools")
+    add_arguments(parser)
+    main(parser.parse_args())